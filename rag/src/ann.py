@@ -0,0 +1,172 @@
+# rag/src/ann.py
+"""
+Chunk index types for build_index.py and the search parameters the loaders apply.
+
+  flat      exact IndexFlatIP (brute force)
+  ivf-flat  inverted lists over k-means cells, full vectors     (search param: nprobe)
+  ivf-pq    inverted lists, product-quantized vectors           (search param: nprobe)
+  hnsw      HNSW graph over full vectors                        (search param: efSearch)
+
+config.json records the choice as
+  "index": {"type": ..., "factory": ..., "build": {...}, "search": {"nprobe": 16}}
+and `apply_search_params` sets the "search" values on a freshly read index.
+"""
+import time
+
+import faiss
+import numpy as np
+
+from retrieval import search_chunk_mode
+
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw")
+SWEEP = {"nprobe": [1, 2, 4, 8, 16, 32, 64, 128], "efSearch": [16, 32, 64, 128, 256]}
+
+
+def default_nlist(n_rows: int) -> int:
+    # ~4*sqrt(N) cells, but keep >= 39 training points per cell (FAISS's own rule of thumb)
+    return int(max(1, min(4 * np.sqrt(n_rows), n_rows // 39)))
+
+
+def index_spec(index_type: str, dim: int, n_rows: int, nlist: int = None, pq_m: int = 48,
+               pq_bits: int = 8, hnsw_m: int = 32, ef_construction: int = 200,
+               nprobe: int = 16, ef_search: int = 64) -> dict:
+    """Factory string plus build/search parameters for `index_type` (the config.json "index" entry)."""
+    if index_type == "flat":
+        return {"type": "flat", "factory": "Flat", "build": {}, "search": {}}
+    if index_type in ("ivf-flat", "ivf-pq"):
+        nlist = nlist or default_nlist(n_rows)
+        build = {"nlist": nlist}
+        factory = f"IVF{nlist},Flat"
+        if index_type == "ivf-pq":
+            if dim % pq_m:
+                raise ValueError(f"--pq-m must divide the embedding dim ({dim}), got {pq_m}")
+            build.update(pq_m=pq_m, pq_bits=pq_bits)
+            factory = f"IVF{nlist},PQ{pq_m}x{pq_bits}"
+        return {"type": index_type, "factory": factory, "build": build,
+                "search": {"nprobe": min(nprobe, nlist)}}
+    if index_type == "hnsw":
+        return {"type": "hnsw", "factory": f"HNSW{hnsw_m},Flat",
+                "build": {"M": hnsw_m, "efConstruction": ef_construction},
+                "search": {"efSearch": ef_search}}
+    raise ValueError(f"unknown index type '{index_type}' (expected one of {', '.join(INDEX_TYPES)})")
+
+
+def make_index(spec: dict, dim: int):
+    index = faiss.index_factory(dim, spec["factory"], faiss.METRIC_INNER_PRODUCT)
+    if spec["type"] == "hnsw":
+        index.hnsw.efConstruction = spec["build"]["efConstruction"]
+    return index
+
+
+def apply_search_params(index, spec: dict):
+    """Set the recorded nprobe/efSearch on a loaded index; a no-op for flat or old configs."""
+    params = faiss.ParameterSpace()
+    for name, value in ((spec or {}).get("search") or {}).items():
+        params.set_index_parameter(index, name, value)
+    return index
+
+
+def read_index(path, mmap: bool = False):
+    """
+    Read a FAISS index; with `mmap` the vectors stay in the file's page cache
+    (IO_FLAG_MMAP_IFC), so processes serving the same index share one copy.
+    Index types FAISS can't map this way (IVF) are read into memory as usual.
+    """
+    if mmap and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        try:
+            return faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC)
+        except RuntimeError as e:
+            print(f"[ann] cannot mmap {path} ({str(e).splitlines()[0][:80]}); reading it into memory")
+    return faiss.read_index(str(path))
+
+
+def describe(spec: dict) -> str:
+    search = ", ".join(f"{k}={v}" for k, v in ((spec or {}).get("search") or {}).items())
+    return (spec or {}).get("type", "flat") + (f" ({search})" if search else "")
+
+
+def build_from_flat(flat, spec: dict, train_size: int = 100_000, block_rows: int = 65_536, seed: int = 0):
+    """Train `spec` on a sample of the flat index's vectors, then add them all in row order."""
+    index = make_index(spec, flat.d)
+    n = flat.ntotal
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, size=min(train_size, n), replace=False))
+        t0 = time.perf_counter()
+        index.train(flat.reconstruct_batch(sample))
+        print(f"[build] trained {spec['factory']} on {len(sample):,} vectors in {time.perf_counter() - t0:.1f}s")
+    for start in range(0, n, block_rows):
+        index.add(flat.reconstruct_n(start, min(block_rows, n - start)))
+    return apply_search_params(index, spec)
+
+
+# ----------------------------
+# Benchmark against the exact index
+# ----------------------------
+def _courses(index, q_embs, parent_idx, top_courses):
+    res = search_chunk_mode(q_embs, [top_courses] * len(q_embs), index, parent_idx)
+    return [set(parent_idx[ids].tolist()) for ids, _, _ in res]
+
+
+def _latencies_ms(index, q_embs, parent_idx, top_courses):
+    out = []
+    for q in q_embs:
+        t0 = time.perf_counter()
+        search_chunk_mode(q.reshape(1, -1), [top_courses], index, parent_idx)
+        out.append(1e3 * (time.perf_counter() - t0))
+    return np.asarray(out)
+
+
+def _point(index, q_embs, parent_idx, top_courses, exact):
+    got = _courses(index, q_embs, parent_idx, top_courses)
+    recall = np.mean([len(g & e) / len(e) for g, e in zip(got, exact) if e])
+    lat = _latencies_ms(index, q_embs, parent_idx, top_courses)
+    return {"recall": round(float(recall), 4),
+            "p50_ms": round(float(np.percentile(lat, 50)), 3),
+            "p99_ms": round(float(np.percentile(lat, 99)), 3)}
+
+
+def benchmark(flat, index, spec: dict, parent_idx: np.ndarray, top_courses: int = 8,
+              n_queries: int = 200, seed: int = 0) -> dict:
+    """
+    Recall@top_courses of grouped courses vs the exact flat index, p50/p99 single-query
+    latency and serialized size, for flat and for `index` at a sweep of its search param.
+    Queries are chunk vectors sampled from the index itself.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(flat.ntotal, size=min(n_queries, flat.ntotal), replace=False))
+    q_embs = flat.reconstruct_batch(rows)
+    exact = _courses(flat, q_embs, parent_idx, top_courses)
+
+    report = {"queries": len(rows), "top_courses": top_courses,
+              "flat": dict(_point(flat, q_embs, parent_idx, top_courses, exact),
+                           size_bytes=int(faiss.serialize_index(flat).nbytes))}
+    if spec["type"] == "flat":
+        return report
+    report[spec["type"]] = dict(_point(index, q_embs, parent_idx, top_courses, exact),
+                                size_bytes=int(faiss.serialize_index(index).nbytes), **spec["search"])
+    name, = spec["search"]
+    limit = spec["build"].get("nlist", max(SWEEP[name]))
+    sweep = []
+    for value in SWEEP[name]:
+        if value > limit:
+            break
+        apply_search_params(index, {"search": {name: value}})
+        sweep.append(dict(_point(index, q_embs, parent_idx, top_courses, exact), **{name: value}))
+    apply_search_params(index, spec)
+    report["sweep"] = sweep
+    return report
+
+
+def print_benchmark(report: dict):
+    print(f"[build] benchmark: {report['queries']} queries, recall@{report['top_courses']} courses vs flat")
+    print(f"  {'index':<22} {'recall':>7} {'p50 ms':>8} {'p99 ms':>8} {'size MB':>8}")
+    for name, row in report.items():
+        if isinstance(row, dict):
+            params = ", ".join(f"{k}={row[k]}" for k in ("nprobe", "efSearch") if k in row)
+            label = f"{name} ({params})" if params else name
+            print(f"  {label:<22} {row['recall']:>7.3f} {row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f} "
+                  f"{row['size_bytes'] / 1e6:>8.2f}")
+    for row in report.get("sweep", []):
+        (k, v), = ((k, row[k]) for k in ("nprobe", "efSearch") if k in row)
+        print(f"    {k}={v:<14} {row['recall']:>7.3f} {row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f}")
@@ -0,0 +1,130 @@
+# rag/src/bench_grouping.py
+"""
+Microbenchmark: per-query course grouping cost, pandas vs integer parent ids.
+
+"before" is the old serve path (iloc copy, sort_values, drop_duplicates on the
+string parent_id, iterrows); "after" is grouping.group_rows on the int32
+parent ids plus materializing results from the columnar store.
+
+    python rag/src/bench_grouping.py                  # synthetic 20k-chunk catalog
+    python rag/src/bench_grouping.py --index-dir rag/data/processed/index
+"""
+import argparse, time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from grouping import group_rows
+from metastore import MetaStore
+
+STRING_COLS = ["id", "text", "metadata.course_code", "metadata.class_name",
+               "metadata.subject", "metadata.subject_code", "metadata.parent_id"]
+
+
+def synthetic_catalog(n_rows: int, seed: int = 0):
+    """Catalog where courses have 1-3 chunks, with text of realistic length."""
+    rng = np.random.default_rng(seed)
+    cols = {c: [] for c in STRING_COLS}
+    course = 0
+    while len(cols["id"]) < n_rows:
+        n_chunks = int(rng.integers(1, 4))
+        parent = f"subj-{course}::{course:012x}"
+        for c in range(1, n_chunks + 1):
+            cols["id"].append(f"{parent}::chunk-{c}")
+            cols["text"].append(f"Course: SUBJ {course} chunk {c} " + "lorem ipsum " * 38)
+            cols["metadata.course_code"].append(f"SUBJ {course}")
+            cols["metadata.class_name"].append(f"Synthetic Course {course}")
+            cols["metadata.subject"].append("Synthetic Subject (SUBJ)")
+            cols["metadata.subject_code"].append("SUBJ")
+            cols["metadata.parent_id"].append(parent)
+        course += 1
+    cols = {c: v[:n_rows] for c, v in cols.items()}
+    return pd.DataFrame(cols), MetaStore.from_columns(n_rows, cols, {})
+
+
+def group_before(df: pd.DataFrame, idxs, scores, top_courses: int):
+    res_df = df.iloc[idxs].copy()
+    res_df.insert(0, "score", scores)
+    best = (
+        res_df
+        .sort_values("score", ascending=False)
+        .drop_duplicates(subset=["metadata.parent_id"], keep="first")
+        .copy()
+    )
+    top = best.head(top_courses).copy()
+
+    def safe_get(row, col, default=""):
+        val = row.get(col, default)
+        return str(val) if pd.notna(val) else default
+
+    results = []
+    for _, row in top.iterrows():
+        results.append({
+            "course_code": safe_get(row, "metadata.course_code"),
+            "class_name": safe_get(row, "metadata.class_name"),
+            "subject": safe_get(row, "metadata.subject") or safe_get(row, "metadata.subject_code"),
+            "description": safe_get(row, "text"),
+            "score": float(row["score"]),
+        })
+    return results
+
+
+def group_after(store: MetaStore, idxs, scores, top_courses: int):
+    pos = group_rows(idxs, store.parent_idx, top_courses)
+    return [
+        {
+            "course_code": store.get("metadata.course_code", i),
+            "class_name": store.get("metadata.class_name", i),
+            "subject": store.get("metadata.subject", i) or store.get("metadata.subject_code", i),
+            "description": store.get("text", i),
+            "score": float(score),
+        }
+        for i, score in zip(idxs[pos].tolist(), scores[pos].tolist())
+    ]
+
+
+def _per_call_us(fn, repeat: int) -> float:
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return 1e6 * (time.perf_counter() - t0) / repeat
+
+
+def main(index_dir, n_rows: int, sizes, top_courses: int, repeat: int):
+    if index_dir:
+        df = pd.read_csv(Path(index_dir) / "chunks.csv")
+        store = MetaStore.load(Path(index_dir))
+        print(f"[bench] catalog: {index_dir} ({len(store):,} chunks)")
+    else:
+        df, store = synthetic_catalog(n_rows)
+        print(f"[bench] catalog: synthetic ({len(store):,} chunks)")
+
+    rng = np.random.default_rng(1)
+    # no hits at all (e.g. everything filtered out) must group to an empty result too
+    empty = np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+    assert group_before(df, [], [], top_courses) == group_after(store, *empty, top_courses) == [], "empty grouping"
+    print(f"[bench] top_courses={top_courses}, {repeat} calls per size\n")
+    print(f"{'chunks':>8} {'before (us)':>12} {'after (us)':>12} {'speedup':>8}")
+    for k in sizes:
+        k = min(k, len(store))
+        idxs = rng.choice(len(store), size=k, replace=False).astype("int64")
+        scores = np.sort(rng.random(k).astype("float32"))[::-1].copy()
+        before = group_before(df, idxs.tolist(), scores.tolist(), top_courses)
+        after = group_after(store, idxs, scores, top_courses)
+        assert [r["course_code"] for r in before] == [r["course_code"] for r in after], "grouping mismatch"
+        t_before = _per_call_us(lambda: group_before(df, idxs.tolist(), scores.tolist(), top_courses), repeat)
+        t_after = _per_call_us(lambda: group_after(store, idxs, scores, top_courses), repeat)
+        print(f"{k:>8} {t_before:>12.1f} {t_after:>12.1f} {t_before / t_after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--index-dir", default=None, help="benchmark on a built index instead of a synthetic catalog")
+    ap.add_argument("--rows", type=int, default=20000, help="synthetic catalog size (chunks)")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000], help="retrieved chunks per query")
+    ap.add_argument("--top-courses", type=int, default=8)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+    main(args.index_dir, args.rows, args.sizes, args.top_courses, args.repeat)
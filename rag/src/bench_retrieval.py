@@ -0,0 +1,303 @@
+# rag/src/bench_retrieval.py
+"""
+Retrieval benchmark and regression check for app.py's `retrieve_and_group` and
+query.py's `retrieve_chunks`, run offline against a built index.
+
+    python rag/src/bench_retrieval.py run --json bench/base.json
+    ... change the index, encoder or grouping ...
+    python rag/src/bench_retrieval.py run --json bench/new.json
+    python rag/src/bench_retrieval.py compare bench/base.json bench/new.json --tolerance 0.15
+
+`run` reports
+  quality   recall@k and MRR of the expected course codes in golden_queries.jsonl
+            (one {"query": ..., "expected": [...]} per line), for both entry points
+  latency   single-query percentiles per stage (expand, encode, search, bm25, fuse,
+            materialize) and end to end, query cache off
+  edge      EDGE_CASES requests (e.g. filters that leave BM25 nothing) answer 200;
+            any that don't are printed and make `run` exit 1
+  load      closed-loop client threads against the Flask app's /query through its
+            test client (so request coalescing is included): QPS and tail latency
+
+`compare` flags every metric that got worse by more than --tolerance (relative, for
+latency and QPS; latency moves under --min-ms are ignored) or --quality-tolerance
+(absolute, for recall and MRR) and exits 1 if there is any.
+"""
+import argparse, json, os, sys, threading, time
+from pathlib import Path
+
+import numpy as np
+
+SRC = Path(__file__).resolve().parent
+WEB = SRC.parent / "web"
+GOLDEN = SRC / "golden_queries.jsonl"
+
+
+def load_golden(path: Path):
+    return [json.loads(l) for l in Path(path).read_text().splitlines() if l.strip()]
+
+
+def _pct(ms) -> dict:
+    ms = np.asarray(ms, dtype="float64")
+    return {"n": int(len(ms)), "mean": round(float(ms.mean()), 3),
+            **{f"p{p}": round(float(np.percentile(ms, p)), 3) for p in (50, 90, 99)}}
+
+
+# ----------------------------
+# Quality
+# ----------------------------
+def score(ranked_codes, expected, k: int) -> dict:
+    """recall@k of the expected codes and reciprocal rank of the first one found."""
+    top = ranked_codes[:k]
+    found = [c for c in expected if c in top]
+    rank = next((r for r, c in enumerate(ranked_codes, start=1) if c in expected), None)
+    return {"recall": len(found) / len(expected), "rr": 1.0 / rank if rank else 0.0}
+
+
+def quality(golden, retrieve, k: int) -> dict:
+    per_query = []
+    for g in golden:
+        codes = retrieve(g["query"], k)
+        s = score(codes, g["expected"], k)
+        per_query.append({"query": g["query"], "got": codes, **s})
+    return {f"recall@{k}": round(float(np.mean([q["recall"] for q in per_query])), 4),
+            "mrr": round(float(np.mean([q["rr"] for q in per_query])), 4),
+            "per_query": per_query}
+
+
+# ----------------------------
+# Edge cases
+# ----------------------------
+# Requests that must answer 200 on any index: filters that leave no row containing
+# the query terms, so BM25 has nothing to rank before fusion.
+EDGE_CASES = [
+    {"query": "programming", "filters": {"subject_code": "MATH", "level": 200}},
+    {"query": "programming", "mode": "course", "filters": {"subject_code": "NO SUCH SUBJECT"}},
+]
+
+
+def edge_cases(A, top_courses: int) -> list:
+    """The EDGE_CASES requests that did not answer 200, with their status and error."""
+    client = A.app.test_client()
+    failed = []
+    for body in EDGE_CASES:
+        resp = client.post("/query", json=dict(body, top_courses=top_courses))
+        if resp.status_code != 200:
+            failed.append(dict(body, status=resp.status_code, error=(resp.get_json(silent=True) or {}).get("error")))
+    return failed
+
+
+# ----------------------------
+# Per-stage latency
+# ----------------------------
+def stage_latency(A, queries, top_courses: int, repeat: int) -> dict:
+    """Time each stage of the app's serve path separately, then both entry points end to end."""
+    from expansion import expand_query
+    from lexical import FUSE_DEPTH, rrf_fuse
+    from retrieval import search_courses
+    import query as Q
+
+    hybrid = A.HYBRID and A.lexical is not None
+    depth = top_courses * (FUSE_DEPTH if hybrid else 1)
+    stages = {name: [] for name in ("expand", "encode", "search", "bm25", "fuse", "materialize",
+                                    "retrieve_and_group", "retrieve_chunks")}
+    for _ in range(repeat):
+        for q in queries:
+            t0 = time.perf_counter()
+            expanded = expand_query(q)
+            t1 = time.perf_counter()
+            emb = A.query_encoder.embed([q])
+            t2 = time.perf_counter()
+            (row_ids, row_scores, _), = search_courses(emb, [depth], A.index, A.store)
+            t3 = time.perf_counter()
+            stages["expand"].append(1e3 * (t1 - t0))
+            stages["encode"].append(1e3 * (t2 - t1))
+            stages["search"].append(1e3 * (t3 - t2))
+            if hybrid:
+                bm25_ids, _ = A.lexical.search(expanded, depth, A.store.parent_idx)
+                t4 = time.perf_counter()
+                row_ids, row_scores = rrf_fuse([row_ids, bm25_ids], A.store.parent_idx, top_courses)
+                t5 = time.perf_counter()
+                stages["bm25"].append(1e3 * (t4 - t3))
+                stages["fuse"].append(1e3 * (t5 - t4))
+                t3 = t5
+            A._materialize(row_ids, row_scores)
+            stages["materialize"].append(1e3 * (time.perf_counter() - t3))
+
+            t0 = time.perf_counter()
+            A.retrieve_and_group(q, top_courses)
+            stages["retrieve_and_group"].append(1e3 * (time.perf_counter() - t0))
+            t0 = time.perf_counter()
+            Q.retrieve_chunks(q, 0, A.index, A.store, A.query_encoder, top_courses=top_courses)
+            stages["retrieve_chunks"].append(1e3 * (time.perf_counter() - t0))
+    return {name: _pct(ms) for name, ms in stages.items() if ms}
+
+
+# ----------------------------
+# Closed-loop load through the Flask test client
+# ----------------------------
+def load(A, queries, top_courses: int, threads: int, duration: float) -> dict:
+    client = A.app.test_client()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def worker(seed: int):
+        mine, i = [], seed
+        while time.perf_counter() < stop:
+            t0 = time.perf_counter()
+            resp = client.post("/query", json={"query": queries[i % len(queries)], "top_courses": top_courses})
+            if resp.status_code == 200:
+                mine.append(1e3 * (time.perf_counter() - t0))
+            else:
+                with lock:
+                    errors[0] += 1
+            i += 1
+        with lock:
+            latencies.extend(mine)
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    t0 = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    return {"threads": threads, "requests": len(latencies), "errors": errors[0],
+            "qps": round(len(latencies) / elapsed, 1), **{f"{k}_ms": v for k, v in _pct(latencies).items()
+                                                            if k in ("p50", "p90", "p99")}}
+
+
+def run(args):
+    # Configure the app before importing it: this index, no query cache (every call does the work)
+    os.environ["RAG_INDEX_DIR"] = str(Path(args.index_dir).resolve())
+    os.environ["RAG_CACHE_SIZE"] = "0"
+    sys.path.insert(0, str(WEB))
+    import app as A
+    import query as Q
+    from query_cache import QueryCache
+
+    A.load_and_warm_up()
+    if not A.ready.is_set():
+        raise SystemExit(f"[bench] index did not load: {A.startup['error']}")
+    Q.QUERY_CACHE = QueryCache(max_entries=0)
+    golden = load_golden(args.golden)
+    queries = [g["query"] for g in golden]
+    k = args.top_courses
+
+    print(f"[bench] {len(golden)} golden queries, top {k} courses, index {os.environ['RAG_INDEX_DIR']}")
+    report = {
+        "meta": {"index_dir": os.environ["RAG_INDEX_DIR"], "version": A.query_cache.version,
+                 "encoder": (A.config.get("encoder") or {}).get("backend", "torch"),
+                 "expansion": A.query_encoder.mode, "hybrid": A.HYBRID, "top_courses": k,
+                 "cpu_count": os.cpu_count(), "created": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "quality": {
+            "retrieve_and_group": quality(golden, lambda q, n: [r["course_code"] for r in A.retrieve_and_group(q, n)], k),
+            "retrieve_chunks": quality(golden, lambda q, n: [
+                A.store.get("metadata.course_code", i)
+                for i, _ in Q.retrieve_chunks(q, 0, A.index, A.store, A.query_encoder, top_courses=n)[0]], k),
+        },
+    }
+    for name, qr in report["quality"].items():
+        print(f"[bench] {name:<19} recall@{k} {qr[f'recall@{k}']:.3f} | MRR {qr['mrr']:.3f}")
+    report["edge_cases_failed"] = edge_cases(A, k)
+    for f in report["edge_cases_failed"]:
+        print(f"[bench] FAILED edge case: {f}")
+
+    report["latency_ms"] = stage_latency(A, queries, k, args.repeat)
+    print(f"  {'stage':<19} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8}   (ms)")
+    for name, s in report["latency_ms"].items():
+        print(f"  {name:<19} {s['mean']:>8.3f} {s['p50']:>8.3f} {s['p90']:>8.3f} {s['p99']:>8.3f}")
+
+    report["load"] = []
+    print(f"  {'threads':>7} {'qps':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for n in args.threads:
+        r = load(A, queries, k, n, args.duration)
+        report["load"].append(r)
+        print(f"  {r['threads']:>7} {r['qps']:>8.1f} {r.get('p50_ms', 0):>8.2f} {r.get('p99_ms', 0):>8.2f} "
+              f"{r['errors']:>7}")
+
+    if args.json:
+        Path(args.json).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.json).write_text(json.dumps(report, indent=2))
+        print(f"[bench] wrote {args.json}")
+    return 1 if report["edge_cases_failed"] else 0
+
+
+# ----------------------------
+# Compare two runs
+# ----------------------------
+def metrics(report: dict) -> dict:
+    """Flatten a report into name -> (value, direction); direction +1 = higher is better."""
+    out = {}
+    for entry, q in report.get("quality", {}).items():
+        for name, value in q.items():
+            if name != "per_query":
+                out[f"quality.{entry}.{name}"] = (value, +1)
+    for stage, s in report.get("latency_ms", {}).items():
+        for p in ("p50", "p99"):
+            out[f"latency.{stage}.{p}_ms"] = (s[p], -1)
+    for r in report.get("load", []):
+        out[f"load.{r['threads']}t.qps"] = (r["qps"], +1)
+        if "p99_ms" in r:
+            out[f"load.{r['threads']}t.p99_ms"] = (r["p99_ms"], -1)
+    return out
+
+
+def compare(base: dict, new: dict, tolerance: float, quality_tolerance: float, min_ms: float = 0.0):
+    """
+    Rows of (metric, base, new, change, verdict) for the metrics both runs have. Latency
+    changes smaller than `min_ms` in absolute terms are never flagged (timer noise).
+    """
+    a, b = metrics(base), metrics(new)
+    rows = []
+    for name in a:
+        if name not in b:
+            continue
+        (old, sign), (cur, _) = a[name], b[name]
+        if name.startswith("quality."):
+            change = cur - old
+            worse, better = change < -quality_tolerance, change > quality_tolerance
+        else:
+            change = (cur - old) / old if old else 0.0
+            worse, better = sign * change < -tolerance, sign * change > tolerance
+            if name.endswith("_ms") and abs(cur - old) < min_ms:
+                worse = better = False
+        rows.append((name, old, cur, change, "REGRESSION" if worse else "improved" if better else "ok"))
+    return rows
+
+
+def compare_cmd(args) -> int:
+    base, new = (json.loads(Path(p).read_text()) for p in (args.base, args.new))
+    for key in ("index_dir", "version", "encoder", "expansion", "hybrid", "cpu_count"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"[bench] note: {key} differs ({base['meta'].get(key)} -> {new['meta'].get(key)})")
+    rows = compare(base, new, args.tolerance, args.quality_tolerance, args.min_ms)
+    print(f"  {'metric':<42} {'base':>10} {'new':>10} {'change':>9}")
+    for name, old, cur, change, verdict in rows:
+        shown = f"{change:+.3f}" if name.startswith("quality.") else f"{100 * change:+.1f}%"
+        print(f"  {name:<42} {old:>10.3f} {cur:>10.3f} {shown:>9}  {verdict}")
+    regressions = [r for r in rows if r[4] == "REGRESSION"]
+    print(f"[bench] {len(regressions)} regression(s) beyond {100 * args.tolerance:.0f}% "
+          f"(latency/QPS) / {args.quality_tolerance} (recall/MRR)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="benchmark an index")
+    r.add_argument("--index-dir", default=str(SRC.parent / "data" / "processed" / "index"))
+    r.add_argument("--golden", default=str(GOLDEN), help="JSONL of {query, expected} (default: golden_queries.jsonl)")
+    r.add_argument("--top-courses", type=int, default=8)
+    r.add_argument("--repeat", type=int, default=5, help="passes over the golden queries for stage latency")
+    r.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8], help="closed-loop client threads")
+    r.add_argument("--duration", type=float, default=5.0, help="seconds of load per thread count")
+    r.add_argument("--json", default=None, help="write the report here")
+    c = sub.add_parser("compare", help="flag regressions between two reports")
+    c.add_argument("base")
+    c.add_argument("new")
+    c.add_argument("--tolerance", type=float, default=0.15, help="allowed relative latency/QPS change")
+    c.add_argument("--quality-tolerance", type=float, default=0.01, help="allowed absolute recall/MRR drop")
+    c.add_argument("--min-ms", type=float, default=0.5, help="ignore latency changes smaller than this")
+    args = ap.parse_args()
+    sys.exit(compare_cmd(args) if args.cmd == "compare" else run(args))
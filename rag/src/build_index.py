@@ -1,58 +1,324 @@
 # rag/src/build_index.py
-import argparse, json
+import argparse, hashlib, json, os, shutil, time
+from collections import defaultdict
 from pathlib import Path
 
 import faiss
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
+
+from ann import INDEX_TYPES, benchmark, build_from_flat, describe, index_spec, print_benchmark
+from embed_store import EmbeddingStore, text_hash
+from encoders import ENCODER_DIRNAME
+from filters import FILTER_DIRNAME, write_filter_index
+from lexical import LEXICAL_DIRNAME, write_lexical_index
+from metastore import META_DIRNAME, MetaStore, MetaStoreWriter
+from prereqs import PREREQ_DIRNAME, write_prereq_index
+from retrieval import CoursePooler
+from similar import SIMILAR_DIRNAME, SIMILAR_K, write_similarity_graph
+from workpool import WorkerPool, finish_in_order
 
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+COURSE_INDEX_FILE = "courses.faiss"
 TEXT_COL = "text"
 ID_COL = "id"
 
-def load_chunks(csv_path: Path) -> pd.DataFrame:
+def iter_chunks(csv_path: Path, block_rows: int):
+    """Read the chunk CSV in bounded blocks of rows."""
     if not csv_path.exists():
         raise FileNotFoundError(f"Missing file: {csv_path}")
-    df = pd.read_csv(csv_path)
-    if TEXT_COL not in df.columns or ID_COL not in df.columns:
-        raise ValueError(f"Expected columns '{ID_COL}' and '{TEXT_COL}' in {csv_path}")
-    print(f"[build] loaded {len(df):,} chunks from {csv_path}")
-    return df
+    for i, df in enumerate(pd.read_csv(csv_path, chunksize=block_rows)):
+        if i == 0 and (TEXT_COL not in df.columns or ID_COL not in df.columns):
+            raise ValueError(f"Expected columns '{ID_COL}' and '{TEXT_COL}' in {csv_path}")
+        yield df
 
-def main(data_dir: str, out_dir: str):
-    data_dir = Path(data_dir).resolve()
-    out_dir  = Path(out_dir).resolve()
-    out_dir.mkdir(parents=True, exist_ok=True)
+# ----------------------------
+# Encoding (in-process or a pool of CPU workers)
+# ----------------------------
+_worker_model = None
+
+def _load_encoder(model_name: str, torch_threads: int):
+    # Called lazily from the first task rather than as a Pool initializer:
+    # an initializer that raises makes the pool respawn workers forever,
+    # while a task that raises hands the error back to the parent.
+    global _worker_model
+    if _worker_model is None:
+        if torch_threads:
+            import torch
+            torch.set_num_threads(torch_threads)
+        from sentence_transformers import SentenceTransformer
+        _worker_model = SentenceTransformer(model_name)
+    return _worker_model
+
+def _encode_task(model_name: str, torch_threads: int, texts, batch_size: int):
+    model = _load_encoder(model_name, torch_threads)
+    t0 = time.perf_counter()
+    vecs = model.encode(texts, batch_size=batch_size, show_progress_bar=False, normalize_embeddings=True)
+    return os.getpid(), np.asarray(vecs, dtype="float32"), time.perf_counter() - t0
+
+class Encoder:
+    """Encode text blocks in this process (workers=1) or fan them out over a process pool."""
+
+    def __init__(self, model_name: str, workers: int, batch_size: int):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.pool = WorkerPool(workers, "process", label="build")
 
+    def submit(self, texts):
+        return self.pool.submit(_encode_task, self.model_name, self.pool.threads, texts, self.batch_size)
+
+    def close(self):
+        self.pool.close()
+
+# ----------------------------
+# Streaming build
+# ----------------------------
+def build(data_dir: Path, build_dir: Path, out_dir: Path, emb_cache: Path, course_pooling: str = "mean",
+          workers: int = 1, block_rows: int = 4096, batch_size: int = 64,
+          index_type: str = "flat", ann_opts: dict = None, train_size: int = 100_000,
+          bench_queries: int = 200, bench_top: int = 8, similar_k: int = SIMILAR_K) -> str:
+    """Write every artifact into the empty `build_dir`; `out_dir` is only read (the previous config). Returns the version."""
     chunks_csv = data_dir / "rag_chunks.csv"
-    df = load_chunks(chunks_csv)
 
-    print(f"[build] embedding with {MODEL_NAME} …")
-    model = SentenceTransformer(MODEL_NAME)
-    texts = df[TEXT_COL].astype(str).tolist()
-    embs = model.encode(texts, batch_size=64, show_progress_bar=True, normalize_embeddings=True)
-    embs = np.asarray(embs, dtype="float32")
-    print(f"[build] embeddings shape: {embs.shape}")
+    # Only chunks whose text is new or changed since the last build hit the encoder
+    cache = EmbeddingStore(emb_cache, MODEL_NAME)
+    cache_writer = cache.writer()
+    print(f"[build] embedding cache: {cache.dir} ({len(cache):,} vectors)")
+    print(f"[build] streaming {chunks_csv} in blocks of {block_rows:,} rows, {workers} encoder worker(s)")
+
+    encoder = Encoder(MODEL_NAME, workers, batch_size)
+    meta_writer = MetaStoreWriter(build_dir / META_DIRNAME)
+    csv_out = build_dir / "chunks.csv"
+    version_hash = hashlib.sha1()
+    state = {"index": None, "pooler": None, "rows": 0, "encoded": 0, "reused": set()}
+    worker_stats = defaultdict(lambda: [0, 0.0])   # pid -> [chunks encoded, busy seconds]
+    t_start = time.perf_counter()
+
+    def sink(df, hashes, rows, miss, job):
+        """Finish one block in input order: assemble vectors and append to every artifact."""
+        hit = rows >= 0
+        vecs = None
+        if job is not None:
+            pid, vecs, secs = job.get()
+            worker_stats[pid][0] += len(vecs)
+            worker_stats[pid][1] += secs
+        dim = vecs.shape[1] if vecs is not None else cache.dim
+        embs = np.empty((len(df), dim), dtype="float32")
+        if hit.any():
+            embs[hit] = cache.vectors[rows[hit]]
+        if vecs is not None:
+            embs[miss] = vecs
+
+        if state["index"] is None:
+            state["index"] = faiss.IndexFlatIP(dim)  # cosine via inner product on normalized vectors
+            state["pooler"] = CoursePooler(dim, pooling=course_pooling)
+        state["index"].add(embs)
+        cache_writer.add(hashes, embs)
+        df.to_csv(csv_out, mode="w" if state["rows"] == 0 else "a", header=state["rows"] == 0, index=False)
+        codes = meta_writer.append_df(df)
+        state["pooler"].add(embs, codes)
+        version_hash.update(embs.tobytes())
 
-    dim = embs.shape[1]
-    index = faiss.IndexFlatIP(dim)  # cosine via inner product on normalized vectors
-    index.add(embs)
+        state["rows"] += len(df)
+        state["encoded"] += len(miss)
+        state["reused"].update(hashes[i] for i in np.flatnonzero(hit))
+        elapsed = time.perf_counter() - t_start
+        print(f"[build] {state['rows']:,} chunks ({state['rows'] / elapsed:,.0f} chunks/s; "
+              f"{state['encoded']:,} encoded, {state['rows'] - state['encoded']:,} reused)")
+
+    def submitted():
+        for df in iter_chunks(chunks_csv, block_rows):
+            texts = df[TEXT_COL].astype(str).tolist()
+            hashes = [text_hash(t) for t in texts]
+            rows = cache.lookup(hashes)
+            miss = np.flatnonzero(rows < 0)
+            job = encoder.submit([texts[i] for i in miss]) if len(miss) else None
+            yield df, hashes, rows, miss, job
+
+    # Blocks are finished strictly in input order, so row order matches the CSV
+    try:
+        finish_in_order(submitted(), sink, workers)
+    finally:
+        encoder.close()
+
+    index = state["index"]
+    if index is None:
+        raise ValueError(f"No chunks found in {chunks_csv}")
+    dim = index.d
+    cache_writer.commit()
+    meta_writer.close()
+    # The version covers the metadata too (a catalog edit that keeps the text changes
+    # results). Hashing the written store keeps it independent of --block-rows.
+    for path in sorted((build_dir / META_DIRNAME).iterdir()):
+        version_hash.update(path.name.encode())
+        with open(path, "rb") as f:
+            while block := f.read(1 << 20):
+                version_hash.update(block)
+    n_dropped = len(cache) - len(state["reused"])
+    elapsed = time.perf_counter() - t_start
+    print(f"[build] embedded {state['rows']:,} chunks in {elapsed:.1f}s: {state['rows'] - state['encoded']:,} reused, "
+          f"{state['encoded']:,} encoded, {n_dropped:,} stale cache entries dropped")
+    for pid, (n, secs) in sorted(worker_stats.items()):
+        print(f"[build]   worker {pid}: {n:,} chunks in {secs:.1f}s ({n / secs if secs else 0:,.0f} chunks/s)")
+
+    # Vectors are streamed into an exact flat index first; ANN types are trained
+    # on a sample of it afterwards and the flat index doubles as benchmark ground truth.
+    spec = index_spec(index_type, dim, index.ntotal, **(ann_opts or {}))
+    flat = index
+    if spec["type"] != "flat":
+        index = build_from_flat(flat, spec, train_size=train_size)
 
     # Save artifacts
-    faiss.write_index(index, str(out_dir / "faiss.index"))
-    df.to_csv(out_dir / "chunks.csv", index=False)  # <- CSV for simplicity
-    (out_dir / "config.json").write_text(json.dumps(
-        {"model": MODEL_NAME, "dim": dim, "normalize": True}, indent=2
-    ))
+    faiss.write_index(index, str(build_dir / "faiss.index"))
+    print(f"[build] chunk index: {describe(spec)}, {(build_dir / 'faiss.index').stat().st_size / 1e6:.1f} MB on disk")
+    store = MetaStore.open(build_dir / META_DIRNAME)
+    write_filter_index(store, build_dir / FILTER_DIRNAME)   # bitmaps for /query "filters"
+    write_lexical_index(store, build_dir / LEXICAL_DIRNAME)  # course-code lookup + BM25
+    write_prereq_index(store, build_dir / PREREQ_DIRNAME)    # prerequisite DAG + closure bitsets
+    if bench_queries:
+        spec["benchmark"] = benchmark(flat, index, spec, store.parent_idx, top_courses=bench_top, n_queries=bench_queries)
+        print_benchmark(spec["benchmark"])
+    del flat
+
+    # Course-level index: one pooled vector per parent_id, row p == parent id p
+    course_embs = state["pooler"].finalize()
+    course_index = faiss.IndexFlatIP(dim)
+    course_index.add(course_embs)
+    faiss.write_index(course_index, str(build_dir / COURSE_INDEX_FILE))
+    print(f"[build] course index: {len(course_embs):,} courses ({course_pooling}-pooled)")
+    if similar_k > 0:   # "more like this" neighbors for /similar
+        write_similarity_graph(course_embs, build_dir / SIMILAR_DIRNAME, k=similar_k)
+    # Content-derived version: query caches are invalidated whenever the vectors or metadata change
+    if spec["type"] != "flat":   # ANN results differ from exact ones, so cached queries must not carry over
+        version_hash.update(json.dumps({k: spec[k] for k in ("factory", "build", "search")}, sort_keys=True).encode())
+    version = version_hash.hexdigest()[:12]
+    cfg = {"model": MODEL_NAME, "dim": dim, "normalize": True, "version": version,
+           "index": spec, "course_index": {"file": COURSE_INDEX_FILE, "pooling": course_pooling}}
+    # Keep a query encoder activated with encoders.py: it only depends on the model
+    old_cfg = json.loads((out_dir / "config.json").read_text()) if (out_dir / "config.json").exists() else {}
+    old_encoder = old_cfg.get("encoder") or {}
+    if old_encoder.get("backend", "torch") != "torch":
+        if old_encoder.get("model") == MODEL_NAME:
+            cfg["encoder"] = old_encoder
+            if (out_dir / ENCODER_DIRNAME).is_dir():   # the exported model files travel with it
+                shutil.copytree(out_dir / ENCODER_DIRNAME, build_dir / ENCODER_DIRNAME)
+            print(f"[build] keeping the {old_encoder['backend']} query encoder from the previous config.json")
+        else:
+            print(f"[build] WARNING: dropped the {old_encoder['backend']} query encoder "
+                  f"(exported from {old_encoder.get('model')}); rerun encoders.py for {MODEL_NAME}")
+    (build_dir / "config.json").write_text(json.dumps(cfg, indent=2))
+    return version
+
+# ----------------------------
+# Publishing
+# ----------------------------
+# A build never writes into a published directory. It fills <out>.versions/.tmp-<pid>,
+# renames that to <out>.versions/<version>, then points the <out> symlink at it with
+# one os.replace. Servers keep reading the files they have mapped, and a reload
+# (RAG_RELOAD_WATCH follows <out>) only ever sees a complete build. The published
+# version and the one before it (for rollback) are kept; older ones are removed.
+
+def versions_dir(out_dir: Path) -> Path:
+    return out_dir.with_name(out_dir.name + ".versions")
+
+def default_emb_cache(out_dir: Path) -> Path:
+    """<out>.emb_cache, shared by every build (moved out of <out>/emb_cache on the first versioned build)."""
+    cache = out_dir.with_name(out_dir.name + ".emb_cache")
+    legacy = out_dir / "emb_cache"
+    if not cache.exists() and legacy.is_dir() and not out_dir.is_symlink():
+        legacy.rename(cache)
+        print(f"[build] moved the embedding cache to {cache}")
+    return cache
+
+def publish(build_dir: Path, out_dir: Path, version: str) -> Path:
+    """Rename the finished build to <out>.versions/<version> and switch <out> to it."""
+    versions = build_dir.parent
+    target = versions / version
+    previous = out_dir.resolve() if out_dir.exists() else None
+    if previous == target:
+        shutil.rmtree(build_dir)
+        print(f"[build] version {version} is already published at {out_dir}; nothing to switch")
+        return target
+    if target.exists():   # an earlier build with the same content
+        shutil.rmtree(target)
+    build_dir.rename(target)
+    if previous is not None and not out_dir.is_symlink():
+        # an index directory from before versioned builds: keep it as the previous version
+        previous = versions / f"unversioned-{time.strftime('%Y%m%d-%H%M%S')}"
+        out_dir.rename(previous)
+        print(f"[build] moved the old index directory to {previous}")
+    link = out_dir.with_name(f".{out_dir.name}.link-{os.getpid()}")
+    link.unlink(missing_ok=True)
+    link.symlink_to(Path(versions.name) / version)
+    os.replace(link, out_dir)
+    print(f"[build] published version {version}: {out_dir} -> {target}")
+    keep = {target, previous}
+    for old in versions.iterdir():
+        if old not in keep and not old.name.startswith(".") and old.is_dir():
+            shutil.rmtree(old)
+            print(f"[build] removed old version {old.name}")
+    return target
+
+def main(data_dir: str, out_dir: str, course_pooling: str = "mean", emb_cache: str = None,
+         workers: int = 1, block_rows: int = 4096, batch_size: int = 64,
+         index_type: str = "flat", ann_opts: dict = None, train_size: int = 100_000,
+         bench_queries: int = 200, bench_top: int = 8, similar_k: int = SIMILAR_K):
+    data_dir = Path(data_dir).resolve()
+    out_dir  = Path(out_dir).absolute()   # not resolve(): out_dir is the symlink being switched
+    versions = versions_dir(out_dir)
+    versions.mkdir(parents=True, exist_ok=True)
+    emb_cache = Path(emb_cache).resolve() if emb_cache else default_emb_cache(out_dir)
+    build_dir = versions / f".tmp-{os.getpid()}"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    build_dir.mkdir()
+    try:
+        version = build(data_dir, build_dir, out_dir, emb_cache, course_pooling, workers, block_rows, batch_size,
+                        index_type, ann_opts, train_size, bench_queries, bench_top, similar_k)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    publish(build_dir, out_dir, version)
     print("[build] saved:")
     print("  -", out_dir / "faiss.index")
+    print("  -", out_dir / COURSE_INDEX_FILE)
     print("  -", out_dir / "chunks.csv")
+    print("  -", out_dir / META_DIRNAME)
+    print("  -", out_dir / FILTER_DIRNAME)
+    print("  -", out_dir / LEXICAL_DIRNAME)
+    print("  -", out_dir / PREREQ_DIRNAME)
+    if similar_k > 0:
+        print("  -", out_dir / SIMILAR_DIRNAME)
     print("  -", out_dir / "config.json")
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--data-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "rag_export"))
     ap.add_argument("--out-dir",  default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
+    ap.add_argument("--course-pooling", choices=["mean", "max"], default="mean",
+                    help="how chunk vectors are pooled into the course-level index")
+    ap.add_argument("--emb-cache", default=None,
+                    help="embedding cache directory (default: <out-dir>.emb_cache); delete it to force a full re-embed")
+    ap.add_argument("--workers", type=int, default=1, help="encoder processes (1 = encode in this process)")
+    ap.add_argument("--block-rows", type=int, default=4096, help="CSV rows read and embedded per block")
+    ap.add_argument("--batch-size", type=int, default=64, help="encoder batch size")
+    ap.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                    help="chunk index: exact flat, or approximate ivf-flat / ivf-pq / hnsw")
+    ap.add_argument("--nlist", type=int, default=None, help="IVF cells (default ~4*sqrt(chunks))")
+    ap.add_argument("--pq-m", type=int, default=48, help="IVF-PQ sub-quantizers (must divide the dim)")
+    ap.add_argument("--pq-bits", type=int, default=8, help="IVF-PQ bits per sub-quantizer code")
+    ap.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbors per node")
+    ap.add_argument("--ef-construction", type=int, default=200, help="HNSW build-time beam width")
+    ap.add_argument("--nprobe", type=int, default=16, help="IVF cells visited per query (saved to config.json)")
+    ap.add_argument("--ef-search", type=int, default=64, help="HNSW search beam width (saved to config.json)")
+    ap.add_argument("--train-size", type=int, default=100_000, help="vectors sampled to train IVF/PQ")
+    ap.add_argument("--bench-queries", type=int, default=200,
+                    help="sampled queries for the recall/latency benchmark vs flat (0 = skip)")
+    ap.add_argument("--bench-top", type=int, default=8, help="courses per benchmark query (recall@k)")
+    ap.add_argument("--similar-k", type=int, default=SIMILAR_K,
+                    help="precomputed similar courses per course for /similar (0 = skip)")
     args = ap.parse_args()
-    main(args.data_dir, args.out_dir)
\ No newline at end of file
+    ann_opts = {"nlist": args.nlist, "pq_m": args.pq_m, "pq_bits": args.pq_bits, "hnsw_m": args.hnsw_m,
+                "ef_construction": args.ef_construction, "nprobe": args.nprobe, "ef_search": args.ef_search}
+    main(args.data_dir, args.out_dir, args.course_pooling, args.emb_cache,
+         args.workers, args.block_rows, args.batch_size,
+         args.index_type, ann_opts, args.train_size, args.bench_queries, args.bench_top, args.similar_k)
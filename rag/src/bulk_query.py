@@ -0,0 +1,192 @@
+# rag/src/bulk_query.py
+"""
+Bulk offline queries for query.py --queries-file.
+
+Input, one query per line, either plain text or a JSON object:
+
+    machine learning for biology
+    {"query": "intro to nlp", "top_courses": 3, "id": "student-42"}
+
+Output (--out), one JSON object per input query, in input order:
+
+    {"id": "student-42", "query": "intro to nlp", "top_courses": 3,
+     "results": [{"course_code": "CS 421", "class_name": "...", "subject": "...", "score": 0.61}, ...]}
+
+Lines that can't be parsed produce {"line": N, "error": "..."} and the run continues.
+
+The input is read in batches of --batch-size queries: each batch is encoded in one
+call and searched with one multi-row index.search (grouping by course is vectorized
+over the batch), then written out. Only a few batches are in flight at a time, so
+memory stays flat however long the file is. With --workers > 1 the encoding runs in a
+thread or process pool (--pool) while the main process searches and writes.
+"""
+import itertools, json, os, sys, time
+from pathlib import Path
+
+import numpy as np
+
+from retrieval import search_courses
+from workpool import POOLS, WorkerPool, finish_in_order
+
+
+def read_queries(lines, default_top: int):
+    """Yield (line_no, query, top_courses, id) per non-empty line; (line_no, None, 0, error) if unparseable."""
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("{"):
+            yield line_no, line, default_top, None
+            continue
+        try:
+            obj = json.loads(line)
+            query, top = obj["query"], int(obj.get("top_courses", default_top))
+            if not isinstance(query, str) or not query.strip() or top < 1:
+                raise ValueError("needs a non-empty 'query' and a positive 'top_courses'")
+        except (ValueError, KeyError, TypeError) as e:
+            yield line_no, None, 0, f"{type(e).__name__}: {e}"
+            continue
+        yield line_no, query.strip(), top, obj.get("id")
+
+
+# ----------------------------
+# Encoding (in-process, or a thread / process pool)
+# ----------------------------
+_worker_encoder = None
+
+def _encode_task(index_dir: str, expansion: str, expansion_weight: float, threads: int, queries):
+    # Process-pool workers load the encoder once, on their first batch
+    global _worker_encoder
+    if _worker_encoder is None:
+        from encoders import OnnxEncoder, load_encoder
+        from expansion import QueryEncoder
+        os.environ["RAG_TORCH_THREADS"] = str(threads)   # sizes onnxruntime's pool
+        cfg = json.loads((Path(index_dir) / "config.json").read_text())
+        model = load_encoder(cfg, Path(index_dir))
+        if not isinstance(model, OnnxEncoder):
+            import torch
+            torch.set_num_threads(threads)
+        _worker_encoder = QueryEncoder(model, expansion, expansion_weight)
+    return _worker_encoder.embed(queries)
+
+
+class BatchEncoder:
+    """
+    Encode query batches in this process (workers <= 1) or in a thread / process pool.
+    The encoder releases the GIL, so threads overlap encoding with search and writing;
+    process workers load their own copy of the encoder.
+    """
+
+    def __init__(self, query_encoder, workers: int = 1, pool: str = "thread", index_dir: Path = None):
+        self.query_encoder = query_encoder
+        self.index_dir = index_dir
+        self.pool = WorkerPool(workers, pool, label="query")
+
+    def submit(self, queries):
+        if self.pool.kind == "thread" or self.pool.workers <= 1:
+            return self.pool.submit(self.query_encoder.embed, queries)
+        qe = self.query_encoder
+        return self.pool.submit(_encode_task, str(self.index_dir), qe.mode, qe.weight, self.pool.threads, queries)
+
+    def close(self):
+        self.pool.close()
+
+
+# ----------------------------
+# Bulk run
+# ----------------------------
+def _batches(records, batch_size: int):
+    it = iter(records)
+    while batch := list(itertools.islice(it, batch_size)):
+        yield batch
+
+
+def run(session, lines, out, k: int = 0, default_top: int = 8, mode: str = "chunk",
+        batch_size: int = 256, workers: int = 1, pool: str = "thread", index_dir: Path = None) -> dict:
+    """
+    Answer every query in `lines` (an iterable of text lines) with `session`
+    (a query.LocalSession) and write one JSON line per query to `out`. Returns the counts and timings.
+    """
+    store = session.store
+    encoder = BatchEncoder(session.model, workers, pool, index_dir)
+    totals = {"queries": 0, "errors": 0, "encode_s": 0.0, "search_s": 0.0, "write_s": 0.0}
+    t_start = time.perf_counter()
+    next_report = 10_000
+
+    def finish(batch, job):
+        """Search and write one encoded batch (batches finish in input order)."""
+        t0 = time.perf_counter()
+        ok = [r for r in batch if r[1] is not None]
+        hits = []
+        if ok:
+            embs = job.get()
+            t1 = time.perf_counter()
+            hits = search_courses(np.asarray(embs, dtype="float32"), [r[2] for r in ok], session.index, store,
+                                  mode=mode, course_index=session.course_index, min_k=k)
+            totals["encode_s"] += t1 - t0   # waiting for the pool
+            totals["search_s"] += time.perf_counter() - t1
+        t2 = time.perf_counter()
+        answers = iter(hits)
+        rows = []
+        for line_no, query, top, extra in batch:
+            if query is None:
+                rows.append(json.dumps({"line": line_no, "error": extra}))
+                totals["errors"] += 1
+                continue
+            row_ids, scores, _ = next(answers)
+            record = {"id": extra} if extra is not None else {}
+            record.update(query=query, top_courses=top, results=[
+                {"course_code": store.get("metadata.course_code", i), "class_name": store.get("metadata.class_name", i),
+                 "subject": store.get("metadata.subject", i) or store.get("metadata.subject_code", i),
+                 "score": round(float(s), 6)}
+                for i, s in zip(row_ids.tolist(), scores.tolist())
+            ])
+            rows.append(json.dumps(record, ensure_ascii=False))
+        out.write("\n".join(rows) + "\n")
+        out.flush()
+        totals["queries"] += len(ok)
+        totals["write_s"] += time.perf_counter() - t2
+
+    def submitted():
+        nonlocal next_report
+        for batch in _batches(read_queries(lines, default_top), batch_size):
+            if totals["queries"] >= next_report:
+                elapsed = time.perf_counter() - t_start
+                print(f"[query] {totals['queries']:,} queries ({totals['queries'] / elapsed:,.0f} queries/s)")
+                next_report += 10_000
+            queries = [r[1] for r in batch if r[1] is not None]
+            t0 = time.perf_counter()
+            job = encoder.submit(queries) if queries else None
+            totals["encode_s"] += time.perf_counter() - t0   # in-process encoding, or handing off to the pool
+            yield batch, job
+
+    # Memory doesn't grow with the input: only a few batches are pending at a time
+    try:
+        finish_in_order(submitted(), finish, workers)
+    finally:
+        encoder.close()
+    totals["elapsed_s"] = time.perf_counter() - t_start
+    return totals
+
+
+def main(session, queries_file: str, out_path: str = None, k: int = 0, default_top: int = 8,
+         mode: str = "chunk", batch_size: int = 256, workers: int = 1, pool: str = "thread", index_dir: Path = None):
+    if out_path is None:
+        if queries_file == "-":
+            raise ValueError("--out is required when queries come from stdin")
+        out_path = str(Path(queries_file).with_suffix(".results.jsonl"))
+    src = sys.stdin if queries_file == "-" else open(queries_file, encoding="utf-8")
+    try:
+        with open(out_path, "w", encoding="utf-8") as out:
+            t = run(session, src, out, k, default_top, mode, batch_size, workers, pool, index_dir)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+    qps = t["queries"] / t["elapsed_s"] if t["elapsed_s"] else 0.0
+    print(f"[query] {t['queries']:,} queries in {t['elapsed_s']:.2f}s: {qps:,.1f} queries/s "
+          f"(batches of {batch_size}, {workers} {pool} worker(s)); encode {t['encode_s']:.2f}s, "
+          f"search {t['search_s']:.2f}s, write {t['write_s']:.2f}s")
+    if t["errors"]:
+        print(f"[query] {t['errors']:,} line(s) could not be parsed; see the 'error' records")
+    print(f"[query] wrote {out_path}")
+    return t
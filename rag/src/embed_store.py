@@ -0,0 +1,107 @@
+# rag/src/embed_store.py
+"""
+On-disk embedding cache for build_index.py, keyed by (model name, text hash).
+
+Layout of <cache_dir>/<model slug>/:
+  store.json     model name, dim, vector count
+  hashes.bin     20-byte SHA-1 of each chunk text, back to back
+  vectors.f32    float32 vectors (normalized), row i belongs to hash i
+
+A rebuild looks every chunk up by the hash of its text, encodes only the
+misses, and streams exactly the current chunks into a fresh store, so vectors
+of removed or edited chunks are dropped.
+"""
+import hashlib, json, os, re
+from pathlib import Path
+
+import numpy as np
+
+HASH_BYTES = 20
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha1(str(text).encode("utf-8")).digest()
+
+
+def _model_slug(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name)
+
+
+class EmbeddingStore:
+    """Read side: hash -> cached vector, with the vectors memory-mapped."""
+
+    def __init__(self, cache_dir: Path, model_name: str):
+        self.model_name = model_name
+        self.dir = Path(cache_dir) / _model_slug(model_name)
+        self.dim = None
+        self.vectors = np.zeros((0, 0), dtype="float32")
+        self._rows = {}
+        info_path = self.dir / "store.json"
+        if info_path.exists():
+            info = json.loads(info_path.read_text())
+            count = int(info.get("count") or 0)
+            dim = int(info.get("dim") or 0)
+            if info.get("model") == model_name and count and self._sizes_match(count, dim):
+                self.dim = dim
+                raw = (self.dir / "hashes.bin").read_bytes()
+                self.vectors = np.memmap(self.dir / "vectors.f32", dtype="float32", mode="r",
+                                         shape=(count, self.dim))
+                self._rows = {raw[i * HASH_BYTES:(i + 1) * HASH_BYTES]: i for i in range(count)}
+
+    def _sizes_match(self, count: int, dim: int) -> bool:
+        # A build interrupted mid-commit leaves files that disagree with store.json;
+        # treat that as an empty cache rather than reading garbage.
+        try:
+            return ((self.dir / "hashes.bin").stat().st_size == count * HASH_BYTES and
+                    (self.dir / "vectors.f32").stat().st_size == count * dim * 4)
+        except FileNotFoundError:
+            return False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def lookup(self, hashes):
+        """Row in `vectors` for each hash, -1 where the text is not cached."""
+        return np.fromiter((self._rows.get(h, -1) for h in hashes), dtype="int64", count=len(hashes))
+
+    def writer(self) -> "EmbeddingStoreWriter":
+        return EmbeddingStoreWriter(self.dir, self.model_name)
+
+
+class EmbeddingStoreWriter:
+    """Write side: append (hash, vector) pairs to temp files, then swap them in atomically."""
+
+    def __init__(self, store_dir: Path, model_name: str):
+        self.dir = Path(store_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.dim = None
+        self.count = 0
+        self._seen = set()
+        self._hashes = open(self.dir / "hashes.bin.tmp", "wb")
+        self._vectors = open(self.dir / "vectors.f32.tmp", "wb")
+
+    def add(self, hashes, vectors: np.ndarray):
+        """Append vectors for `hashes`; returns how many were new to this writer."""
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        before = self.count
+        if self.dim is None and len(vectors):
+            self.dim = int(vectors.shape[1])
+        for h, v in zip(hashes, vectors):
+            if h in self._seen:   # identical texts share one cached vector
+                continue
+            self._seen.add(h)
+            self._hashes.write(h)
+            self._vectors.write(v.tobytes())
+            self.count += 1
+        return self.count - before
+
+    def commit(self):
+        self._hashes.close()
+        self._vectors.close()
+        os.replace(self.dir / "hashes.bin.tmp", self.dir / "hashes.bin")
+        os.replace(self.dir / "vectors.f32.tmp", self.dir / "vectors.f32")
+        (self.dir / "store.json").write_text(json.dumps(
+            {"model": self.model_name, "dim": self.dim, "count": self.count}, indent=2
+        ))
+
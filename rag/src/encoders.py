@@ -0,0 +1,316 @@
+# rag/src/encoders.py
+"""
+Query encoder backends for app.py and query.py.
+
+  torch       SentenceTransformer(config["model"]) as is (the reference; always the fallback)
+  torch-int8  the same model with its Linear layers dynamically quantized to int8
+  onnx        the model (transformer + pooling) exported to ONNX, run by onnxruntime
+  onnx-int8   the ONNX graph with int8 dynamically quantized weights
+
+config.json selects one with
+  "encoder": {"backend": "onnx-int8", "model": ..., "path": "encoder/model.int8.onnx", "parity": {...}}
+which only this script writes, after the backend passed the parity checks:
+
+    python encoders.py --index-dir ../data/processed/index --backend onnx-int8
+
+It exports the model into <index_dir>/encoder/ (ONNX backends), compares the candidate
+with the reference on a sample of indexed chunks (cosine of the embeddings) and on a
+query set (overlap of the top courses retrieved), and activates it only when both are
+above --min-cosine / --min-overlap. `--backend torch` switches back to the reference.
+"""
+import argparse, json, os, shutil, sys, threading, time
+from pathlib import Path
+
+import numpy as np
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+ENCODER_DIRNAME = "encoder"
+
+# Default query set for the top-k check: broad interests across majors, like real traffic
+DEFAULT_QUERIES = [
+    "machine learning", "courses about databases", "intro to accounting", "organic chemistry lab",
+    "statistics for social science", "computer security", "music theory", "public health policy",
+    "urban planning", "creative writing workshop", "operations research", "cognitive psychology",
+    "data visualization", "microeconomics", "human anatomy", "art history survey",
+    "nlp", "ai ethics", "bioinformatics", "classes with no prerequisites", "calculus for engineers",
+    "spanish conversation", "film studies", "environmental policy", "nursing clinical practice",
+    "marketing analytics", "philosophy of mind", "signal processing", "kinesiology", "game design",
+]
+
+
+class OnnxEncoder:
+    """
+    `encode` like SentenceTransformer.encode, backed by an onnxruntime session. The
+    session is created on first use in each process: onnxruntime's thread pool does not
+    survive a fork, so a gunicorn master that preloads the encoder must not start it.
+    """
+
+    def __init__(self, onnx_path: Path, tokenizer_dir: Path, max_seq_length: int = 256):
+        # the `tokenizers` runtime directly: importing transformers (and torch) takes seconds
+        from tokenizers import Tokenizer
+        self.path = Path(onnx_path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"{self.path} not found")
+        tokenizer_dir = Path(tokenizer_dir)
+        self.tokenizer = Tokenizer.from_file(str(tokenizer_dir / "tokenizer.json"))
+        pad = json.loads((tokenizer_dir / "tokenizer_config.json").read_text()).get("pad_token", "[PAD]")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad) or 0, pad_token=pad)
+        self.tokenizer.enable_truncation(max_seq_length)
+        self.max_seq_length = max_seq_length
+        self._session, self._pid = None, None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    import onnxruntime as ort
+                    opts = ort.SessionOptions()
+                    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    # same budget as torch: RAG_TORCH_THREADS, else OMP_NUM_THREADS (gunicorn.conf.py)
+                    threads = int(os.environ.get("RAG_TORCH_THREADS") or os.environ.get("OMP_NUM_THREADS") or 0)
+                    if threads:
+                        opts.intra_op_num_threads = threads
+                    session = ort.InferenceSession(str(self.path), opts, providers=["CPUExecutionProvider"])
+                    self._inputs = {i.name for i in session.get_inputs()}
+                    self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def encode(self, texts, batch_size: int = 32, normalize_embeddings: bool = False, **_):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        session = self._get_session()
+        # similar lengths per batch means less padding (SentenceTransformer does the same)
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        out = np.zeros((len(texts), 0), dtype="float32")
+        for start in range(0, len(texts), batch_size):
+            pos = order[start:start + batch_size]
+            enc = self.tokenizer.encode_batch([texts[i] for i in pos])
+            feed = {name: np.array([getattr(e, attr) for e in enc], dtype="int64")
+                    for name, attr in (("input_ids", "ids"), ("attention_mask", "attention_mask"),
+                                       ("token_type_ids", "type_ids"))
+                    if name in self._inputs}
+            vecs = session.run(None, feed)[0].astype("float32")
+            if out.shape[1] == 0:
+                out = np.zeros((len(texts), vecs.shape[1]), dtype="float32")
+            out[pos] = vecs
+        if normalize_embeddings:
+            norms = np.linalg.norm(out, axis=1, keepdims=True)
+            out /= np.maximum(norms, 1e-12)
+        return out[0] if single else out
+
+
+def _sentence_transformer(model_name: str, int8: bool = False):
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device="cpu")
+    if int8:
+        import torch
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def _make_encoder(spec: dict, index_dir: Path):
+    backend = spec["backend"]
+    if backend in ("torch", "torch-int8"):
+        return _sentence_transformer(spec["model"], int8=backend == "torch-int8")
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEncoder(index_dir / spec["path"], index_dir / spec.get("tokenizer", ENCODER_DIRNAME),
+                           spec.get("max_seq_length", 256))
+    raise ValueError(f"unknown encoder backend '{backend}' (expected one of {', '.join(BACKENDS)})")
+
+
+def load_encoder(cfg: dict, index_dir: Path):
+    """
+    The query encoder selected by config.json's "encoder" entry, or the reference
+    SentenceTransformer when there is none or the selected backend cannot be loaded.
+    """
+    spec = cfg.get("encoder") or {}
+    if spec.get("backend", "torch") != "torch":
+        try:
+            if spec.get("model") != cfg["model"]:
+                raise ValueError(f"exported from {spec.get('model')}, index uses {cfg['model']}")
+            encoder = _make_encoder(spec, Path(index_dir))
+            print(f"[encoder] using {spec['backend']} backend")
+            return encoder
+        except Exception as e:
+            print(f"[encoder] cannot use {spec['backend']} backend ({e}); falling back to SentenceTransformer")
+    return _sentence_transformer(cfg["model"])
+
+
+# ----------------------------
+# Export
+# ----------------------------
+def export_onnx(model_name: str, out_dir: Path, quantize: bool = False) -> Path:
+    """
+    Export the whole SentenceTransformer (transformer, pooling, normalize) as one ONNX
+    graph with dynamic batch/sequence axes, plus its tokenizer; optionally add an int8
+    dynamically quantized copy. Returns the path of the graph to serve.
+    """
+    import torch
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    st = _sentence_transformer(model_name)
+    st.tokenizer.save_pretrained(str(out_dir))
+    sample = st.tokenizer(["a short query", "a somewhat longer sentence to trace the export with"],
+                          padding=True, return_tensors="pt")
+    names = list(sample.keys())
+
+    class Pooled(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.st = st
+
+        def forward(self, *inputs):
+            return self.st(dict(zip(names, inputs)))["sentence_embedding"]
+
+    path = out_dir / "model.onnx"
+    axes = {n: {0: "batch", 1: "seq"} for n in names}
+    axes["sentence_embedding"] = {0: "batch"}
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        torch.onnx.export(Pooled().eval(), tuple(sample[n] for n in names), str(path), input_names=names,
+                          output_names=["sentence_embedding"], dynamic_axes=axes, opset_version=17, dynamo=False)
+    print(f"[encoder] exported {model_name} to {path} in {time.perf_counter() - t0:.1f}s "
+          f"({path.stat().st_size / 1e6:.1f} MB)")
+    if not quantize:
+        return path
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    qpath = out_dir / "model.int8.onnx"
+    quantize_dynamic(str(path), str(qpath), weight_type=QuantType.QInt8)
+    print(f"[encoder] quantized to {qpath} ({qpath.stat().st_size / 1e6:.1f} MB)")
+    return qpath
+
+
+# ----------------------------
+# Parity checks
+# ----------------------------
+def _encode_ms(model, queries):
+    """Embeddings one query at a time (as served) and the per-query latencies in ms."""
+    embs, lat = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        embs.append(model.encode([q], normalize_embeddings=True)[0])
+        lat.append(1e3 * (time.perf_counter() - t0))
+    return np.asarray(embs, dtype="float32"), np.asarray(lat)
+
+
+def parity(reference, candidate, texts, queries, index, store, top_courses: int = 8, batch_size: int = 64) -> dict:
+    """
+    Cosine between reference and candidate embeddings of `texts` (indexed chunks), and
+    overlap of the top `top_courses` courses each retrieves for `queries`, plus the
+    single-query encode latency of both.
+    """
+    from retrieval import search_courses
+    ref = reference.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    cand = candidate.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    cos = np.einsum("ij,ij->i", ref, cand)
+
+    _encode_ms(reference, queries[:2])   # warm up both before timing
+    _encode_ms(candidate, queries[:2])
+    q_ref, lat_ref = _encode_ms(reference, queries)
+    q_cand, lat_cand = _encode_ms(candidate, queries)
+    tops = [top_courses] * len(queries)
+    got_ref = search_courses(q_ref, tops, index, store)
+    got_cand = search_courses(q_cand, tops, index, store)
+    overlap = [len(set(store.parent_idx[a].tolist()) & set(store.parent_idx[b].tolist())) / max(len(a), 1)
+               for (a, _, _), (b, _, _) in zip(got_ref, got_cand)]
+    return {
+        "chunks": len(texts),
+        "cosine_mean": round(float(cos.mean()), 5),
+        "cosine_p01": round(float(np.percentile(cos, 1)), 5),
+        "cosine_min": round(float(cos.min()), 5),
+        "queries": len(queries),
+        "top_courses": top_courses,
+        "overlap_mean": round(float(np.mean(overlap)), 4),
+        "overlap_min": round(float(np.min(overlap)), 4),
+        "reference_p50_ms": round(float(np.percentile(lat_ref, 50)), 3),
+        "candidate_p50_ms": round(float(np.percentile(lat_cand, 50)), 3),
+    }
+
+
+def main(index_dir: str, backend: str, sample: int = 2000, queries_file: str = None, top_courses: int = 8,
+         min_cosine: float = 0.99, min_overlap: float = 0.9, activate: bool = True) -> int:
+    import faiss
+    from ann import apply_search_params
+    from metastore import MetaStore
+    from expansion import expand_query
+
+    index_dir = Path(index_dir).resolve()
+    cfg_path = index_dir / "config.json"
+    cfg = json.loads(cfg_path.read_text())
+    if backend == "torch":
+        cfg.pop("encoder", None)
+        cfg_path.write_text(json.dumps(cfg, indent=2))
+        print(f"[encoder] {cfg_path}: using the reference SentenceTransformer")
+        return 0
+
+    reference = _sentence_transformer(cfg["model"])
+    spec = {"backend": backend, "model": cfg["model"]}
+    # export next to the live files; they are only replaced once the new ones pass
+    staging = index_dir / f"{ENCODER_DIRNAME}.new"
+    shutil.rmtree(staging, ignore_errors=True)
+    if backend.startswith("onnx"):
+        path = export_onnx(cfg["model"], staging, quantize=backend == "onnx-int8")
+        spec.update(path=f"{ENCODER_DIRNAME}/{path.name}", tokenizer=ENCODER_DIRNAME,
+                    max_seq_length=reference.max_seq_length)
+        candidate = OnnxEncoder(path, staging, reference.max_seq_length)
+    else:
+        candidate = _make_encoder(spec, index_dir)
+
+    store = MetaStore.load(index_dir)
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(len(store), size=min(sample, len(store)), replace=False))
+    texts = [store.get("text", int(i)) for i in rows]
+    if queries_file:
+        queries = [l.strip() for l in Path(queries_file).read_text().splitlines() if l.strip()]
+    else:
+        queries = DEFAULT_QUERIES
+    # queries are encoded expanded, exactly as served
+    queries = [expand_query(q) for q in queries]
+    index = faiss.read_index(str(index_dir / "faiss.index"))
+    apply_search_params(index, cfg.get("index"))
+
+    report = parity(reference, candidate, texts, queries, index, store, top_courses)
+    print(f"[encoder] {backend} vs reference on {report['chunks']:,} chunks: cosine mean {report['cosine_mean']:.4f}"
+          f" | p01 {report['cosine_p01']:.4f} | min {report['cosine_min']:.4f}")
+    print(f"[encoder] top-{top_courses} course overlap on {report['queries']} queries: "
+          f"mean {report['overlap_mean']:.3f} | min {report['overlap_min']:.3f}")
+    print(f"[encoder] single-query encode p50: reference {report['reference_p50_ms']:.2f} ms | "
+          f"{backend} {report['candidate_p50_ms']:.2f} ms")
+
+    failed = []
+    if report["cosine_mean"] < min_cosine:
+        failed.append(f"cosine mean {report['cosine_mean']:.4f} < {min_cosine}")
+    if report["overlap_mean"] < min_overlap:
+        failed.append(f"overlap mean {report['overlap_mean']:.3f} < {min_overlap}")
+    if failed or not activate:
+        shutil.rmtree(staging, ignore_errors=True)
+    if failed:
+        print(f"[encoder] NOT activating {backend}: " + "; ".join(failed))
+        return 1
+    if not activate:
+        print(f"[encoder] {backend} passed (not activated: --no-activate)")
+        return 0
+    if staging.exists():
+        shutil.rmtree(index_dir / ENCODER_DIRNAME, ignore_errors=True)
+        staging.rename(index_dir / ENCODER_DIRNAME)
+    spec["parity"] = dict(report, min_cosine=min_cosine, min_overlap=min_overlap)
+    cfg["encoder"] = spec
+    cfg_path.write_text(json.dumps(cfg, indent=2))
+    print(f"[encoder] activated {backend} in {cfg_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Export, verify and activate a query encoder backend")
+    ap.add_argument("--index-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
+    ap.add_argument("--backend", choices=BACKENDS, required=True)
+    ap.add_argument("--sample", type=int, default=2000, help="indexed chunks compared by cosine")
+    ap.add_argument("--queries-file", default=None, help="one query per line (default: a built-in set)")
+    ap.add_argument("--top-courses", type=int, default=8)
+    ap.add_argument("--min-cosine", type=float, default=0.99, help="required mean cosine vs the reference")
+    ap.add_argument("--min-overlap", type=float, default=0.9, help="required mean top-k course overlap")
+    ap.add_argument("--no-activate", action="store_true", help="only report; leave config.json as is")
+    args = ap.parse_args()
+    sys.exit(main(args.index_dir, args.backend, args.sample, args.queries_file, args.top_courses,
+                  args.min_cosine, args.min_overlap, activate=not args.no_activate))
@@ -0,0 +1,211 @@
+# rag/src/expansion.py
+"""
+Query expansion shared by app.py, query.py and encoders.py.
+
+Topics are matched with one precompiled pattern (one named group per topic), so a
+query is scanned once instead of once per topic. Two ways to use the matches:
+
+  string     append the topics' synonym phrases to the query text before encoding
+             (the original behaviour; the encoder sees a much longer input)
+  embedding  encode only the query and blend it with the mean embedding of the
+             matched phrases, which are encoded once per process
+
+    python expansion.py --index-dir ../data/processed/index --weights 0.3 0.5 0.7
+
+compares the two on a query set: encode latency and overlap of the top courses.
+"""
+import argparse, json, re, threading, time
+from pathlib import Path
+
+import numpy as np
+
+EXPANSION_MODES = ("string", "embedding")
+SYNONYM_WEIGHT = 0.5   # share of the synonym centroid in an embedding-mode query vector
+
+TOPIC_SYNONYMS = {
+    r"\bnlp\b": [
+        "natural language processing", "computational linguistics",
+        "text mining", "language modeling", "transformers", "sequence models"
+    ],
+    r"\bml\b|\bmachine learning\b": [
+        "supervised learning", "unsupervised learning", "classification",
+        "regression", "neural networks", "support vector machines", "clustering"
+    ],
+    r"\bai\b": [
+        "artificial intelligence", "knowledge representation", "search algorithms",
+        "planning", "intelligent agents"
+    ],
+    r"\bdata viz\b|\bvisuali[sz]ation\b|\btableau\b": [
+        "data visualization", "tableau", "plotting", "dashboards", "visual analytics"
+    ],
+    r"\bstats?\b|\bstatistics\b": [
+        "statistical inference", "probability", "hypothesis testing",
+        "regression analysis", "experimental design"
+    ],
+    r"\boptimization\b|\boperations research\b|\bor\b": [
+        "linear programming", "integer programming", "stochastic optimization",
+        "operations research"
+    ],
+    r"\bcomputational biology\b|\bbioinformatics\b": [
+        "genomics", "sequence analysis", "biostatistics", "systems biology"
+    ],
+    r"\bsecurity\b|\bcybersecurity\b": [
+        "cryptography", "network security", "secure systems", "access control"
+    ],
+    r"\bdatabases?\b": [
+        "relational databases", "sql", "transaction processing", "query optimization"
+    ],
+    r"\beconomics?\b|\becon\b": [
+        "microeconomics", "macroeconomics", "econometrics"
+    ],
+    r"\bpsychology\b|\bcognitive\b": [
+        "cognitive science", "perception", "human factors", "behavioral science"
+    ],
+}
+
+# The topics' patterns match disjoint words, so one leftmost scan finds every topic
+_TOPICS = list(TOPIC_SYNONYMS.values())
+_COMBINED = re.compile("|".join(f"(?P<t{i}>{p})" for i, p in enumerate(TOPIC_SYNONYMS)))
+# Every distinct phrase once, and each topic's phrases as positions in that list
+PHRASES = list(dict.fromkeys(p for syns in _TOPICS for p in syns))
+_TOPIC_PHRASES = [[PHRASES.index(p) for p in syns] for syns in _TOPICS]
+
+
+def match_topics(q: str):
+    """Indexes of the topics mentioned in `q`, in TOPIC_SYNONYMS order."""
+    return sorted({int(m.lastgroup[1:]) for m in _COMBINED.finditer(q.lower())})
+
+
+def synonym_phrases(q: str):
+    """Positions in PHRASES of the synonyms for the topics in `q` (first occurrence order)."""
+    return list(dict.fromkeys(p for t in match_topics(q) for p in _TOPIC_PHRASES[t]))
+
+
+def expand_query(q: str) -> str:
+    """Add synonyms/related phrases to the query while keeping the original text."""
+    phrases = synonym_phrases(q)
+    if phrases:
+        return q + " | " + " ; ".join(PHRASES[p] for p in phrases)
+    return q
+
+
+class QueryEncoder:
+    """
+    Normalized query vectors from an encoder (anything with SentenceTransformer's
+    `encode`), expanded in `mode`. The phrase vectors for embedding mode are encoded
+    on first use (`prepare`) in each process.
+    """
+
+    def __init__(self, model, mode: str = "string", weight: float = SYNONYM_WEIGHT):
+        if mode not in EXPANSION_MODES:
+            raise ValueError(f"unknown expansion mode '{mode}' (expected one of {', '.join(EXPANSION_MODES)})")
+        self.model = model
+        self.mode = mode
+        self.weight = weight
+        self._phrase_vecs = None
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        if self.mode == "embedding" and self._phrase_vecs is None:
+            with self._lock:
+                if self._phrase_vecs is None:
+                    self._phrase_vecs = self.model.encode(PHRASES, normalize_embeddings=True).astype("float32")
+        return self
+
+    def embed(self, queries) -> np.ndarray:
+        if self.mode == "string":
+            return self.model.encode([expand_query(q) for q in queries], normalize_embeddings=True).astype("float32")
+        phrase_vecs = self.prepare()._phrase_vecs
+        embs = self.model.encode(list(queries), normalize_embeddings=True).astype("float32")
+        for i, q in enumerate(queries):
+            phrases = synonym_phrases(q)
+            if phrases:
+                centroid = phrase_vecs[phrases].mean(axis=0)
+                blended = (1 - self.weight) * embs[i] + self.weight * centroid / max(np.linalg.norm(centroid), 1e-12)
+                embs[i] = blended / max(np.linalg.norm(blended), 1e-12)
+        return embs
+
+
+# ----------------------------
+# String vs embedding expansion
+# ----------------------------
+# Queries that trigger expansion (every topic at least once, some several)
+COMPARE_QUERIES = [
+    "nlp", "intro to nlp", "machine learning", "ml for beginners", "ai", "ai and robotics",
+    "data visualization with tableau", "data viz", "stats", "statistics for biology",
+    "operations research", "optimization methods", "bioinformatics", "computational biology lab",
+    "security", "cybersecurity policy", "databases", "database design", "econ", "economics of health",
+    "psychology", "cognitive neuroscience", "ml and statistics", "nlp and ai", "databases and security",
+    "econ and stats", "visualization for psychology", "optimization for machine learning",
+]
+
+
+def _timed(qe: QueryEncoder, queries):
+    embs, lat = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        embs.append(qe.embed([q])[0])
+        lat.append(1e3 * (time.perf_counter() - t0))
+    return np.asarray(embs), np.asarray(lat)
+
+
+def compare(model, queries, index, store, weights=(SYNONYM_WEIGHT,), top_courses: int = 8) -> list:
+    """
+    Per expansion setting: single-query embed latency (p50/p99) and the mean overlap of its
+    top courses with the string-expansion results (the reference), plus the mean query
+    length the encoder sees in words. "none" (the bare query) is the floor to beat.
+    """
+    from retrieval import search_courses
+    settings = [("string", QueryEncoder(model, "string")), ("none", QueryEncoder(model, "embedding", 0.0))]
+    settings += [(f"embedding w={w:g}", QueryEncoder(model, "embedding", w).prepare()) for w in weights]
+    tops = [top_courses] * len(queries)
+    rows, reference = [], None
+    for name, qe in settings:
+        qe.embed(queries[:2])   # warm up
+        embs, lat = _timed(qe, queries)
+        got = [set(store.parent_idx[ids].tolist()) for ids, _, _ in search_courses(embs, tops, index, store)]
+        reference = reference or got
+        words = [len((expand_query(q) if qe.mode == "string" else q).split()) for q in queries]
+        rows.append({"expansion": name,
+                     "p50_ms": round(float(np.percentile(lat, 50)), 3),
+                     "p99_ms": round(float(np.percentile(lat, 99)), 3),
+                     "words": round(float(np.mean(words)), 1),
+                     "overlap": round(float(np.mean([len(a & b) / max(len(a), 1) for a, b in zip(reference, got)])), 4)})
+    return rows
+
+
+def main(index_dir: str, weights, queries_file: str = None, top_courses: int = 8, json_out: str = None):
+    import faiss
+    from ann import apply_search_params
+    from encoders import load_encoder
+    from metastore import MetaStore
+
+    index_dir = Path(index_dir).resolve()
+    cfg = json.loads((index_dir / "config.json").read_text())
+    index = apply_search_params(faiss.read_index(str(index_dir / "faiss.index")), cfg.get("index"))
+    store = MetaStore.load(index_dir)
+    model = load_encoder(cfg, index_dir)
+    if queries_file:
+        queries = [l.strip() for l in Path(queries_file).read_text().splitlines() if l.strip()]
+    else:
+        queries = COMPARE_QUERIES
+    rows = compare(model, queries, index, store, weights, top_courses)
+    print(f"[expand] {len(queries)} queries, top-{top_courses} course overlap with string expansion")
+    print(f"  {'expansion':<18} {'words':>6} {'p50 ms':>8} {'p99 ms':>8} {'overlap':>8}")
+    for r in rows:
+        print(f"  {r['expansion']:<18} {r['words']:>6.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['overlap']:>8.3f}")
+    if json_out:
+        Path(json_out).write_text(json.dumps(rows, indent=2))
+        print(f"[expand] wrote {json_out}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Compare string and embedding-space query expansion")
+    ap.add_argument("--index-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
+    ap.add_argument("--weights", type=float, nargs="+", default=[0.3, SYNONYM_WEIGHT, 0.7],
+                    help="synonym weights to try for embedding expansion")
+    ap.add_argument("--queries-file", default=None, help="one query per line (default: a built-in set)")
+    ap.add_argument("--top-courses", type=int, default=8)
+    ap.add_argument("--json", default=None, help="also write the results to this file")
+    args = ap.parse_args()
+    main(args.index_dir, args.weights, args.queries_file, args.top_courses, args.json)
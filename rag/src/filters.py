@@ -0,0 +1,235 @@
+# rag/src/filters.py
+"""
+Metadata pre-filtering with precomputed bitmaps.
+
+build_index.py writes <index_dir>/filters/ from the columnar meta/ store:
+  filters.json          row count + per-field kind and the value of each bitmap
+  <field>.npy           uint8 matrix, one packed row bitmap per distinct value
+
+Fields:
+  subject_code   category   "CS" or ["CS", "MATH"]
+  level          category   course level from the code number: 400 (CS 412) or [300, 400]
+  credits        range      3 (courses that can be taken for 3 credits) or {"min": 3, "max": 4}
+  has_prereqs    flag       true / false
+  has_coreqs     flag       true / false
+  eligible_with  prereqs    ["CS 141", "MATH 180"]: courses whose prerequisites are all in the
+                            list (the student's completed courses), minus the listed ones
+
+A filter object is compiled into one packed bitmap by OR-ing the bitmaps of the
+requested values and AND-ing across fields; nothing is evaluated per row. The
+result becomes a FAISS IDSelectorBitmap so the search only visits eligible rows.
+"eligible_with" is answered by the prerequisite graph (prereqs.py) instead of a
+stored bitmap, since it depends on the completed set.
+"""
+import json, re, threading
+from collections import OrderedDict
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from prereqs import EMPTY_PREREQ_VALUES, PrereqGraph
+
+FILTER_DIRNAME = "filters"
+FIELDS = ("subject_code", "level", "credits", "has_prereqs", "has_coreqs", "eligible_with")
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype="int64")
+_CODE_NUMBER = re.compile(r"(\d+)")
+
+
+def _pack(mask: np.ndarray) -> np.ndarray:
+    # FAISS's IDSelectorBitmap reads bit (i & 7) of byte (i >> 3)
+    return np.packbits(mask, bitorder="little")
+
+
+def _bitmaps(keys: np.ndarray, values) -> np.ndarray:
+    return np.vstack([_pack(keys == v) for v in values]) if len(values) else np.zeros((0, 0), "uint8")
+
+
+def _level(code: str) -> int:
+    m = _CODE_NUMBER.search(code)
+    return int(m.group(1)) // 100 * 100 if m else -1
+
+
+def build_fields(store) -> dict:
+    """field -> (kind, values, bitmap matrix) computed from a MetaStore, one pass per column."""
+    n = len(store)
+    fields = {}
+    subjects = np.array([store.get("metadata.subject_code", i).strip().upper() for i in range(n)], dtype=object)
+    values = sorted(set(subjects) - {""})
+    fields["subject_code"] = ("category", values, _bitmaps(subjects, values))
+
+    levels = np.array([_level(store.get("metadata.course_code", i)) for i in range(n)], dtype="int64")
+    values = sorted(set(levels.tolist()) - {-1})
+    fields["level"] = ("category", values, _bitmaps(levels, values))
+
+    # credits: two sorted value lists so a range query is an OR over a slice of bitmaps
+    for col in ("credits_min", "credits_max"):
+        name = f"metadata.{col}"
+        vals = np.asarray(store.numeric(name), dtype="float64") if store.has(name) else np.full(n, np.nan)
+        distinct = np.unique(vals[~np.isnan(vals)]).tolist()
+        fields[col] = ("range", distinct, _bitmaps(vals, distinct))
+
+    for field, col in (("has_prereqs", "metadata.prereq_codes"), ("has_coreqs", "metadata.coreq_codes")):
+        has = np.array([store.get(col, i).strip() not in EMPTY_PREREQ_VALUES for i in range(n)], dtype=bool)
+        fields[field] = ("flag", [False, True], np.vstack([_pack(~has), _pack(has)]))
+    return fields
+
+
+def write_filter_index(store, out_dir: Path):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    info = {"rows": len(store), "fields": {}}
+    for field, (kind, values, bits) in build_fields(store).items():
+        np.save(out_dir / f"{field}.npy", bits)
+        info["fields"][field] = {"kind": kind, "values": values}
+    (out_dir / "filters.json").write_text(json.dumps(info, indent=2))
+
+
+class Selection:
+    """A compiled filter: packed row bitmap plus the number of eligible rows."""
+
+    def __init__(self, bits: np.ndarray, n_rows: int, key: str):
+        self.bits = np.ascontiguousarray(bits, dtype="uint8")
+        self.n_rows = n_rows
+        self.key = key
+        self.count = int(_POPCOUNT[self.bits].sum())
+        self._parents = None
+
+    def rows(self) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.n_rows, bitorder="little"))
+
+    def parent_selection(self, parent_idx: np.ndarray) -> "Selection":
+        """The same filter over course-level ids (rows of the course index)."""
+        if self._parents is None:
+            n_parents = int(parent_idx.max()) + 1 if len(parent_idx) else 0
+            mask = np.zeros(n_parents, dtype=bool)
+            mask[parent_idx[self.rows()]] = True
+            self._parents = Selection(_pack(mask), n_parents, self.key)
+        return self._parents
+
+    def search_params(self, index):
+        """
+        SearchParameters of the right type for `index`, restricted to the selected ids.
+        ANN indexes only look at a fraction of the ids, so the fewer are eligible the
+        more of the index has to be visited: nprobe/efSearch grow by 1/selectivity.
+        """
+        sel = faiss.IDSelectorBitmap(self.n_rows, faiss.swig_ptr(self.bits))
+        boost = int(np.ceil(index.ntotal / max(self.count, 1)))
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=min(ivf.nlist, ivf.nprobe * boost))
+        elif hasattr(index, "hnsw"):
+            params = faiss.SearchParametersHNSW(sel=sel, efSearch=min(index.ntotal, index.hnsw.efSearch * boost))
+        else:
+            params = faiss.SearchParameters(sel=sel)
+        params.bits_ref = self.bits   # the selector points into this buffer
+        return params
+
+
+class FilterIndex:
+    def __init__(self, n_rows: int, fields: dict, cache_size: int = 256, prereqs: PrereqGraph = None):
+        self.n_rows = n_rows
+        self.fields = fields          # field -> (kind, values, bitmap matrix)
+        self.prereqs = prereqs        # for "eligible_with"
+        self._compiled = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()   # compile() runs on the app's and daemon's request threads
+
+    @classmethod
+    def open(cls, filter_dir: Path) -> "FilterIndex":
+        filter_dir = Path(filter_dir)
+        info = json.loads((filter_dir / "filters.json").read_text())
+        fields = {
+            field: (spec["kind"], spec["values"], np.load(filter_dir / f"{field}.npy", mmap_mode="r"))
+            for field, spec in info["fields"].items()
+        }
+        return cls(int(info["rows"]), fields)
+
+    @classmethod
+    def load(cls, index_dir: Path, store) -> "FilterIndex":
+        """
+        Open <index_dir>/filters and the prerequisite graph, or build them in memory
+        for indexes built without them.
+        """
+        filter_dir = Path(index_dir) / FILTER_DIRNAME
+        if (filter_dir / "filters.json").exists():
+            fi = cls.open(filter_dir)
+        else:
+            print(f"[filters] {filter_dir} not found; building filter bitmaps in memory (rebuild the index to persist them)")
+            fi = cls(len(store), build_fields(store))
+        fi.prereqs = PrereqGraph.load(index_dir, store)
+        return fi
+
+    # ----------------------------
+    # Compiling filter objects
+    # ----------------------------
+    def _any_of(self, field: str, wanted) -> np.ndarray:
+        _, values, bits = self.fields[field]
+        pos = [i for i, v in enumerate(values) if v in wanted]
+        if not pos:
+            return np.zeros((self.n_rows + 7) // 8, dtype="uint8")
+        return np.bitwise_or.reduce(bits[pos], axis=0)
+
+    def _range(self, field: str, lo=None, hi=None) -> np.ndarray:
+        _, values, _ = self.fields[field]
+        return self._any_of(field, {v for v in values if (lo is None or v >= lo) and (hi is None or v <= hi)})
+
+    def _field_bits(self, field: str, value) -> np.ndarray:
+        if field == "subject_code":
+            wanted = value if isinstance(value, list) else [value]
+            return self._any_of(field, {str(v).strip().upper() for v in wanted})
+        if field == "level":
+            wanted = value if isinstance(value, list) else [value]
+            try:
+                return self._any_of(field, {int(v) // 100 * 100 for v in wanted})
+            except (TypeError, ValueError):
+                raise ValueError("filter 'level' must be a number or a list of numbers, e.g. 400")
+        if field == "credits":
+            if isinstance(value, dict):
+                lo, hi = value.get("min"), value.get("max")
+            else:
+                lo = hi = value
+            try:
+                lo = None if lo is None else float(lo)
+                hi = None if hi is None else float(hi)
+            except (TypeError, ValueError):
+                raise ValueError("filter 'credits' must be a number or {\"min\": .., \"max\": ..}")
+            # a course with credits_min..credits_max overlaps the requested [lo, hi]
+            return self._range("credits_max", lo=lo) & self._range("credits_min", hi=hi)
+        if field in ("has_prereqs", "has_coreqs"):
+            if not isinstance(value, bool):
+                raise ValueError(f"filter '{field}' must be true or false")
+            return self._any_of(field, {value})
+        if field == "eligible_with":
+            if not isinstance(value, list) or not all(isinstance(c, str) for c in value):
+                raise ValueError("filter 'eligible_with' must be a list of course codes, e.g. [\"CS 141\"]")
+            if self.prereqs is None:
+                raise ValueError("filter 'eligible_with' needs the prerequisite graph")
+            completed, _ = self.prereqs.resolve(value)
+            return _pack(self.prereqs.row_mask(completed))
+        raise ValueError(f"unknown filter '{field}' (expected any of {', '.join(FIELDS)})")
+
+    def compile(self, filters) -> "Selection":
+        """Selection for a filter object; None when there is nothing to filter."""
+        if not filters:
+            return None
+        if not isinstance(filters, dict):
+            raise ValueError("'filters' must be an object")
+        key = json.dumps(filters, sort_keys=True)
+        with self._lock:
+            sel = self._compiled.get(key)
+            if sel is not None:
+                self._compiled.move_to_end(key)
+                return sel
+        # build outside the lock; two threads compiling the same filter get equal selections
+        bits = None
+        for field, value in filters.items():
+            b = self._field_bits(field, value)
+            bits = b if bits is None else bits & b
+        sel = Selection(bits, self.n_rows, key)
+        with self._lock:
+            self._compiled[key] = sel
+            self._compiled.move_to_end(key)
+            while len(self._compiled) > self._cache_size:
+                self._compiled.popitem(last=False)
+        return sel
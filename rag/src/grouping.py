@@ -0,0 +1,47 @@
+# rag/src/grouping.py
+"""
+Course grouping on integer parent ids.
+
+FAISS returns hits already sorted by score, so "best chunk per course" is just
+the first occurrence of each parent id along a row. These helpers compute that
+with NumPy instead of sort_values/drop_duplicates on string ids.
+"""
+import numpy as np
+
+
+def first_occurrence_mask(parents: np.ndarray) -> np.ndarray:
+    """
+    Boolean mask, same shape as `parents` (1-D or 2-D, one row per query), that is
+    True at the first occurrence of each value along the last axis. Negative
+    values (missing hits) are never marked.
+    """
+    parents = np.asarray(parents)
+    if parents.size == 0:   # no hits: nothing to reshape along the last axis
+        return np.zeros(parents.shape, dtype=bool)
+    p2 = parents.reshape(-1, parents.shape[-1]) if parents.ndim else parents.reshape(1, 1)
+    order = np.argsort(p2, axis=1, kind="stable")
+    sorted_p = np.take_along_axis(p2, order, axis=1)
+    first_sorted = np.ones_like(sorted_p, dtype=bool)
+    first_sorted[:, 1:] = sorted_p[:, 1:] != sorted_p[:, :-1]
+    mask = np.zeros_like(first_sorted)
+    np.put_along_axis(mask, order, first_sorted, axis=1)
+    mask &= p2 >= 0
+    return mask.reshape(parents.shape)
+
+
+def group_rows(idxs: np.ndarray, parent_idx: np.ndarray, top_n: int):
+    """
+    Group score-ordered FAISS ids into courses.
+
+    `idxs` is 1-D (one query) or 2-D (a batch, as returned by index.search).
+    Returns, per query, the positions into that row of the best hit of each of
+    the first `top_n` distinct parents; a list of arrays for 2-D input.
+    """
+    idxs = np.asarray(idxs)
+    single = idxs.ndim == 1
+    idx2 = idxs.reshape(1, -1) if single else idxs
+    parents = np.where(idx2 >= 0, parent_idx[np.clip(idx2, 0, None)], -1)
+    keep = first_occurrence_mask(parents)
+    keep &= np.cumsum(keep, axis=1) <= top_n
+    out = [np.flatnonzero(row) for row in keep]
+    return out[0] if single else out
@@ -0,0 +1,184 @@
+# rag/src/lexical.py
+"""
+Lexical retrieval next to the vector index: a course-code hash index and BM25.
+
+build_index.py writes <index_dir>/lexical/:
+  codes.json                normalized course code ("CS 412") -> first chunk row
+  bm25.json                 BM25 parameters, row count and the vocabulary (term i = list position)
+  postings.offsets.npy      int64, term i's postings are [offsets[i], offsets[i + 1])
+  postings.rows.npy         int32 chunk row of each posting
+  postings.weights.npy      float32 precomputed BM25 term weight (idf * saturated tf)
+
+With the weights precomputed, scoring a query is one bincount over the postings of
+its terms. `LexicalIndex.code_match` answers queries that are only course codes
+(plus a few words like "prerequisites"); everything else is fused with the vector
+results by reciprocal rank fusion (`rrf_fuse`).
+"""
+import json, re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from grouping import group_rows
+
+LEXICAL_DIRNAME = "lexical"
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60          # rank offset in 1 / (RRF_K + rank)
+FUSE_DEPTH = 3      # candidates per requested course taken from each ranked list
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_CODE = re.compile(r"\b([A-Za-z]{2,5})\s*-?\s*(\d{3}[A-Za-z]?)\b")
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+             "of", "on", "or", "that", "the", "to", "with"}
+# Words that can accompany a course code without turning it into a topical search
+CODE_QUERY_WORDS = STOPWORDS | {
+    "about", "class", "classes", "course", "courses", "coreq", "coreqs", "corequisite",
+    "corequisites", "credit", "credits", "describe", "description", "details", "info",
+    "information", "me", "prereq", "prereqs", "prerequisite", "prerequisites", "show",
+    "tell", "what", "whats", "requirements", "requires",
+}
+
+
+def tokenize(text: str):
+    return [t for t in _TOKEN.findall(str(text).lower()) if t not in STOPWORDS]
+
+
+def normalize_code(code: str) -> str:
+    """'cs412', 'CS-412' and ' cs 412 ' all become 'CS 412'."""
+    m = _CODE.search(str(code))
+    return f"{m.group(1).upper()} {m.group(2).upper()}" if m else str(code).strip().upper()
+
+
+def build_lexical(store) -> tuple:
+    """(codes, params, offsets, rows, weights) for a MetaStore; one pass over the text column."""
+    n = len(store)
+    codes = {}
+    for i in range(n):
+        code = store.get("metadata.course_code", i)
+        if code:
+            codes.setdefault(normalize_code(code), i)
+
+    vocab, postings, lengths = {}, [], np.zeros(n, dtype="float32")
+    for i in range(n):
+        tokens = tokenize(store.get("text", i))
+        lengths[i] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            postings.append((vocab.setdefault(term, len(vocab)), i, tf))
+    avgdl = float(lengths.mean()) if n else 0.0
+    post = np.array(postings, dtype="int64").reshape(-1, 3)
+    order = np.lexsort((post[:, 1], post[:, 0]))  # by term, then row
+    terms, rows, tf = post[order, 0], post[order, 1], post[order, 2].astype("float32")
+    df = np.bincount(terms, minlength=len(vocab)).astype("float32")
+    idf = np.log1p((n - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / max(avgdl, 1e-9))
+    weights = (idf[terms] * tf * (BM25_K1 + 1) / (tf + norm)).astype("float32")
+    offsets = np.zeros(len(vocab) + 1, dtype="int64")
+    np.cumsum(df.astype("int64"), out=offsets[1:])
+    params = {"k1": BM25_K1, "b": BM25_B, "rows": n, "avgdl": avgdl,
+              "vocab": sorted(vocab, key=vocab.get)}
+    return codes, params, offsets, rows.astype("int32"), weights
+
+
+def write_lexical_index(store, out_dir: Path):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    codes, params, offsets, rows, weights = build_lexical(store)
+    (out_dir / "codes.json").write_text(json.dumps(codes))
+    (out_dir / "bm25.json").write_text(json.dumps(params))
+    np.save(out_dir / "postings.offsets.npy", offsets)
+    np.save(out_dir / "postings.rows.npy", rows)
+    np.save(out_dir / "postings.weights.npy", weights)
+
+
+class LexicalIndex:
+    def __init__(self, codes: dict, params: dict, offsets, rows, weights):
+        self.codes = codes
+        self.n_rows = int(params["rows"])
+        self.vocab = {t: i for i, t in enumerate(params["vocab"])}
+        self._offsets, self._rows, self._weights = offsets, rows, weights
+
+    @classmethod
+    def open(cls, lex_dir: Path) -> "LexicalIndex":
+        lex_dir = Path(lex_dir)
+        return cls(
+            json.loads((lex_dir / "codes.json").read_text()),
+            json.loads((lex_dir / "bm25.json").read_text()),
+            np.load(lex_dir / "postings.offsets.npy", mmap_mode="r"),
+            np.load(lex_dir / "postings.rows.npy", mmap_mode="r"),
+            np.load(lex_dir / "postings.weights.npy", mmap_mode="r"),
+        )
+
+    @classmethod
+    def load(cls, index_dir: Path, store) -> "LexicalIndex":
+        """Open <index_dir>/lexical, or build it in memory for indexes built without it."""
+        lex_dir = Path(index_dir) / LEXICAL_DIRNAME
+        if (lex_dir / "bm25.json").exists():
+            return cls.open(lex_dir)
+        print(f"[lexical] {lex_dir} not found; building code/BM25 index in memory (rebuild the index to persist it)")
+        return cls(*build_lexical(store))
+
+    def code_match(self, query: str):
+        """
+        Rows of the courses named in `query` when it is only course codes (plus words like
+        "prerequisites"); None when it is a topical question for the full search.
+        """
+        found = [normalize_code(m.group(0)) for m in _CODE.finditer(query)]
+        rows = [self.codes[c] for c in dict.fromkeys(found) if c in self.codes]
+        if not rows:
+            return None
+        rest = _CODE.sub(" ", query)
+        if any(t not in CODE_QUERY_WORDS for t in _TOKEN.findall(rest.lower())):
+            return None
+        return rows
+
+    def search(self, query: str, top_n: int, parent_idx: np.ndarray, selection=None):
+        """BM25 over chunk text, best chunk per course: (row_ids, scores) in score order."""
+        terms = [self.vocab[t] for t in dict.fromkeys(tokenize(query)) if t in self.vocab]
+        if not terms:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+        rows = np.concatenate([self._rows[self._offsets[t]:self._offsets[t + 1]] for t in terms])
+        weights = np.concatenate([self._weights[self._offsets[t]:self._offsets[t + 1]] for t in terms])
+        scores = np.bincount(rows, weights=weights, minlength=self.n_rows)
+        cand = np.flatnonzero(scores > 0)
+        if selection is not None:
+            mask = np.unpackbits(selection.bits, count=self.n_rows, bitorder="little").astype(bool)
+            cand = cand[mask[cand]]
+        if cand.size == 0:   # the filter removed every row containing a query term
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+        order = cand[np.argsort(-scores[cand], kind="stable")]
+        pos = group_rows(order, parent_idx, top_n)
+        return order[pos].astype("int64"), scores[order[pos]].astype("float32")
+
+
+def rrf_fuse(ranked_lists, parent_idx: np.ndarray, top_n: int, k: int = RRF_K):
+    """
+    Reciprocal rank fusion of per-course ranked row lists (each already one row per
+    course). Returns (row_ids, scores) for the top `top_n` courses; the score is the
+    fused RRF score divided by its maximum (rank 1 in every list), so it stays in [0, 1].
+    """
+    fused, rep = {}, {}
+    for rows in ranked_lists:
+        for rank, row in enumerate(rows.tolist(), start=1):
+            p = int(parent_idx[row])
+            fused[p] = fused.get(p, 0.0) + 1.0 / (k + rank)
+            rep.setdefault(p, row)   # the first list (vector) picks the row shown
+    best = sorted(fused, key=fused.get, reverse=True)[:top_n]
+    top = len(ranked_lists) / (k + 1)
+    return (np.array([rep[p] for p in best], dtype="int64"),
+            np.array([fused[p] / top for p in best], dtype="float32"))
+
+
+class SavingsMeter:
+    """Running mean of what the encoder + search path costs per query, to report fast-path savings."""
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.mean_ms = None
+
+    def observe(self, ms: float):
+        self.mean_ms = ms if self.mean_ms is None else (1 - self.alpha) * self.mean_ms + self.alpha * ms
+
+    def saved(self, elapsed_ms: float):
+        return None if self.mean_ms is None else round(max(self.mean_ms - elapsed_ms, 0.0), 3)
@@ -0,0 +1,305 @@
+# rag/src/metastore.py
+"""
+Columnar, memory-mapped chunk metadata (the serve-time replacement for chunks.csv).
+
+Layout of <index_dir>/meta/:
+  meta.json                 row count + column names/kinds
+  <col>.offsets.npy         int64 offsets (rows + 1) into <col>.data.bin
+  <col>.data.bin            UTF-8 bytes of every value, back to back
+  <col>.npy                 numeric columns (credits, chunk index/count)
+  parent_idx.npy            dense int32 course id per row (from metadata.parent_id)
+
+Row i of every column lines up with FAISS row id i. Lookups slice the mapped
+buffers directly, so nothing is parsed or copied until a field is read.
+
+The writer never reopens a published file: everything is written under a temp name
+and os.replace()d into place, meta.json last. Processes that have the old store
+mapped keep reading the old inodes while a rebuild runs in the same directory.
+"""
+import argparse, csv, json, os
+from pathlib import Path
+
+import numpy as np
+
+META_DIRNAME = "meta"
+NUMERIC_COLUMNS = {
+    "metadata.credits_min": "float32",
+    "metadata.credits_max": "float32",
+    "metadata.chunk_index": "int32",
+    "metadata.chunk_count": "int32",
+}
+PARENT_IDX = "parent_idx"
+
+
+def _int_fill(dtype: str):
+    return -1 if dtype.startswith("int") else np.nan
+
+
+def _encode_strings(values):
+    """Offset-encode a list of strings: (int64 offsets of len n+1, concatenated UTF-8 bytes)."""
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype="int64")
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, b"".join(encoded)
+
+
+def _parent_codes(strings: dict) -> np.ndarray:
+    """Dense int32 id per row, numbering parents (courses) in first-seen order."""
+    col = "metadata.parent_id" if "metadata.parent_id" in strings else "id"
+    codes = {}
+    return np.array([codes.setdefault(p, len(codes)) for p in strings.get(col, [])], dtype="int32")
+
+
+def _tmp_name(path: Path) -> Path:
+    """Per-process scratch name next to `path`, so concurrent writers don't share one."""
+    return path.with_name(f"{path.name}.tmp-{os.getpid()}")
+
+
+def _raw_to_npy(tmp_path: Path, final_path: Path, dtype: str, count: int, block: int = 1 << 20):
+    """Turn a raw append-only tmp file into a .npy file (copying in bounded blocks) and publish it."""
+    out_path = _tmp_name(final_path)
+    dst = np.lib.format.open_memmap(out_path, mode="w+", dtype=dtype, shape=(count,))
+    if count:
+        src = np.memmap(tmp_path, dtype=dtype, mode="r", shape=(count,))
+        for start in range(0, count, block):
+            dst[start:start + block] = src[start:start + block]
+        del src
+    dst.flush()
+    del dst
+    tmp_path.unlink()
+    os.replace(out_path, final_path)
+
+
+class MetaStoreWriter:
+    """
+    Append-only writer for the columnar store, so a build can stream rows in
+    bounded blocks. Offsets and numeric columns are appended to raw tmp files
+    and turned into .npy files on close(), when every file is renamed into place.
+    """
+
+    def __init__(self, out_dir: Path):
+        self.dir = Path(out_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.n_rows = 0
+        self._strings = None    # col -> [data file, offsets tmp file, bytes written]
+        self._numerics = None   # col -> (tmp file, dtype)
+        self._parent_col = None
+        self._parent_file = None
+        self._codes = {}
+
+    def _open(self, strings: dict, numerics: dict):
+        self._strings = {}
+        for col in strings:
+            off_f = open(_tmp_name(self.dir / f"{col}.offsets"), "wb")
+            np.zeros(1, dtype="int64").tofile(off_f)
+            self._strings[col] = [open(_tmp_name(self.dir / f"{col}.data.bin"), "wb"), off_f, 0]
+        self._numerics = {col: (open(_tmp_name(self.dir / col), "wb"), NUMERIC_COLUMNS.get(col, str(np.asarray(arr).dtype)))
+                          for col, arr in numerics.items()}
+        self._parent_col = "metadata.parent_id" if "metadata.parent_id" in strings else "id"
+        self._parent_file = open(_tmp_name(self.dir / PARENT_IDX), "wb")
+
+    def append_columns(self, n_rows: int, strings: dict, numerics: dict) -> np.ndarray:
+        """Append a block of rows; returns the block's dense parent ids."""
+        if self._strings is None:
+            self._open(strings, numerics)
+        for col, values in strings.items():
+            data_f, off_f, end = self._strings[col]
+            offsets, blob = _encode_strings(values)
+            data_f.write(blob)
+            (offsets[1:] + end).tofile(off_f)
+            self._strings[col][2] = end + len(blob)
+        for col, arr in numerics.items():
+            f, dtype = self._numerics[col]
+            np.asarray(arr, dtype=dtype).tofile(f)
+        codes = np.array([self._codes.setdefault(p, len(self._codes))
+                          for p in strings.get(self._parent_col, [])], dtype="int32")
+        codes.tofile(self._parent_file)
+        self.n_rows += n_rows
+        return codes
+
+    def append_df(self, df) -> np.ndarray:
+        """Append a pandas DataFrame block (build time only)."""
+        strings, numerics = {}, {}
+        for col in df.columns:
+            if col in NUMERIC_COLUMNS:
+                dtype = NUMERIC_COLUMNS[col]
+                vals = df[col].astype("float64").fillna(_int_fill(dtype)).to_numpy()
+                numerics[col] = vals.astype(dtype)
+            else:
+                strings[col] = [("" if v != v or v is None else str(v)) for v in df[col].tolist()]
+        return self.append_columns(len(df), strings, numerics)
+
+    @property
+    def n_parents(self) -> int:
+        return len(self._codes)
+
+    def close(self):
+        if self._strings is None:
+            self._open({}, {})
+        for col, (data_f, off_f, _) in self._strings.items():
+            data_f.close()
+            off_f.close()
+            os.replace(data_f.name, self.dir / f"{col}.data.bin")
+            _raw_to_npy(Path(off_f.name), self.dir / f"{col}.offsets.npy", "int64", self.n_rows + 1)
+        numeric_info = {}
+        for col, (f, dtype) in self._numerics.items():
+            f.close()
+            _raw_to_npy(Path(f.name), self.dir / f"{col}.npy", dtype, self.n_rows)
+            numeric_info[col] = dtype
+        self._parent_file.close()
+        _raw_to_npy(Path(self._parent_file.name), self.dir / f"{PARENT_IDX}.npy", "int32", self.n_rows)
+        numeric_info[PARENT_IDX] = "int32"
+        meta_json = _tmp_name(self.dir / "meta.json")
+        meta_json.write_text(json.dumps({
+            "rows": self.n_rows,
+            "strings": list(self._strings),
+            "numeric": numeric_info,
+        }, indent=2))
+        os.replace(meta_json, self.dir / "meta.json")
+
+
+def write_metastore(df, out_dir: Path):
+    """Write a pandas DataFrame (build time only) as a columnar store."""
+    writer = MetaStoreWriter(out_dir)
+    writer.append_df(df)
+    writer.close()
+
+
+def _iter_csv_blocks(csv_path: Path, block_rows: int = None):
+    """Yield (n_rows, strings, numerics) blocks parsed with the csv module (no pandas)."""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        while True:
+            cols = [[] for _ in header]
+            n = 0
+            for rec in reader:
+                for j, v in enumerate(rec):
+                    cols[j].append(v)
+                n += 1
+                if block_rows and n >= block_rows:
+                    break
+            if n == 0 and block_rows:
+                return
+            strings, numerics = {}, {}
+            for col, values in zip(header, cols):
+                if col in NUMERIC_COLUMNS:
+                    dtype = NUMERIC_COLUMNS[col]
+                    fill = _int_fill(dtype)
+                    numerics[col] = np.array([float(v) if v != "" else fill for v in values]).astype(dtype)
+                else:
+                    strings[col] = values
+            yield n, strings, numerics
+            if not block_rows:
+                return
+
+
+def _read_csv_columns(csv_path: Path):
+    return next(_iter_csv_blocks(csv_path))
+
+
+def convert_csv(csv_path: Path, out_dir: Path, block_rows: int = 50_000):
+    """Convert an existing chunks.csv export into a columnar store without pandas."""
+    writer = MetaStoreWriter(out_dir)
+    for block in _iter_csv_blocks(Path(csv_path), block_rows):
+        writer.append_columns(*block)
+    writer.close()
+
+
+class MetaStore:
+    """Read-only view over the columnar store; row ids are FAISS ids."""
+
+    def __init__(self, n_rows: int, strings: dict, numerics: dict):
+        self.n_rows = n_rows
+        self._strings = strings     # col -> (offsets, data buffer)
+        self._numerics = numerics   # col -> ndarray
+        self._parent_rows = None
+
+    @classmethod
+    def open(cls, meta_dir: Path) -> "MetaStore":
+        meta_dir = Path(meta_dir)
+        info = json.loads((meta_dir / "meta.json").read_text())
+        strings = {}
+        for col in info["strings"]:
+            offsets = np.load(meta_dir / f"{col}.offsets.npy", mmap_mode="r")
+            data_path = meta_dir / f"{col}.data.bin"
+            data = np.memmap(data_path, dtype="uint8", mode="r") if data_path.stat().st_size else np.zeros(0, "uint8")
+            strings[col] = (offsets, data)
+        numerics = {col: np.load(meta_dir / f"{col}.npy", mmap_mode="r") for col in info["numeric"]}
+        return cls(int(info["rows"]), strings, numerics)
+
+    @classmethod
+    def from_columns(cls, n_rows: int, str_cols: dict, numerics: dict) -> "MetaStore":
+        """In-memory store from plain Python string lists and numeric arrays."""
+        strings = {}
+        for col, values in str_cols.items():
+            offsets, blob = _encode_strings(values)
+            strings[col] = (offsets, np.frombuffer(blob, dtype="uint8"))
+        return cls(n_rows, strings, {**numerics, PARENT_IDX: _parent_codes(str_cols)})
+
+    @classmethod
+    def from_csv(cls, csv_path: Path) -> "MetaStore":
+        """In-memory store built straight from chunks.csv (fallback when meta/ is missing)."""
+        return cls.from_columns(*_read_csv_columns(Path(csv_path)))
+
+    @classmethod
+    def load(cls, index_dir: Path) -> "MetaStore":
+        """Open <index_dir>/meta, falling back to parsing <index_dir>/chunks.csv."""
+        index_dir = Path(index_dir)
+        meta_dir = index_dir / META_DIRNAME
+        if (meta_dir / "meta.json").exists():
+            return cls.open(meta_dir)
+        print(f"[meta] {meta_dir} not found; reading {index_dir / 'chunks.csv'} (run metastore.py to convert)")
+        return cls.from_csv(index_dir / "chunks.csv")
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def columns(self):
+        return list(self._strings) + list(self._numerics)
+
+    def has(self, col: str) -> bool:
+        return col in self._strings or col in self._numerics
+
+    def numeric(self, col: str):
+        """Whole numeric column as an array view."""
+        return self._numerics[col]
+
+    @property
+    def parent_idx(self) -> np.ndarray:
+        """Dense int32 course id per FAISS row (computed once for stores written without it)."""
+        if PARENT_IDX not in self._numerics:
+            col = "metadata.parent_id" if "metadata.parent_id" in self._strings else "id"
+            values = [self.get(col, i) for i in range(self.n_rows)]
+            self._numerics[PARENT_IDX] = _parent_codes({col: values})
+        return self._numerics[PARENT_IDX]
+
+    @property
+    def parent_rows(self) -> np.ndarray:
+        """First chunk row of every parent, indexed by parent id (rows of the course-level index)."""
+        if self._parent_rows is None:
+            _, first = np.unique(self.parent_idx, return_index=True)
+            self._parent_rows = first.astype("int64")
+        return self._parent_rows
+
+    def get(self, col: str, i: int, default=""):
+        """Single field for row i; missing columns give `default`."""
+        if col in self._strings:
+            offsets, data = self._strings[col]
+            return data[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+        if col in self._numerics:
+            return self._numerics[col][i].item()
+        return default
+
+    def row(self, i: int, cols=None) -> dict:
+        return {col: self.get(col, i) for col in (cols or self.columns)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Convert an index's chunks.csv into the columnar meta/ store")
+    ap.add_argument("--index-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
+    args = ap.parse_args()
+    index_dir = Path(args.index_dir).resolve()
+    convert_csv(index_dir / "chunks.csv", index_dir / META_DIRNAME)
+    print(f"[meta] wrote {index_dir / META_DIRNAME}")
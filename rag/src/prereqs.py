@@ -0,0 +1,365 @@
+# rag/src/prereqs.py
+"""
+Prerequisite graph over course codes, answered with bitsets.
+
+build_index.py writes <index_dir>/prereqs/ from the columnar meta/ store:
+  graph.json      node codes (catalog courses first, then prerequisite codes that are not
+                  in the catalog), direct prerequisite / corequisite lists and any cycles
+  rows.npy        int32 graph node of every chunk row
+  gated.npy       int32 nodes with at least one prerequisite (row r of the matrices below)
+  direct.npy      uint64 (len(gated), words) bitset of each gated node's direct prerequisites
+  closure.npy     uint64 (len(gated), words) bitset of all its transitive prerequisites
+  depth.npy       int32 longest prerequisite chain below every node (0 = no prerequisites)
+
+An edge "A before B" comes from B's metadata.prereq_codes; all of them are required, as
+in the plan generator. Corequisites don't block a course (they can be taken in the same
+term) and are only reported. Cycles among prerequisites are found at build time and
+listed in graph.json; the closure treats each cycle as one unit.
+
+A set of completed courses becomes one bitset, so "which courses are eligible" is an
+AND-NOT over the gated rows. The courses still missing for a target are its closure
+when none of it is completed; otherwise the walk back from the target ORs the direct
+prerequisite rows of the courses not yet taken and stops at completed ones, whose own
+prerequisites no longer matter.
+
+`python prereqs.py --check` compares that against a plain graph walk for every course,
+with each of its prerequisites in turn marked completed.
+"""
+import argparse, ast, json
+from pathlib import Path
+
+import numpy as np
+
+from lexical import normalize_code
+
+PREREQ_DIRNAME = "prereqs"
+EMPTY_PREREQ_VALUES = {"", "[]", "nan", "None"}   # how the export writes "no codes"
+
+
+def _codes(value: str) -> list:
+    value = value.strip()
+    if value in EMPTY_PREREQ_VALUES:
+        return []
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        parsed = value.strip("[]").split(",")
+    if isinstance(parsed, str):
+        parsed = [parsed]
+    return list(dict.fromkeys(normalize_code(c) for c in parsed if str(c).strip()))
+
+
+def _words(n: int) -> int:
+    return max(1, (n + 63) // 64)
+
+
+def _to_words(bits: int, n_words: int) -> np.ndarray:
+    return np.frombuffer(bits.to_bytes(8 * n_words, "little"), dtype="<u8")
+
+
+def _sccs(adj: list) -> list:
+    """Strongly connected components (iterative Tarjan); every component comes after the ones it points to."""
+    n = len(adj)
+    index, low = [-1] * n, [0] * n
+    on_stack, stack, out = [False] * n, [], []
+    counter = 0
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, i = work.pop()
+            if i == 0:
+                index[v] = low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = True
+            if i < len(adj[v]):
+                work.append((v, i + 1))
+                w = adj[v][i]
+                if index[w] == -1:
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+                continue
+            if low[v] == index[v]:
+                comp = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    comp.append(w)
+                    if w == v:
+                        break
+                out.append(comp)
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[v])
+    return out
+
+
+def build_graph(store) -> tuple:
+    """(info, rows, gated, direct, closure, depth) for a MetaStore; see the module docstring."""
+    n_rows = len(store)
+    parent_rows = store.parent_rows
+    codes, node_of = [], {}
+    for r in parent_rows.tolist():
+        code = normalize_code(store.get("metadata.course_code", r))
+        if code and code not in node_of:
+            node_of[code] = len(codes)
+            codes.append(code)
+    n_catalog = len(codes)
+
+    def node(code):
+        if code not in node_of:
+            node_of[code] = len(codes)
+            codes.append(code)
+        return node_of[code]
+
+    prereqs, coreqs = {}, {}
+    for r in parent_rows.tolist():
+        v = node_of.get(normalize_code(store.get("metadata.course_code", r)))
+        if v is None:
+            continue
+        pre = [node(c) for c in _codes(store.get("metadata.prereq_codes", r))]
+        co = [node(c) for c in _codes(store.get("metadata.coreq_codes", r))]
+        if pre:
+            prereqs[v] = sorted(set(prereqs.get(v, [])) | set(pre))
+        # a corequisite that is also a prerequisite is just a prerequisite
+        co = sorted(set(co) - set(prereqs.get(v, [])) - {v})
+        if co:
+            coreqs[v] = co
+    n = len(codes)
+    adj = [prereqs.get(v, []) for v in range(n)]
+
+    # Closure and depth per strongly connected component, prerequisites first
+    closure, depth, cycles = [0] * n, [0] * n, []
+    for comp in _sccs(adj):
+        members = set(comp)
+        cyclic = len(comp) > 1 or comp[0] in adj[comp[0]]
+        bits, d = 0, 0
+        for v in comp:
+            for u in adj[v]:
+                if u not in members:
+                    bits |= closure[u] | (1 << u)
+                    d = max(d, depth[u] + 1)
+        if cyclic:
+            cycles.append(sorted(codes[v] for v in comp))
+            for v in comp:
+                bits |= 1 << v
+        for v in comp:
+            closure[v], depth[v] = bits, d
+
+    n_words = _words(n)
+    gated = np.array(sorted(prereqs), dtype="int32")
+    direct_m = np.zeros((len(gated), n_words), dtype="<u8")
+    closure_m = np.zeros((len(gated), n_words), dtype="<u8")
+    for i, v in enumerate(gated.tolist()):
+        direct_m[i] = _to_words(sum(1 << u for u in prereqs[v]), n_words)
+        closure_m[i] = _to_words(closure[v], n_words)
+
+    row_node = np.full(n_rows, -1, dtype="int32")
+    for r in range(n_rows):
+        row_node[r] = node_of.get(normalize_code(store.get("metadata.course_code", r)), -1)
+
+    info = {
+        "codes": codes, "catalog": n_catalog, "cycles": sorted(cycles),
+        "prereqs": {str(v): p for v, p in sorted(prereqs.items())},
+        "coreqs": {str(v): c for v, c in sorted(coreqs.items())},
+    }
+    return info, row_node, gated, direct_m, closure_m, np.asarray(depth, dtype="int32")
+
+
+def write_prereq_index(store, out_dir: Path):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    info, rows, gated, direct, closure, depth = build_graph(store)
+    (out_dir / "graph.json").write_text(json.dumps(info))
+    for name, arr in (("rows", rows), ("gated", gated), ("direct", direct), ("closure", closure), ("depth", depth)):
+        np.save(out_dir / f"{name}.npy", arr)
+    n_edges = sum(len(p) for p in info["prereqs"].values())
+    print(f"[build] prereq graph: {len(gated):,} courses with prerequisites, {n_edges:,} edges, "
+          f"{len(info['codes']) - info['catalog']:,} codes outside the catalog, {len(info['cycles'])} cycle(s)")
+    for cycle in info["cycles"]:
+        print(f"[build]   prerequisite cycle: {' -> '.join(cycle)}")
+
+
+class PrereqGraph:
+    def __init__(self, info: dict, rows, gated, direct, closure, depth):
+        self.codes = info["codes"]
+        self.n_catalog = int(info["catalog"])
+        self.cycles = info["cycles"]
+        self.node_of = {c: i for i, c in enumerate(self.codes)}
+        self.prereqs = {int(v): p for v, p in info["prereqs"].items()}
+        self.coreqs = {int(v): c for v, c in info["coreqs"].items()}
+        self.row_node = np.asarray(rows)
+        self.gated = np.asarray(gated)
+        self.direct = np.ascontiguousarray(direct)
+        self.closure = np.ascontiguousarray(closure)
+        self.depth = np.asarray(depth)
+        self.n_words = self.direct.shape[1] if self.direct.ndim == 2 and len(self.direct) else _words(len(self.codes))
+        self.slot = np.full(len(self.codes), -1, dtype="int64")
+        self.slot[self.gated] = np.arange(len(self.gated))
+
+    @classmethod
+    def open(cls, graph_dir: Path) -> "PrereqGraph":
+        graph_dir = Path(graph_dir)
+        arrays = [np.load(graph_dir / f"{name}.npy") for name in ("rows", "gated", "direct", "closure", "depth")]
+        return cls(json.loads((graph_dir / "graph.json").read_text()), *arrays)
+
+    @classmethod
+    def load(cls, index_dir: Path, store) -> "PrereqGraph":
+        """Open <index_dir>/prereqs, or build the graph in memory for indexes built without it."""
+        graph_dir = Path(index_dir) / PREREQ_DIRNAME
+        if (graph_dir / "graph.json").exists():
+            return cls.open(graph_dir)
+        print(f"[prereqs] {graph_dir} not found; building the prerequisite graph in memory (rebuild the index to persist it)")
+        return cls(*build_graph(store))
+
+    # ----------------------------
+    # Bitsets
+    # ----------------------------
+    def bits(self, nodes) -> np.ndarray:
+        mask = np.zeros(64 * self.n_words, dtype=bool)
+        mask[np.asarray(list(nodes), dtype="int64")] = True
+        return np.packbits(mask, bitorder="little").view("<u8")
+
+    def nodes(self, bits: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(bits.view("uint8"), count=len(self.codes), bitorder="little"))
+
+    def resolve(self, codes) -> tuple:
+        """(known nodes, unknown codes) for a list of course codes in any spelling."""
+        known, unknown = [], []
+        for c in codes:
+            code = normalize_code(c)
+            if code in self.node_of:
+                known.append(self.node_of[code])
+            else:
+                unknown.append(code)
+        return sorted(set(known)), unknown
+
+    # ----------------------------
+    # Queries
+    # ----------------------------
+    def eligible_mask(self, completed) -> np.ndarray:
+        """Bool mask over nodes: catalog courses not yet completed whose prerequisites all are."""
+        done = self.bits(completed)
+        mask = np.zeros(len(self.codes), dtype=bool)
+        mask[:self.n_catalog] = True
+        mask[np.asarray(completed, dtype="int64")] = False
+        if len(self.gated):
+            blocked = (self.direct & ~done).any(axis=1)
+            mask[self.gated[blocked]] = False
+        return mask
+
+    def row_mask(self, completed) -> np.ndarray:
+        """eligible_mask over chunk rows, for restricting a search."""
+        eligible = self.eligible_mask(completed)
+        return (self.row_node >= 0) & eligible[np.maximum(self.row_node, 0)]
+
+    def missing(self, target: int, completed) -> np.ndarray:
+        """
+        Nodes still to take for `target`: itself and its prerequisites, walking back
+        from it and stopping at completed courses (whose own prerequisites are satisfied).
+        """
+        done = self.bits(completed)
+        need = self.bits([target]) & ~done
+        s = self.slot[target]
+        if not need.any() or s < 0:
+            return self.nodes(need)
+        if not (self.closure[s] & done).any():   # nothing completed on the way: the closure is the answer
+            return self.nodes(need | self.closure[s])
+        frontier = need
+        while True:
+            slots = self.slot[self.nodes(frontier)]
+            slots = slots[slots >= 0]
+            if not len(slots):
+                break
+            frontier = np.bitwise_or.reduce(self.direct[slots], axis=0) & ~done & ~need
+            if not frontier.any():
+                break
+            need = need | frontier
+        return self.nodes(need)
+
+    def unlock_chain(self, target: int, completed) -> dict:
+        """
+        The courses still needed for `target`, in the earliest term each can be taken:
+        steps[0] is eligible now, steps[i] once steps[:i] are done. Its length is the
+        longest remaining prerequisite path, which `path` spells out.
+        """
+        missing = self.missing(target, completed)
+        if not len(missing):
+            return {"steps": [], "longest_path": [], "blocked": []}
+        done = self.bits(completed)
+        remaining, level, steps = set(missing.tolist()), {}, []
+        while remaining:
+            step = []
+            for v in sorted(remaining):
+                s = self.slot[v]
+                if s < 0 or not (self.direct[s] & ~done).any():
+                    step.append(v)
+            if not step:
+                break   # the rest sits on a prerequisite cycle
+            for v in step:
+                level[v] = len(steps)
+            steps.append(step)
+            done = done | self.bits(step)
+            remaining.difference_update(step)
+        path = []
+        if target in level:
+            v = target
+            path.append(v)
+            while level[v] > 0:
+                v = next(u for u in self.prereqs.get(v, []) if level.get(u) == level[v] - 1)
+                path.append(v)
+            path.reverse()
+        return {"steps": [[self.codes[v] for v in step] for step in steps],
+                "longest_path": [self.codes[v] for v in path],
+                "blocked": [self.codes[v] for v in sorted(remaining)]}
+
+    def missing_coreqs(self, node: int, completed) -> list:
+        done = set(completed)
+        return [self.codes[u] for u in self.coreqs.get(node, []) if u not in done]
+
+
+def _walk(graph: PrereqGraph, target: int, completed) -> set:
+    """Reference for PrereqGraph.missing: depth-first walk over the prerequisite lists."""
+    done, need, todo = set(completed), set(), [target]
+    while todo:
+        v = todo.pop()
+        if v in done or v in need:
+            continue
+        need.add(v)
+        todo.extend(graph.prereqs.get(v, []))
+    return need
+
+
+def check(graph: PrereqGraph) -> int:
+    """Mismatches between `missing` and `_walk` with nothing, then each direct prerequisite, completed."""
+    bad = 0
+    for v in graph.gated.tolist():
+        for completed in [[]] + [[u] for u in graph.prereqs[v]]:
+            got, want = set(graph.missing(v, completed).tolist()), _walk(graph, v, completed)
+            if got != want:
+                bad += 1
+                print(f"[prereqs] {graph.codes[v]} with {[graph.codes[u] for u in completed]} completed: "
+                      f"missing {sorted(graph.codes[u] for u in got)}, expected {sorted(graph.codes[u] for u in want)}")
+    return bad
+
+
+if __name__ == "__main__":
+    from metastore import MetaStore
+    ap = argparse.ArgumentParser(description="Inspect an index's prerequisite graph")
+    ap.add_argument("--index-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
+    ap.add_argument("--check", action="store_true", help="verify the missing-course walk for every course")
+    ap.add_argument("--target", help="print the unlock chain for this course")
+    ap.add_argument("--completed", nargs="*", default=[], help="completed course codes")
+    args = ap.parse_args()
+    index_dir = Path(args.index_dir).resolve()
+    graph = PrereqGraph.load(index_dir, MetaStore.load(index_dir))
+    if args.target:
+        done, _ = graph.resolve(args.completed)
+        print(json.dumps(graph.unlock_chain(graph.node_of[normalize_code(args.target)], done), indent=2))
+    if args.check:
+        bad = check(graph)
+        print(f"[prereqs] checked {len(graph.gated):,} courses: {bad} mismatch(es)")
+        raise SystemExit(1 if bad else 0)
@@ -1,168 +1,170 @@
 print("[query] v2 interactive with freeform re-query")
-import argparse, json, textwrap, re
+import argparse, json, sys, textwrap
 from pathlib import Path
 
-import faiss
 import numpy as np
-import pandas as pd
-from sentence_transformers import SentenceTransformer
 
-# ----------------------------
-# Query expansion (lightweight)
-# ----------------------------
-TOPIC_SYNONYMS = {
-    r"\bnlp\b": [
-        "natural language processing", "computational linguistics",
-        "text mining", "language modeling", "transformers", "sequence models"
-    ],
-    r"\bml\b|\bmachine learning\b": [
-        "supervised learning", "unsupervised learning", "classification",
-        "regression", "neural networks", "support vector machines", "clustering"
-    ],
-    r"\bai\b": [
-        "artificial intelligence", "knowledge representation", "search algorithms",
-        "planning", "intelligent agents"
-    ],
-    r"\bdata viz\b|\bvisuali[sz]ation\b|\btableau\b": [
-        "data visualization", "tableau", "plotting", "dashboards", "visual analytics"
-    ],
-    r"\bstats?\b|\bstatistics\b": [
-        "statistical inference", "probability", "hypothesis testing",
-        "regression analysis", "experimental design"
-    ],
-    r"\boptimization\b|\boperations research\b|\bor\b": [
-        "linear programming", "integer programming", "stochastic optimization",
-        "operations research"
-    ],
-    r"\bcomputational biology\b|\bbioinformatics\b": [
-        "genomics", "sequence analysis", "biostatistics", "systems biology"
-    ],
-    r"\bsecurity\b|\bcybersecurity\b": [
-        "cryptography", "network security", "secure systems", "access control"
-    ],
-    r"\bdatabases?\b": [
-        "relational databases", "sql", "transaction processing", "query optimization"
-    ],
-    r"\beconomics?\b|\becon\b": [
-        "microeconomics", "macroeconomics", "econometrics"
-    ],
-    r"\bpsychology\b|\bcognitive\b": [
-        "cognitive science", "perception", "human factors", "behavioral science"
-    ],
-}
-
-def expand_query(q: str) -> str:
-    """Add synonyms/related phrases to the query while keeping the original text."""
-    q_low = q.lower()
-    expansions = []
-    for pattern, syns in TOPIC_SYNONYMS.items():
-        if re.search(pattern, q_low):
-            expansions.extend(syns)
-    if expansions:
-        return q + " | " + " ; ".join(dict.fromkeys(expansions))
-    return q
+import bulk_query
+import query_daemon
+from encoders import load_encoder
+from expansion import EXPANSION_MODES, SYNONYM_WEIGHT, QueryEncoder, expand_query
+from grouping import group_rows
+from metastore import MetaStore
+from query_cache import QueryCache, cache_key, index_version
+from retrieval import MODES, search_courses
+from similar import DIVERSITY, SimilarityGraph, diversify
 
 # ----------------------------
 # Index loading / retrieval
 # ----------------------------
-def load_index(index_dir: Path):
+# Repeated questions in interactive mode skip the encoder and the search
+QUERY_CACHE = QueryCache(max_entries=256)
+
+def load_index(index_dir: Path, expansion: str = "string", expansion_weight: float = SYNONYM_WEIGHT):
+    # faiss is only needed here, so a call answered by the daemon never imports it
+    import faiss
+    from ann import apply_search_params, describe
     idx_path = index_dir / "faiss.index"
-    tbl_path = index_dir / "chunks.csv"   # stored by build_index.py
+    tbl_path = index_dir / "chunks.csv"   # CSV export; meta/ (columnar) is preferred
+    meta_path = index_dir / "meta" / "meta.json"
     cfg_path = index_dir / "config.json"
-    if not idx_path.exists() or not tbl_path.exists() or not cfg_path.exists():
+    if not idx_path.exists() or not (tbl_path.exists() or meta_path.exists()) or not cfg_path.exists():
         raise FileNotFoundError(f"Missing index files in {index_dir}")
     index = faiss.read_index(str(idx_path))
-    df = pd.read_csv(tbl_path)
+    store = MetaStore.load(index_dir)
     cfg = json.loads(cfg_path.read_text())
-    model = SentenceTransformer(cfg["model"])
-    print(f"[query] loaded index/table from {index_dir} ({len(df):,} chunks)")
-    return index, df, model, cfg
+    apply_search_params(index, cfg.get("index"))   # nprobe / efSearch recorded at build time
+    course_path = index_dir / (cfg.get("course_index") or {}).get("file", "courses.faiss")
+    course_index = faiss.read_index(str(course_path)) if course_path.exists() else None
+    # config.json "encoder" backend (else SentenceTransformer), plus query expansion
+    model = QueryEncoder(load_encoder(cfg, index_dir), expansion, expansion_weight)
+    QUERY_CACHE.set_version(index_version(cfg, idx_path))
+    print(f"[query] loaded index/table from {index_dir} ({len(store):,} chunks, {describe(cfg.get('index'))} index)")
+    return index, store, model, cfg, course_index
 
-def retrieve_chunks(query: str, k: int, index, df: pd.DataFrame, model: SentenceTransformer):
+def retrieve_chunks(query: str, k: int, index, store: MetaStore, model,
+                    top_courses: int = 8, mode: str = "chunk", course_index=None):
+    """
+    Best chunk per course as a score-ordered list of (row_id, score), plus retrieval stats.
+    In chunk mode `k` is the minimum number of chunks fetched by the first search.
+    """
     # Expand query to be friendlier for broad interests (across all majors)
     q_expanded = expand_query(query)
-    q_emb = model.encode([q_expanded], normalize_embeddings=True).astype("float32")
-    scores, idxs = index.search(q_emb, k)
-    idxs = idxs[0].tolist(); scores = scores[0].tolist()
-    res = df.iloc[idxs].copy()
-    res.insert(0, "score", scores)  # kept internally; we won't print it
-    return res
+    key = f"{mode}|{cache_key(q_expanded)}"
+    hits, q_emb = QUERY_CACHE.lookup(key, top_courses)
+    stats = {"mode": mode, "cache": "exact"}
+    if hits is None:
+        if q_emb is None:
+            q_emb = model.embed([query])[0]
+        hits = QUERY_CACHE.lookup_semantic(q_emb, top_courses, namespace=mode)
+        stats = {"mode": mode, "cache": "semantic"}
+    if hits is None:
+        (ids, scores, stats), = search_courses(q_emb.reshape(1, -1), [top_courses], index, store,
+                                               mode=mode, course_index=course_index, min_k=k)
+        hits = list(zip(ids.tolist(), scores.tolist()))
+        QUERY_CACHE.put(key, q_emb, hits, top_courses, namespace=mode)
+    return hits, stats
+
+class LocalSession:
+    """Index and model loaded in this process; `search` returns (courses, stats)."""
+
+    def __init__(self, index_dir: Path, expansion: str = "string", expansion_weight: float = SYNONYM_WEIGHT):
+        self.index, self.store, self.model, self.cfg, self.course_index = load_index(index_dir, expansion, expansion_weight)
+        self.has_course_index = self.course_index is not None
+        self.neighbors = SimilarityGraph.load(index_dir, self.course_index)
+
+    def search(self, query: str, k: int, top_courses: int, mode: str = "chunk"):
+        if mode == "course" and self.course_index is None:
+            mode = "chunk"
+        # Chunk mode starts with a small over-fetch and widens only if too few courses surface
+        hits, stats = retrieve_chunks(query, k, self.index, self.store, self.model,
+                                      top_courses=top_courses, mode=mode, course_index=self.course_index)
+        return group_by_course(hits, self.store, top_courses=top_courses), stats
+
+    def similar(self, parent: int, top_courses: int, diversity: float = 0.0):
+        """Courses most similar to course `parent`, from the precomputed similarity graph."""
+        if self.neighbors is None:
+            return []
+        if diversity > 0:
+            ids, scores = self.neighbors.lookup(parent)
+            subjects = [self.store.get("metadata.subject_code", r) for r in self.store.parent_rows[ids].tolist()]
+            ids, scores = diversify(ids, scores, subjects, top_courses, diversity)
+        else:
+            ids, scores = self.neighbors.lookup(parent, top_courses)
+        rows = self.store.parent_rows[ids]
+        return [course_entry(self.store, i, s) for i, s in zip(rows.tolist(), scores.tolist())]
+
+def print_stats(stats: dict):
+    if "cache" in stats:
+        print(f"[query] {stats['mode']} mode: served from cache ({stats['cache']})")
+    else:
+        print(f"[query] {stats['mode']} mode: fetched {stats['fetched']} vectors for "
+              f"{stats['delivered']} courses ({stats['fetched_per_course']:.1f} per course, "
+              f"{stats['rounds']} round{'s' if stats['rounds'] != 1 else ''})")
 
 # ----------------------------
 # Grouping / presentation
 # ----------------------------
-def _safe_series(df: pd.DataFrame, col: str, default: str = "") -> pd.Series:
-    if col in df.columns:
-        return df[col].astype(str).fillna("")
-    return pd.Series([default] * len(df), index=df.index, dtype="object")
-
-def group_by_course(chunks_df: pd.DataFrame, top_courses: int):
-    """Collapse many chunks into distinct courses via parent_id; preview = best chunk."""
-    if "metadata.parent_id" not in chunks_df.columns:
-        chunks_df = chunks_df.copy()
-        chunks_df["metadata.parent_id"] = chunks_df["id"]
-
-    best = (
-        chunks_df
-        .sort_values("score", ascending=False)
-        .drop_duplicates(subset=["metadata.parent_id"], keep="first")
-        .copy()
-    )
-    top = best.head(top_courses).copy()
-
-    code_s  = _safe_series(top, "metadata.course_code")
-    name_s  = _safe_series(top, "metadata.class_name")
-    subj_s  = _safe_series(top, "metadata.subject")
-    subj2_s = _safe_series(top, "metadata.subject_code")
-    subject_s = subj_s.mask(subj_s.eq(""), subj2_s)
+def _hit_arrays(hits):
+    ids = np.fromiter((i for i, _ in hits), dtype="int64", count=len(hits))
+    scores = np.fromiter((s for _, s in hits), dtype="float32", count=len(hits))
+    return ids, scores
 
+def course_entry(store: MetaStore, i: int, score: float) -> dict:
+    """Menu entry for chunk row i."""
     def short_snippet(t: str, n=260):
         s = (t or "").replace("\n", " ").strip()
         return s  # no truncation
 
-    top["course_code"] = code_s
-    top["class_name"]  = name_s
-    top["subject"]     = subject_s
-    top["snippet"]     = top["text"].astype(str).apply(lambda x: short_snippet(x, 260))
-    return top
+    return {
+        "row": i,
+        "parent": int(store.parent_idx[i]),
+        "score": score,
+        "course_code": store.get("metadata.course_code", i),
+        "class_name": store.get("metadata.class_name", i),
+        "subject": store.get("metadata.subject", i) or store.get("metadata.subject_code", i),
+        "source_url": store.get("metadata.source_url", i),
+        "snippet": short_snippet(store.get("text", i), 260),
+    }
 
-def print_menu(query: str, courses_df: pd.DataFrame):
+def group_by_course(hits, store: MetaStore, top_courses: int):
+    """Collapse many chunks into distinct courses via parent_id; preview = best chunk."""
+    ids, scores = _hit_arrays(hits)
+    # hits are already score-ordered, so the first chunk seen per parent is the best one
+    pos = group_rows(ids, store.parent_idx, top_courses)
+    return [course_entry(store, i, score) for i, score in zip(ids[pos].tolist(), scores[pos].tolist())]
+
+def print_menu(query: str, courses):
     print(f"\nYou asked: {query}\n")
-    if courses_df.empty:
+    if not courses:
         print("I couldn’t find matches. Try something simpler, like: “electives with no prerequisites” or “natural language processing”.")
         return
     print("You can choose from:")
-    for i, (_, r) in enumerate(courses_df.iterrows(), start=1):
+    for i, r in enumerate(courses, start=1):
         code  = r.get("course_code", "") or ""
         name  = r.get("class_name", "") or ""
         subj  = r.get("subject", "") or ""
         head  = f"{code} — {name}" if (code or name) else "(Untitled course)"
         print(f"{i:>2}. {head}  [{subj}]")
         print("    " + textwrap.fill(r.get("snippet",""), subsequent_indent="    "))
-    print("\nTip: in interactive mode you can type:  more N  |  list  |  help  |  or just ask a new question.\n")
+    print("\nTip: in interactive mode you can type:  more N  |  similar N  |  list  |  help  |  or just ask a new question.\n")
 
-def print_course_details(chunks_df: pd.DataFrame, parent_id: str):
-    rows = chunks_df[chunks_df.get("metadata.parent_id", chunks_df["id"]) == parent_id] \
-                .sort_values("score", ascending=False)
-    if rows.empty:
-        print("No details for that selection.")
-        return
-    top = rows.iloc[0]
-    code  = top.get("metadata.course_code", "")
-    name  = top.get("metadata.class_name", "")
-    subj  = top.get("metadata.subject", "") or top.get("metadata.subject_code","")
-    url   = top.get("metadata.source_url", "")
+def print_course_details(course: dict):
+    """Full text of a menu entry (its best chunk, which group_by_course already picked)."""
+    code  = course.get("course_code")
+    name  = course.get("class_name")
+    subj  = course.get("subject")
+    url   = course.get("source_url")
     print(f"\n{code} — {name} [{subj}]")
     if url: print(f"Source: {url}")
-    text = str(top.get("text","")).strip()
+    text = (course.get("snippet") or "").strip()
     print("\n" + textwrap.fill(text, width=100))
 
-def interactive_loop(query: str, chunks_df: pd.DataFrame, menu_df: pd.DataFrame, index, df, model, k, top_courses):
-    # mapping for the initial menu
-    idx_to_parent = {i: r["metadata.parent_id"] for i, (_, r) in enumerate(menu_df.iterrows(), start=1)}
-    print_menu(query, menu_df)
+def interactive_loop(query: str, menu, session, k, top_courses, mode):
+    print_menu(query, menu)
     print("Interactive mode. Commands:\n"
           "  more N  → show full details for option N\n"
+          "  similar N [diverse] → courses like option N (diverse: mix in other subjects)\n"
           "  list    → reprint the current menu\n"
           "  help    → show this help\n"
           "  quit    → exit\n"
@@ -170,9 +172,7 @@ def interactive_loop(query: str, chunks_df: pd.DataFrame, menu_df: pd.DataFrame,
 
     # Keep current state so `list` works after a requery
     current_query = query
-    current_chunks = chunks_df
-    current_menu = menu_df
-    current_map = idx_to_parent
+    current_menu = menu
 
     while True:
         try:
@@ -191,6 +191,7 @@ def interactive_loop(query: str, chunks_df: pd.DataFrame, menu_df: pd.DataFrame,
         if cmd_lower in ("h", "help"):
             print("Commands:\n"
                   "  more N  → show full details for option N\n"
+                  "  similar N [diverse] → courses like option N (diverse: mix in other subjects)\n"
                   "  list    → reprint the current menu\n"
                   "  help    → show this help\n"
                   "  quit    → exit\n"
@@ -203,11 +204,25 @@ def interactive_loop(query: str, chunks_df: pd.DataFrame, menu_df: pd.DataFrame,
         parts = raw.split()
         if len(parts) == 2 and parts[0].lower() == "more" and parts[1].isdigit():
             num = int(parts[1])
-            if num not in current_map:
+            if not 1 <= num <= len(current_menu):
                 print("Pick a valid number from the menu.")
                 continue
-            parent_id = current_map[num]
-            print_course_details(current_chunks, parent_id)
+            print_course_details(current_menu[num - 1])
+            continue
+        if 2 <= len(parts) <= 3 and parts[0].lower() == "similar" and parts[1].isdigit():
+            num = int(parts[1])
+            if not 1 <= num <= len(current_menu):
+                print("Pick a valid number from the menu.")
+                continue
+            course = current_menu[num - 1]
+            diversity = DIVERSITY if len(parts) == 3 and parts[2].lower() == "diverse" else 0.0
+            similar_menu = session.similar(course["parent"], top_courses, diversity)
+            if not similar_menu:
+                print("No similar courses available (this index has no course-level vectors).")
+                continue
+            current_query = f"courses similar to {course['course_code']}"
+            current_menu = similar_menu
+            print_menu(current_query, current_menu)
             continue
 
         # ---------------
@@ -215,36 +230,83 @@ def interactive_loop(query: str, chunks_df: pd.DataFrame, menu_df: pd.DataFrame,
         # ---------------
         new_query = raw
         print("Got it — you’re asking something new. Let’s look that up…")
-        chunk_k = max(k, top_courses * 5)
-        new_chunks = retrieve_chunks(new_query, chunk_k, index, df, model)
-        new_menu = group_by_course(new_chunks, top_courses=top_courses)
+        new_menu, stats = session.search(new_query, k, top_courses, mode)
+        print_stats(stats)
         current_query = new_query
-        current_chunks = new_chunks
         current_menu = new_menu
-        current_map = {i: r["metadata.parent_id"] for i, (_, r) in enumerate(new_menu.iterrows(), start=1)}
         print_menu(new_query, new_menu)
 
 # ----------------------------
 # Main
 # ----------------------------
-def main(index_dir: str, k: int, query: str, top_courses: int, interactive: bool):
-    index, df, model, cfg = load_index(Path(index_dir).resolve())
-    # Pull more chunks than courses so multiple classes can surface
-    chunk_k = max(k, top_courses * 5)
-    chunks = retrieve_chunks(query, chunk_k, index, df, model)
-    courses = group_by_course(chunks, top_courses=top_courses)
+def open_session(index_dir: Path, expansion: str = "string", expansion_weight: float = SYNONYM_WEIGHT,
+                 use_daemon: bool = True, socket_path=None):
+    """A running query daemon for this index and settings if there is one, else a LocalSession."""
+    def local():
+        return LocalSession(index_dir, expansion, expansion_weight)
+    if use_daemon:
+        try:
+            socket_path = socket_path or query_daemon.default_socket(index_dir)
+        except PermissionError as e:
+            print(f"[query] not using the daemon: {e}")
+            return local()
+        session = query_daemon.connect(socket_path, index_dir, expansion, expansion_weight, fallback=local)
+        if session is not None:
+            return session
+    return local()
+
+def main(index_dir: str, k: int, query: str, top_courses: int, interactive: bool, mode: str = "chunk",
+         expansion: str = "string", expansion_weight: float = SYNONYM_WEIGHT,
+         use_daemon: bool = True, socket_path: str = None):
+    session = open_session(Path(index_dir).resolve(), expansion, expansion_weight, use_daemon, socket_path)
+    if mode == "course" and not session.has_course_index:
+        print("[query] no course-level index in this build; falling back to chunk mode")
+        mode = "chunk"
+    courses, stats = session.search(query, k, top_courses, mode)
+    print_stats(stats)
     if interactive:
         print("[query] interactive: freeform follow-ups enabled")
-        interactive_loop(query, chunks, courses, index, df, model, k, top_courses)
+        interactive_loop(query, courses, session, k, top_courses, mode)
     else:
         print_menu(query, courses)
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--index-dir", default=str(Path(__file__).resolve().parents[1] / "data" / "processed" / "index"))
-    ap.add_argument("--query", required=True)
-    ap.add_argument("-k", type=int, default=50, help="top chunks to retrieve (used internally)")
+    ap.add_argument("--query", help="required unless --daemon or --queries-file is given")
+    ap.add_argument("-k", type=int, default=0, help="minimum chunks fetched by the first search (chunk mode; widened automatically)")
     ap.add_argument("--top-courses", type=int, default=8, help="show this many distinct courses")
+    ap.add_argument("--mode", choices=MODES, default="chunk", help="chunk: group chunk hits by course; course: search the course-level index")
     ap.add_argument("--interactive", action="store_true", help="enable simple REPL to drill into options")
+    ap.add_argument("--expansion", choices=EXPANSION_MODES, default="string",
+                    help="string: encode the query with synonym phrases appended; embedding: blend precomputed synonym vectors into the query vector")
+    ap.add_argument("--expansion-weight", type=float, default=SYNONYM_WEIGHT, help="synonym share in embedding expansion")
+    ap.add_argument("--daemon", choices=query_daemon.COMMANDS,
+                    help="start/stop/status a background process that keeps the index and model loaded "
+                         "(serve runs it in the foreground); queries use it automatically when it is running")
+    ap.add_argument("--no-daemon", action="store_true", help="always load the index in this process")
+    ap.add_argument("--socket", default=None, help="daemon socket (default: one per user and index directory)")
+    ap.add_argument("--idle-timeout", type=float, default=query_daemon.IDLE_TIMEOUT_S,
+                    help="seconds without a query after which the daemon exits (0 = never)")
+    ap.add_argument("--queries-file", default=None,
+                    help="bulk mode: one query per line (text, or JSON with query/top_courses/id); '-' = stdin")
+    ap.add_argument("--out", default=None, help="bulk mode: JSONL results (default: <queries-file>.results.jsonl)")
+    ap.add_argument("--batch-size", type=int, default=256, help="bulk mode: queries encoded and searched together")
+    ap.add_argument("--workers", type=int, default=1, help="bulk mode: encoder workers (1 = encode in this process)")
+    ap.add_argument("--pool", choices=bulk_query.POOLS, default="thread", help="bulk mode: kind of encoder workers")
     args = ap.parse_args()
-    main(args.index_dir, args.k, args.query, args.top_courses, args.interactive)
\ No newline at end of file
+    if args.queries_file:
+        index_dir = Path(args.index_dir).resolve()
+        # Bulk runs always load in-process: the batched encode and search is the point
+        session = LocalSession(index_dir, args.expansion, args.expansion_weight)
+        mode = args.mode if args.mode != "course" or session.has_course_index else "chunk"
+        bulk_query.main(session, args.queries_file, args.out, args.k, args.top_courses, mode,
+                        args.batch_size, args.workers, args.pool, index_dir)
+        sys.exit(0)
+    if args.daemon:
+        sys.exit(query_daemon.main(args.daemon, Path(args.index_dir).resolve(), args.socket,
+                                   args.idle_timeout, args.expansion, args.expansion_weight))
+    if args.query is None:
+        ap.error("--query is required (or use --daemon / --queries-file)")
+    main(args.index_dir, args.k, args.query, args.top_courses, args.interactive, args.mode,
+         args.expansion, args.expansion_weight, not args.no_daemon, args.socket)
\ No newline at end of file
@@ -0,0 +1,199 @@
+# rag/src/query_cache.py
+"""
+Two-tier query cache shared by query.py and the Flask app.
+
+- exact tier: LRU keyed on the normalized, expanded query text, holding the
+  query embedding and the final results computed for it.
+- semantic tier (optional): if a new query embedding is within a cosine
+  threshold of a cached one, that entry's results are reused.
+
+Both tiers evict by size and TTL, and everything is dropped when the index
+version (from config.json) changes.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def cache_key(expanded_query: str) -> str:
+    """Normalize expanded query text: case-folded, whitespace collapsed."""
+    return " ".join(str(expanded_query).lower().split())
+
+
+class _Entry:
+    __slots__ = ("embedding", "results", "size", "created")
+
+    def __init__(self, embedding, results, size, created):
+        self.embedding = embedding
+        self.results = results
+        self.size = size
+        self.created = created
+
+    def covers(self, size: int) -> bool:
+        # Results computed for N items also answer any request for <= N, and a
+        # short result list means the index had nothing more to give.
+        return self.results is not None and (size <= self.size or len(self.results) < self.size)
+
+
+class QueryCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600.0,
+                 semantic_threshold: float = None, semantic_max_entries: int = 256):
+        self.max_entries = int(max_entries)
+        self.ttl_seconds = float(ttl_seconds)
+        self.semantic_threshold = semantic_threshold
+        self.semantic_max_entries = int(semantic_max_entries)
+        self.version = None
+        self._lock = threading.Lock()
+        self._exact = OrderedDict()        # key -> _Entry
+        self._semantic = OrderedDict()     # key -> (embedding, namespace)
+        self._sem_keys = []
+        self._sem_ns = None
+        self._sem_matrix = None            # stacked semantic embeddings, rebuilt lazily
+        self._counters = dict.fromkeys(
+            ("exact_hits", "embedding_hits", "semantic_hits", "misses", "evictions", "invalidations"), 0
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def set_version(self, version):
+        """Tie the cache to an index version; switching versions drops every entry."""
+        with self._lock:
+            if version != self.version:
+                if self._exact:
+                    self._counters["invalidations"] += 1
+                self._clear_locked()
+                self.version = version
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+
+    def _clear_locked(self):
+        self._exact.clear()
+        self._semantic.clear()
+        self._sem_keys = []
+        self._sem_matrix = None
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry.created > self.ttl_seconds
+
+    def _drop_locked(self, key):
+        self._exact.pop(key, None)
+        if self._semantic.pop(key, None) is not None:
+            self._sem_matrix = None
+
+    def lookup(self, key: str, size: int):
+        """
+        Exact-tier lookup. Returns (results, embedding):
+        results is the cached list trimmed to `size` (or None if not covered),
+        embedding is the cached query vector (or None on a full miss).
+        """
+        if not self.enabled:
+            return None, None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._drop_locked(key)
+                entry = None
+            if entry is None:
+                self._counters["misses"] += 1
+                return None, None
+            self._exact.move_to_end(key)
+            if entry.covers(size):
+                self._counters["exact_hits"] += 1
+                return entry.results[:size], entry.embedding
+            self._counters["embedding_hits"] += 1
+            return None, entry.embedding
+
+    def lookup_semantic(self, embedding, size: int, namespace: str = ""):
+        """
+        Semantic-tier lookup: results of the closest cached query above the
+        threshold within the same namespace (e.g. retrieval mode), else None.
+        """
+        if not self.enabled or self.semantic_threshold is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if not self._semantic:
+                return None
+            if self._sem_matrix is None:
+                self._sem_keys = list(self._semantic.keys())
+                self._sem_matrix = np.vstack([self._semantic[k][0] for k in self._sem_keys])
+                self._sem_ns = np.array([self._semantic[k][1] for k in self._sem_keys], dtype=object)
+            sims = self._sem_matrix @ np.asarray(embedding, dtype="float32").reshape(-1)
+            sims = np.where(self._sem_ns == namespace, sims, -np.inf)
+            best = int(np.argmax(sims))
+            if float(sims[best]) < self.semantic_threshold:
+                return None
+            key = self._sem_keys[best]
+            entry = self._exact.get(key)
+            if entry is None or self._expired(entry, now) or not entry.covers(size):
+                return None
+            self._exact.move_to_end(key)
+            self._semantic.move_to_end(key)
+            self._counters["semantic_hits"] += 1
+            return entry.results[:size]
+
+    def put(self, key: str, embedding, results, size: int, namespace: str = "", version=None):
+        """
+        Store the embedding and the results computed for `size` items. With `version`,
+        results computed on another index version (e.g. a request that was still
+        running on the old index when a reload swapped it) are not stored.
+        """
+        if not self.enabled:
+            return
+        embedding = np.asarray(embedding, dtype="float32").reshape(-1)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._exact[key] = _Entry(embedding, results, int(size), time.monotonic())
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_entries:
+                old_key, _ = self._exact.popitem(last=False)
+                self._drop_locked(old_key)
+                self._counters["evictions"] += 1
+            if self.semantic_threshold is not None and results is not None:
+                self._semantic[key] = (embedding, namespace)
+                self._semantic.move_to_end(key)
+                while len(self._semantic) > self.semantic_max_entries:
+                    self._semantic.popitem(last=False)
+                self._sem_matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._counters)
+            lookups = out["exact_hits"] + out["embedding_hits"] + out["misses"]
+            out.update({
+                "version": self.version,
+                "entries": len(self._exact),
+                "semantic_entries": len(self._semantic),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "semantic_threshold": self.semantic_threshold,
+                "hit_rate": ((out["exact_hits"] + out["semantic_hits"]) / lookups) if lookups else 0.0,
+            })
+            return out
+
+
+def index_version(cfg: dict, index_path) -> str:
+    """
+    Version string for an index: config.json's "version", else the FAISS file's mtime/size,
+    plus a digest of the "encoder" entry when there is one. encoders.py switches the query
+    encoder in place without rebuilding, and that changes results as much as new vectors do.
+    """
+    if cfg.get("version"):
+        version = str(cfg["version"])
+    else:
+        st = index_path.stat()
+        version = f"mtime-{st.st_mtime_ns}-{st.st_size}"
+    if cfg.get("encoder"):
+        spec = json.dumps(cfg["encoder"], sort_keys=True).encode()
+        version += "-" + hashlib.blake2b(spec, digest_size=4).hexdigest()
+    return version
@@ -0,0 +1,366 @@
+# rag/src/query_daemon.py
+"""
+Background query daemon for query.py.
+
+    python query.py --daemon start     # load index + model once, in the background
+    python query.py --query "nlp"      # answered by the daemon (no model/index load)
+    python query.py --daemon status    # uptime and served counts
+    python query.py --daemon stop
+
+The daemon listens on a Unix domain socket (one per index directory, in a 0700
+per-user directory; clients only connect to sockets they own) and
+exits after --idle-timeout seconds without a query. query.py connects to it when it
+is running and serves the same index with the same expansion settings, and loads
+everything in-process otherwise (also when the daemon goes away mid-session).
+
+Protocol: one JSON object per line in each direction.
+  {"op": "query", "query": ..., "k": 0, "top_courses": 8, "mode": "chunk"}
+      -> {"courses": [...], "stats": {...}}
+  {"op": "similar", "parent": 17, "top_courses": 8, "diversity": 0.0} -> {"courses": [...]}
+  {"op": "status"} -> {"pid": ..., "uptime_s": ..., "served": {...}, ...}
+  {"op": "stop"}   -> {"stopping": true}
+Errors come back as {"error": "..."}.
+"""
+import hashlib, json, os, signal, socket, socketserver, subprocess, sys, tempfile, threading, time
+from pathlib import Path
+
+from expansion import SYNONYM_WEIGHT
+
+COMMANDS = ("start", "stop", "status", "serve")
+IDLE_TIMEOUT_S = 900.0
+START_TIMEOUT_S = 180.0   # model load on a cold cache can take a while
+
+
+def _private_dir(path: Path) -> Path:
+    """Create `path` with mode 0700, and refuse it if another user owns it or can get in."""
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = path.stat()
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory owned by uid {os.getuid()} with mode 0700")
+    return path
+
+
+def default_socket(index_dir) -> Path:
+    """
+    Socket path for `index_dir` in a 0700 per-user directory under XDG_RUNTIME_DIR
+    (else the temp dir), so no other user can create or reach it.
+    """
+    key = hashlib.sha1(str(Path(index_dir).resolve()).encode()).hexdigest()[:10]
+    base = Path(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir())
+    return _private_dir(base / f"rag-query-{os.getuid()}") / f"{key}.sock"
+
+
+def _owned(path) -> bool:
+    """True if `path` exists and belongs to this user; a socket someone else made is never trusted."""
+    try:
+        uid = os.stat(path).st_uid
+    except OSError:
+        return False
+    if uid != os.getuid():
+        print(f"[query] ignoring {path}: owned by uid {uid}, not {os.getuid()}")
+        return False
+    return True
+
+
+# ----------------------------
+# Client
+# ----------------------------
+class DaemonClient:
+    """One connection to the daemon; `request` sends a message and waits for the reply."""
+
+    def __init__(self, socket_path, timeout: float = None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(str(socket_path))
+        self.file = self.sock.makefile("rwb")
+
+    def request(self, payload: dict) -> dict:
+        self.file.write((json.dumps(payload) + "\n").encode())
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("daemon closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def _try_client(socket_path, timeout: float = None):
+    if not _owned(socket_path):
+        return None
+    try:
+        return DaemonClient(socket_path, timeout)
+    except OSError:   # stale socket file: nobody is listening
+        return None
+
+
+class DaemonSession:
+    """
+    query.py session backed by the daemon: same `search` / `similar` / `has_course_index` as
+    query.LocalSession. If the daemon disappears (idle timeout, stopped), the session
+    loads the index in-process via `fallback` and carries on.
+    """
+
+    def __init__(self, client: DaemonClient, status: dict, fallback):
+        self.client = client
+        self.status = status
+        self.has_course_index = status["course_index"]
+        self._fallback = fallback
+        self._local = None
+
+    def search(self, query: str, k: int, top_courses: int, mode: str = "chunk"):
+        if self._local is None:
+            try:
+                reply = self.client.request({"op": "query", "query": query, "k": k,
+                                             "top_courses": top_courses, "mode": mode})
+                return reply["courses"], reply["stats"]
+            except (OSError, ConnectionError) as e:
+                print(f"[query] daemon unavailable ({e}); loading the index in this process")
+                self.client.close()
+                self._local = self._fallback()
+        return self._local.search(query, k, top_courses, mode)
+
+    def similar(self, parent: int, top_courses: int, diversity: float = 0.0):
+        if self._local is None:
+            try:
+                reply = self.client.request({"op": "similar", "parent": parent, "top_courses": top_courses,
+                                             "diversity": diversity})
+                return reply["courses"]
+            except (OSError, ConnectionError) as e:
+                print(f"[query] daemon unavailable ({e}); loading the index in this process")
+                self.client.close()
+                self._local = self._fallback()
+        return self._local.similar(parent, top_courses, diversity)
+
+
+def _current_version(index_dir: Path):
+    from query_cache import index_version
+    try:
+        return index_version(json.loads((index_dir / "config.json").read_text()), index_dir / "faiss.index")
+    except (OSError, ValueError):
+        return None
+
+
+def connect(socket_path, index_dir: Path, expansion: str, expansion_weight: float, fallback):
+    """A DaemonSession if a daemon serving this index (current version) and settings is up, else None."""
+    client = _try_client(socket_path)
+    if client is None:
+        return None
+    try:
+        status = client.request({"op": "status"})
+    except (OSError, ConnectionError, RuntimeError, ValueError):
+        client.close()
+        return None
+    wanted = {"index_dir": str(index_dir), "expansion": expansion, "expansion_weight": expansion_weight}
+    served = {key: status.get(key) for key in wanted}
+    if served != wanted:
+        print(f"[query] daemon at {socket_path} serves {served}; loading in-process for {wanted}")
+        client.close()
+        return None
+    version = _current_version(index_dir)
+    if version != status.get("version"):
+        print(f"[query] daemon serves index version {status.get('version')} but {index_dir} is now {version}; "
+              "loading in-process (restart it: --daemon stop, then --daemon start)")
+        client.close()
+        return None
+    print(f"[query] using daemon pid {status['pid']} (up {status['uptime_s']:.0f}s, "
+          f"{status['served']['queries']} queries served)")
+    return DaemonSession(client, status, fallback)
+
+
+# ----------------------------
+# Server
+# ----------------------------
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.query_daemon
+        daemon.count("connections")
+        for line in self.rfile:
+            try:
+                reply = daemon.handle(json.loads(line))
+            except Exception as e:
+                daemon.count("errors")
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class QueryDaemon:
+    """Serves a query.LocalSession on a Unix socket until stopped or idle for `idle_timeout` seconds."""
+
+    def __init__(self, session, socket_path: Path, idle_timeout: float, settings: dict):
+        self.session = session
+        self.socket_path = Path(socket_path)
+        self.idle_timeout = float(idle_timeout)
+        self.settings = settings
+        self.started = time.time()
+        self.last_request = time.monotonic()
+        self.served = dict.fromkeys(("connections", "queries", "cache_hits", "errors"), 0)
+        self.query_ms = 0.0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.served[name] += n
+
+    def handle(self, msg: dict) -> dict:
+        op = msg.get("op")
+        if op == "query":   # only queries keep the daemon alive, not status checks
+            self.last_request = time.monotonic()
+            t0 = time.perf_counter()
+            courses, stats = self.session.search(str(msg["query"]), int(msg.get("k", 0)),
+                                                 int(msg.get("top_courses", 8)), msg.get("mode", "chunk"))
+            with self._lock:
+                self.served["queries"] += 1
+                self.served["cache_hits"] += "cache" in stats
+                self.query_ms += 1e3 * (time.perf_counter() - t0)
+            return {"courses": courses, "stats": stats}
+        if op == "similar":
+            self.last_request = time.monotonic()
+            return {"courses": self.session.similar(int(msg["parent"]), int(msg.get("top_courses", 8)),
+                                                    float(msg.get("diversity", 0.0)))}
+        if op == "status":
+            return self.status()
+        if op == "stop":
+            self.shutdown()
+            return {"stopping": True}
+        raise ValueError(f"unknown op {op!r}")
+
+    def status(self) -> dict:
+        from query import QUERY_CACHE
+        with self._lock:
+            served = dict(self.served)
+            mean_ms = self.query_ms / served["queries"] if served["queries"] else 0.0
+        return {**self.settings, "pid": os.getpid(), "socket": str(self.socket_path),
+                "version": QUERY_CACHE.version, "course_index": self.session.has_course_index,
+                "uptime_s": round(time.time() - self.started, 1),
+                "idle_s": round(time.monotonic() - self.last_request, 1),
+                "idle_timeout_s": self.idle_timeout, "served": served,
+                "mean_query_ms": round(mean_ms, 3), "cache": QUERY_CACHE.stats()}
+
+    def shutdown(self):
+        # server.shutdown() blocks until serve_forever returns, so never call it on the serving thread
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def _watch_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 5.0))
+            if time.monotonic() - self.last_request > self.idle_timeout:
+                print(f"[daemon] idle for {self.idle_timeout:g}s; exiting")
+                self.shutdown()
+                return
+
+    def serve(self):
+        old_umask = os.umask(0o177)   # the socket is created 0600, not chmod-ed after bind
+        try:
+            self.server = _Server(str(self.socket_path), _Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.query_daemon = self
+        signal.signal(signal.SIGTERM, lambda *_: self.shutdown())
+        if self.idle_timeout > 0:
+            threading.Thread(target=self._watch_idle, name="idle-watch", daemon=True).start()
+        print(f"[daemon] pid {os.getpid()} listening on {self.socket_path}", flush=True)
+        try:
+            self.server.serve_forever(poll_interval=0.5)
+        finally:
+            self.server.server_close()
+            self.socket_path.unlink(missing_ok=True)
+            print(f"[daemon] stopped after {self.served['queries']} queries", flush=True)
+
+
+def serve(index_dir: Path, socket_path: Path, idle_timeout: float, expansion: str, expansion_weight: float) -> int:
+    from query import LocalSession
+    client = _try_client(socket_path)
+    if client is not None:
+        client.close()
+        print(f"[daemon] already running on {socket_path}")
+        return 1
+    socket_path.unlink(missing_ok=True)   # left behind by a daemon that was killed
+    session = LocalSession(index_dir, expansion, expansion_weight)
+    settings = {"index_dir": str(index_dir), "expansion": expansion, "expansion_weight": expansion_weight}
+    QueryDaemon(session, socket_path, idle_timeout, settings).serve()
+    return 0
+
+
+# ----------------------------
+# start / stop / status
+# ----------------------------
+def _print_status(status: dict):
+    served = status["served"]
+    print(f"[daemon] pid {status['pid']} on {status['socket']}")
+    print(f"  index     {status['index_dir']} (version {status['version']}, expansion {status['expansion']})")
+    timeout = f"exits after {status['idle_timeout_s']:g}s idle" if status["idle_timeout_s"] > 0 else "no idle timeout"
+    print(f"  uptime    {status['uptime_s']:.0f}s, idle {status['idle_s']:.0f}s ({timeout})")
+    print(f"  served    {served['queries']} queries ({served['cache_hits']} from cache, "
+          f"{status['mean_query_ms']:.1f} ms mean), {served['connections']} connections, {served['errors']} errors")
+
+
+def start(index_dir: Path, socket_path: Path, idle_timeout: float, expansion: str, expansion_weight: float) -> int:
+    client = _try_client(socket_path)
+    if client is not None:
+        _print_status(client.request({"op": "status"}))
+        client.close()
+        print("[daemon] already running")
+        return 0
+    log_path = socket_path.with_suffix(".log")
+    cmd = [sys.executable, str(Path(__file__).with_name("query.py")), "--daemon", "serve",
+           "--index-dir", str(index_dir), "--socket", str(socket_path), "--idle-timeout", str(idle_timeout),
+           "--expansion", expansion, "--expansion-weight", str(expansion_weight)]
+    with open(log_path, "ab") as log:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True, env=dict(os.environ, PYTHONUNBUFFERED="1"))
+    print(f"[daemon] starting pid {proc.pid} (log: {log_path})")
+    deadline = time.monotonic() + START_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            print(f"[daemon] exited during startup (status {proc.returncode}); see {log_path}")
+            return 1
+        client = _try_client(socket_path, timeout=5)
+        if client is not None:
+            status = client.request({"op": "status"})
+            client.close()
+            print(f"[daemon] ready after {status['uptime_s']:.1f}s")
+            return 0
+        time.sleep(0.2)
+    print(f"[daemon] not ready after {START_TIMEOUT_S:g}s; see {log_path}")
+    return 1
+
+
+def main(command: str, index_dir: Path, socket_path=None, idle_timeout: float = IDLE_TIMEOUT_S,
+         expansion: str = "string", expansion_weight: float = SYNONYM_WEIGHT) -> int:
+    try:
+        socket_path = Path(socket_path) if socket_path else default_socket(index_dir)
+    except PermissionError as e:
+        print(f"[daemon] {e}")
+        return 1
+    if command == "serve":
+        return serve(index_dir, socket_path, idle_timeout, expansion, expansion_weight)
+    if command == "start":
+        return start(index_dir, socket_path, idle_timeout, expansion, expansion_weight)
+    client = _try_client(socket_path, timeout=10)
+    if client is None:
+        print(f"[daemon] not running ({socket_path})")
+        return 1 if command == "status" else 0
+    try:
+        if command == "status":
+            _print_status(client.request({"op": "status"}))
+        else:
+            client.request({"op": "stop"})
+            print("[daemon] stopping")
+    finally:
+        client.close()
+    return 0
@@ -0,0 +1,150 @@
+# rag/src/retrieval.py
+"""
+Course retrieval shared by query.py and the Flask app.
+
+Two modes:
+- "chunk":  search the chunk index and group hits by course. The first search
+            fetches only a small multiple of top_courses chunks and widens k
+            only for queries that came back with too few distinct courses.
+- "course": search the course-level index (one pooled vector per parent_id)
+            built by build_index.py, so every hit is already a distinct course.
+
+Both accept a compiled filter (filters.Selection); the search then only visits
+eligible ids and k is capped by the number of eligible rows.
+"""
+import time
+
+import numpy as np
+
+from grouping import group_rows
+
+MODES = ("chunk", "course")
+CHUNK_OVERFETCH = 2   # initial chunks fetched per requested course
+WIDEN_FACTOR = 4      # k multiplier when a query under-delivers
+
+
+def _stats(mode: str, fetched: int, delivered: int, rounds: int, selection=None, timings=None) -> dict:
+    stats = {
+        "mode": mode,
+        "fetched": int(fetched),
+        "delivered": int(delivered),
+        "fetched_per_course": (fetched / delivered) if delivered else float(fetched),
+        "rounds": rounds,
+    }
+    if selection is not None:
+        stats["eligible"] = selection.count
+    if timings is not None:
+        # time the batch spent in FAISS and in grouping, shared by its queries
+        stats["timings_ms"] = {k: round(v, 3) for k, v in timings.items()}
+    return stats
+
+
+def search_chunk_mode(q_embs: np.ndarray, tops, index, parent_idx: np.ndarray, min_k: int = 0,
+                      selection=None):
+    """
+    Adaptive chunk-level search for a batch of query vectors.
+    Returns one (row_ids, scores, stats) per query, best chunk per course in score order.
+    """
+    tops = np.asarray(tops, dtype="int64")
+    ntotal = selection.count if selection is not None else int(index.ntotal)
+    params = selection.search_params(index) if selection is not None else None
+    ks = np.minimum(np.maximum(tops * CHUNK_OVERFETCH, min_k), ntotal)
+    out = [None] * len(tops)
+    pending = np.arange(len(tops))
+    rounds = 0
+    timings = {"search": 0.0, "group": 0.0}
+    while len(pending):
+        rounds += 1
+        k = max(int(ks[pending].max()), 1)
+        t0 = time.perf_counter()
+        scores, idxs = index.search(q_embs[pending], k, params=params)
+        t1 = time.perf_counter()
+        groups = group_rows(idxs, parent_idx, int(tops[pending].max()))
+        timings["search"] += 1e3 * (t1 - t0)
+        timings["group"] += 1e3 * (time.perf_counter() - t1)
+        still = []
+        for row, q in enumerate(pending):
+            pos = groups[row][:tops[q]]
+            if len(pos) < tops[q] and k < ntotal:
+                ks[q] = min(ntotal, k * WIDEN_FACTOR)
+                still.append(q)
+            else:
+                out[q] = (idxs[row, pos], scores[row, pos], _stats("chunk", k, len(pos), rounds, selection, timings))
+        pending = np.asarray(still, dtype="int64")
+    return out
+
+
+def search_course_mode(q_embs: np.ndarray, tops, course_index, parent_rows: np.ndarray,
+                       selection=None):
+    """
+    Course-level search: one hit per course. Each course is represented by its
+    first chunk row for display. Returns one (row_ids, scores, stats) per query.
+    """
+    tops = np.asarray(tops, dtype="int64")
+    ntotal = selection.count if selection is not None else int(course_index.ntotal)
+    params = selection.search_params(course_index) if selection is not None else None
+    k = max(min(int(tops.max()), ntotal), 1)
+    t0 = time.perf_counter()
+    scores, parents = course_index.search(q_embs, k, params=params)
+    timings = {"search": 1e3 * (time.perf_counter() - t0)}
+    out = []
+    for row, top in enumerate(tops.tolist()):
+        valid = parents[row, :top]
+        valid = valid[valid >= 0]
+        out.append((parent_rows[valid], scores[row, :len(valid)], _stats("course", k, len(valid), 1, selection, timings)))
+    return out
+
+
+def search_courses(q_embs: np.ndarray, tops, index, store, mode: str = "chunk",
+                   course_index=None, min_k: int = 0, selection=None):
+    """
+    Dispatch a batch of normalized query vectors to the selected retrieval mode,
+    optionally restricted to the rows of a compiled filter.
+    """
+    q_embs = np.ascontiguousarray(q_embs, dtype="float32")
+    if mode == "course":
+        if course_index is None:
+            raise ValueError("course-level index not available; rebuild with build_index.py")
+        if selection is not None:
+            selection = selection.parent_selection(store.parent_idx)
+        return search_course_mode(q_embs, tops, course_index, store.parent_rows, selection)
+    if mode != "chunk":
+        raise ValueError(f"unknown retrieval mode '{mode}' (expected one of {', '.join(MODES)})")
+    return search_chunk_mode(q_embs, tops, index, store.parent_idx, min_k=min_k, selection=selection)
+
+
+class CoursePooler:
+    """
+    Incrementally pool chunk vectors into one vector per parent (mean or max),
+    so a streaming build never needs all chunk vectors at once.
+    """
+
+    def __init__(self, dim: int, pooling: str = "mean"):
+        if pooling not in ("mean", "max"):
+            raise ValueError(f"unknown pooling '{pooling}' (expected 'mean' or 'max')")
+        self.pooling = pooling
+        self.dim = dim
+        self._pooled = np.zeros((0, dim), dtype="float32")
+        self.n_parents = 0
+
+    def add(self, embs: np.ndarray, parent_codes: np.ndarray):
+        if not len(parent_codes):
+            return
+        need = int(parent_codes.max()) + 1
+        if need > len(self._pooled):
+            grown = np.full((max(need, 2 * len(self._pooled)), self.dim),
+                            0.0 if self.pooling == "mean" else -np.inf, dtype="float32")
+            grown[:len(self._pooled)] = self._pooled
+            self._pooled = grown
+        self.n_parents = max(self.n_parents, need)
+        if self.pooling == "mean":
+            np.add.at(self._pooled, parent_codes, embs)
+        else:
+            np.maximum.at(self._pooled, parent_codes, embs)
+
+    def finalize(self) -> np.ndarray:
+        """L2-normalized pooled vectors, row p == parent id p."""
+        pooled = self._pooled[:self.n_parents]
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (pooled / norms).astype("float32")
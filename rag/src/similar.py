@@ -0,0 +1,113 @@
+# rag/src/similar.py
+"""
+Precomputed "more like this": each course's nearest courses by pooled vector.
+
+build_index.py writes <index_dir>/similar/ from the course-level vectors:
+  similar.json      k and the number of courses
+  neighbors.npy     int32 (courses, k) parent ids of the k most similar courses, best first
+  scores.npy        float16 (courses, k) their cosine similarity
+
+The graph is computed with blocked matrix multiplies (BLOCK_ROWS x BLOCK_COLS
+similarities at a time, merged into a running top-k per row), so memory stays bounded
+however many courses there are. Answering "similar to course p" is reading row p.
+`diversify` optionally re-ranks the neighbors so one subject doesn't fill the list.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+SIMILAR_DIRNAME = "similar"
+SIMILAR_K = 20
+BLOCK_ROWS = 1024
+BLOCK_COLS = 8192
+DIVERSITY = 0.05  # default strength for diversify(): each same-subject pick scales the next by 0.95
+
+
+def knn_graph(vectors: np.ndarray, k: int = SIMILAR_K, block_rows: int = BLOCK_ROWS,
+              block_cols: int = BLOCK_COLS) -> tuple:
+    """(neighbors int32, scores float16) of the top-k inner products per row, excluding the row itself."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n = len(vectors)
+    k = max(0, min(k, n - 1))
+    neighbors = np.empty((n, k), dtype="int32")
+    scores = np.empty((n, k), dtype="float16")
+    if k == 0:
+        return neighbors, scores
+    for r0 in range(0, n, block_rows):
+        q = vectors[r0:r0 + block_rows]
+        best_s = np.full((len(q), k), -np.inf, dtype="float32")
+        best_i = np.full((len(q), k), -1, dtype="int64")
+        for c0 in range(0, n, block_cols):
+            sims = q @ vectors[c0:c0 + block_cols].T
+            lo, hi = max(r0, c0), min(r0 + len(q), c0 + sims.shape[1])
+            if lo < hi:   # the diagonal of this tile: a course is not its own neighbor
+                sims[np.arange(lo - r0, hi - r0), np.arange(lo - c0, hi - c0)] = -np.inf
+            kk = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            cand_s = np.concatenate([best_s, np.take_along_axis(sims, part, axis=1)], axis=1)
+            cand_i = np.concatenate([best_i, part + c0], axis=1)
+            keep = np.argpartition(-cand_s, k - 1, axis=1)[:, :k]
+            best_s = np.take_along_axis(cand_s, keep, axis=1)
+            best_i = np.take_along_axis(cand_i, keep, axis=1)
+        order = np.argsort(-best_s, axis=1, kind="stable")
+        neighbors[r0:r0 + len(q)] = np.take_along_axis(best_i, order, axis=1)
+        scores[r0:r0 + len(q)] = np.take_along_axis(best_s, order, axis=1)
+    return neighbors, scores
+
+
+def write_similarity_graph(vectors: np.ndarray, out_dir: Path, k: int = SIMILAR_K):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    neighbors, scores = knn_graph(vectors, k)
+    np.save(out_dir / "neighbors.npy", neighbors)
+    np.save(out_dir / "scores.npy", scores)
+    (out_dir / "similar.json").write_text(json.dumps({"k": neighbors.shape[1], "courses": len(neighbors)}))
+    size = (neighbors.nbytes + scores.nbytes) / 1e6
+    print(f"[build] similarity graph: {neighbors.shape[1]} neighbors for each of {len(neighbors):,} courses ({size:.1f} MB)")
+
+
+def diversify(ids: np.ndarray, scores: np.ndarray, subjects, top: int, strength: float = DIVERSITY) -> tuple:
+    """
+    Greedy re-rank of score-ordered neighbors: every course already picked from a
+    subject scales the scores of that subject's remaining ones by (1 - strength).
+    """
+    seen, picked, left = {}, [], list(range(len(ids)))
+    while left and len(picked) < top:
+        adjusted = [scores[j] * (1.0 - strength) ** seen.get(subjects[j], 0) for j in left]
+        j = left.pop(int(np.argmax(adjusted)))
+        seen[subjects[j]] = seen.get(subjects[j], 0) + 1
+        picked.append(j)
+    return ids[picked], scores[picked]
+
+
+class SimilarityGraph:
+    def __init__(self, neighbors: np.ndarray, scores: np.ndarray):
+        self.neighbors = neighbors
+        self.scores = scores
+        self.k = neighbors.shape[1]
+
+    @classmethod
+    def open(cls, graph_dir: Path) -> "SimilarityGraph":
+        graph_dir = Path(graph_dir)
+        return cls(np.load(graph_dir / "neighbors.npy", mmap_mode="r"), np.load(graph_dir / "scores.npy", mmap_mode="r"))
+
+    @classmethod
+    def load(cls, index_dir: Path, course_index=None) -> "SimilarityGraph":
+        """
+        Open <index_dir>/similar; indexes built without it get the graph computed from
+        the course-level index. None when there is no course-level index either.
+        """
+        graph_dir = Path(index_dir) / SIMILAR_DIRNAME
+        if (graph_dir / "similar.json").exists():
+            return cls.open(graph_dir)
+        if course_index is None:
+            return None
+        print(f"[similar] {graph_dir} not found; computing the similarity graph in memory (rebuild the index to persist it)")
+        return cls(*knn_graph(course_index.reconstruct_n(0, course_index.ntotal)))
+
+    def lookup(self, parent: int, top: int = None) -> tuple:
+        """(parent ids, scores as float32) of the `top` most similar courses."""
+        top = self.k if top is None else min(top, self.k)
+        ids = np.asarray(self.neighbors[parent, :top], dtype="int64")
+        return ids, np.asarray(self.scores[parent, :top], dtype="float32")
@@ -0,0 +1,70 @@
+# rag/src/workpool.py
+"""
+Worker pools for the streaming pipelines (build_index.py, bulk queries in query.py).
+
+`WorkerPool.submit(fn, *args)` runs fn in this process (workers <= 1), in a thread
+pool, or in a spawn process pool, and always hands back something with `.get()`.
+`finish_in_order` drives a lazily submitted stream: it keeps at most 2 jobs per
+worker in flight and finishes them strictly in submission order, so memory stays
+bounded and output order matches input order.
+"""
+import os
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.pool import ThreadPool
+
+POOLS = ("thread", "process")
+
+
+class Ready:
+    """An already computed result with the AsyncResult interface."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class WorkerPool:
+    def __init__(self, workers: int = 1, kind: str = "process", label: str = "pool"):
+        if kind not in POOLS:
+            raise ValueError(f"unknown pool '{kind}' (expected one of {', '.join(POOLS)})")
+        self.workers = workers
+        self.kind = kind
+        self.label = label
+        # split the cores between worker processes so their thread pools don't oversubscribe them
+        self.threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 and kind == "process" else 0
+        self._pool = None
+
+    def submit(self, fn, *args):
+        if self.workers <= 1:
+            return Ready(fn(*args))
+        if self._pool is None:
+            if self.kind == "thread":
+                self._pool = ThreadPool(self.workers)
+            else:
+                print(f"[{self.label}] starting {self.workers} worker processes ({self.threads} threads each)")
+                self._pool = get_context("spawn").Pool(self.workers)
+        return self._pool.apply_async(fn, args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def finish_in_order(submitted, finish, workers: int = 1):
+    """
+    Pull argument tuples from `submitted` (a generator that submits each job as it
+    yields it) and call finish(*args) in the same order, with at most 2 per worker pending.
+    """
+    in_flight = deque()
+    max_in_flight = max(1, 2 * workers)
+    for args in submitted:
+        in_flight.append(args)
+        while len(in_flight) >= max_in_flight:
+            finish(*in_flight.popleft())
+    while in_flight:
+        finish(*in_flight.popleft())
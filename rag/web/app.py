@@ -4,173 +4,607 @@ Provides a /query endpoint that accepts course-related questions
 and returns relevant course recommendations using the FAISS index.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 from pathlib import Path
+import hashlib
 import json
-import re
+import sys
+import threading
+import time
 
-import faiss
 import numpy as np
-import pandas as pd
-from sentence_transformers import SentenceTransformer
 import os
 
+from coalescer import QueryCoalescer
+from metrics import COUNT_BUCKETS, Counter, Gauge, Histogram, Registry, SamplingProfiler, server_timing
+
+# Shared retrieval helpers live next to the CLI in rag/src. faiss and
+# sentence_transformers (torch) are imported lazily in load_index so the
+# server can bind its port before they are loaded.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from expansion import SYNONYM_WEIGHT, QueryEncoder, expand_query
+from lexical import FUSE_DEPTH, LexicalIndex, SavingsMeter, normalize_code, rrf_fuse
+from metastore import MetaStore
+from query_cache import QueryCache, cache_key, index_version
+from retrieval import MODES, search_courses
+from similar import DIVERSITY, SimilarityGraph, diversify
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
-# Global variables for index and model
+# Global variables for index and model. They always come from one index directory
+# and are replaced together, under _state_lock, when an index is (re)loaded.
 index = None
-chunks_df = None
+course_index = None  # one pooled vector per course; None for indexes built without it
+store = None  # columnar chunk metadata, row i == FAISS id i
+filter_index = None  # precomputed metadata bitmaps for "filters"
+lexical = None  # course-code hash index + BM25 postings
+similar = None  # precomputed course-similarity neighbors for /similar; None without a course-level index
 model = None
+query_encoder = None  # `model` plus query expansion
 config = None
+index_dir = None
+version = None  # index version id (query_cache.index_version); ETags and cache entries carry it
 
-# Query expansion dictionary (same as query.py)
-TOPIC_SYNONYMS = {
-    r"\bnlp\b": [
-        "natural language processing", "computational linguistics",
-        "text mining", "language modeling", "transformers", "sequence models"
-    ],
-    r"\bml\b|\bmachine learning\b": [
-        "supervised learning", "unsupervised learning", "classification",
-        "regression", "neural networks", "support vector machines", "clustering"
-    ],
-    r"\bai\b": [
-        "artificial intelligence", "knowledge representation", "search algorithms",
-        "planning", "intelligent agents"
-    ],
-    r"\bdata viz\b|\bvisuali[sz]ation\b|\btableau\b": [
-        "data visualization", "tableau", "plotting", "dashboards", "visual analytics"
-    ],
-    r"\bstats?\b|\bstatistics\b": [
-        "statistical inference", "probability", "hypothesis testing",
-        "regression analysis", "experimental design"
-    ],
-    r"\boptimization\b|\boperations research\b|\bor\b": [
-        "linear programming", "integer programming", "stochastic optimization",
-        "operations research"
-    ],
-    r"\bcomputational biology\b|\bbioinformatics\b": [
-        "genomics", "sequence analysis", "biostatistics", "systems biology"
-    ],
-    r"\bsecurity\b|\bcybersecurity\b": [
-        "cryptography", "network security", "secure systems", "access control"
-    ],
-    r"\bdatabases?\b": [
-        "relational databases", "sql", "transaction processing", "query optimization"
-    ],
-    r"\beconomics?\b|\becon\b": [
-        "microeconomics", "macroeconomics", "econometrics"
-    ],
-    r"\bpsychology\b|\bcognitive\b": [
-        "cognitive science", "perception", "human factors", "behavioral science"
-    ],
-}
-
-def expand_query(q: str) -> str:
-    """Add synonyms/related phrases to the query while keeping the original text."""
-    q_low = q.lower()
-    expansions = []
-    for pattern, syns in TOPIC_SYNONYMS.items():
-        if re.search(pattern, q_low):
-            expansions.extend(syns)
-    if expansions:
-        return q + " | " + " ; ".join(dict.fromkeys(expansions))
-    return q
+_STATE_FIELDS = ("index_dir", "config", "version", "index", "course_index", "store",
+                 "filter_index", "lexical", "similar", "model", "query_encoder")
+_state_lock = threading.Lock()
 
-def load_index():
-    """Load FAISS index, chunks CSV, and embedding model on startup."""
-    global index, chunks_df, model, config
-    
-    # Determine index directory path (relative to this file)
+class IndexState:
+    """Everything loaded from one index directory; a reload swaps it in as a unit."""
+    __slots__ = _STATE_FIELDS
+
+    def __init__(self, **fields):
+        for name in _STATE_FIELDS:
+            setattr(self, name, fields.get(name))
+
+def current_state() -> IndexState:
+    """
+    Consistent snapshot of the live index. A request holds on to its snapshot, so it
+    finishes on the index it started with even if a reload swaps in a new one meanwhile.
+    """
+    with _state_lock:
+        live = globals()
+        return IndexState(**{name: live[name] for name in _STATE_FIELDS})
+
+def _install(state: IndexState):
+    with _state_lock:
+        globals().update({name: getattr(state, name) for name in _STATE_FIELDS})
+
+# Startup state for /healthz and /readyz: /query answers 503 until `ready` is set
+ready = threading.Event()
+startup = {"phase": "starting", "timings": {}, "error": None}
+
+# "chunk" (adaptive chunk search grouped by course) or "course" (course-level index)
+DEFAULT_MODE = os.environ.get("RAG_RETRIEVAL_MODE", "chunk")
+
+# Two-tier query cache (exact LRU + optional semantic near-duplicate tier).
+# RAG_CACHE_SIZE=0 disables it; set RAG_CACHE_SEMANTIC_THRESHOLD (e.g. 0.95) to
+# enable the semantic tier.
+_semantic_env = os.environ.get("RAG_CACHE_SEMANTIC_THRESHOLD")
+query_cache = QueryCache(
+    max_entries=int(os.environ.get("RAG_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.environ.get("RAG_CACHE_TTL", "3600")),
+    semantic_threshold=float(_semantic_env) if _semantic_env else None,
+)
+
+# Query expansion (rag/src/expansion.py): RAG_EXPANSION=string appends synonym phrases
+# to the text that is encoded; =embedding encodes only the query and blends in
+# precomputed synonym vectors (weight RAG_EXPANSION_WEIGHT).
+EXPANSION = os.environ.get("RAG_EXPANSION", "string")
+EXPANSION_WEIGHT = float(os.environ.get("RAG_EXPANSION_WEIGHT", str(SYNONYM_WEIGHT)))
+
+# RAG_INDEX_MMAP=1 maps the FAISS vectors from disk instead of copying them onto the
+# heap, so every gunicorn worker (and the page cache) shares a single copy.
+INDEX_MMAP = os.environ.get("RAG_INDEX_MMAP", "0") == "1"
+
+def pin_threads(n: int):
+    """Cap torch intra-op and FAISS OpenMP threads so workers don't oversubscribe cores."""
+    import faiss
+    from encoders import OnnxEncoder
+    faiss.omp_set_num_threads(n)
+    if not isinstance(model, OnnxEncoder):   # onnxruntime sizes its own pool (encoders.py)
+        import torch
+        torch.set_num_threads(n)
+
+def _phase(name: str, t0: float, status: dict = startup) -> float:
+    """Record how long phase `name` took (startup or a reload); returns the start of the next one."""
+    now = time.perf_counter()
+    status["timings"][name] = round(now - t0, 3)
+    return now
+
+def default_index_dir() -> Path:
+    """RAG_INDEX_DIR, else relative to this file."""
     base_path = Path(__file__).resolve().parent
-    index_dir = base_path / "data" / "processed" / "index"
+    return Path(os.environ.get("RAG_INDEX_DIR") or base_path / "data" / "processed" / "index")
+
+def _same_encoder(old_cfg: dict, new_cfg: dict) -> bool:
+    return old_cfg.get("model") == new_cfg.get("model") and old_cfg.get("encoder") == new_cfg.get("encoder")
+
+def _load_state(index_dir: Path, status: dict = startup, reuse: IndexState = None) -> IndexState:
+    """
+    Load FAISS index, columnar chunk metadata, and embedding model from `index_dir`.
+    The encoder of `reuse` (the live index) is kept when config.json names the same one.
+    """
+    status["phase"] = "import"
+    t0 = time.perf_counter()
+    from ann import apply_search_params, read_index
+    from encoders import load_encoder
+    from filters import FilterIndex
+    t0 = _phase("import", t0, status)
     
-    idx_path = index_dir / "faiss.index"
-    tbl_path = index_dir / "chunks.csv"
-    cfg_path = index_dir / "config.json"
+    # Follow a symlinked index directory (build_index.py publishes that way) once, so every
+    # file comes from the same build even if the link is switched while this one loads
+    src = Path(index_dir).resolve()
+    idx_path = src / "faiss.index"
+    tbl_path = src / "chunks.csv"   # CSV export; meta/ is preferred when present
+    meta_path = src / "meta" / "meta.json"
+    cfg_path = src / "config.json"
     
-    if not idx_path.exists() or not tbl_path.exists() or not cfg_path.exists():
+    has_table = tbl_path.exists() or meta_path.exists()
+    if not idx_path.exists() or not has_table or not cfg_path.exists():
         print(f"[app] Missing index files in {index_dir}")
         raise FileNotFoundError(f"Missing index files in {index_dir}")
     
-    print(f"[app] Loading index from {index_dir}...")
-    index = faiss.read_index(str(idx_path))
-    chunks_df = pd.read_csv(tbl_path)
-    config = json.loads(cfg_path.read_text())
-    model = SentenceTransformer(config["model"])
-    print(f"[app] Loaded index with {len(chunks_df):,} chunks")
-
-def retrieve_and_group(query: str, top_courses: int = 8):
-    """Retrieve top courses based on query using RAG."""
+    print(f"[app] Loading index from {index_dir}" + (f" ({src})" if src != Path(index_dir) else "") + "...")
+    status["phase"] = "index read"
+    cfg = json.loads(cfg_path.read_text())
+    idx = read_index(idx_path, mmap=INDEX_MMAP)
+    apply_search_params(idx, cfg.get("index"))   # nprobe / efSearch recorded at build time
+    course_cfg = cfg.get("course_index") or {}
+    course_path = src / course_cfg.get("file", "courses.faiss")
+    courses = read_index(course_path, mmap=INDEX_MMAP) if course_path.exists() else None
+    if courses is None:
+        print("[app] No course-level index found; only 'chunk' mode is available")
+    t0 = _phase("index read", t0, status)
     
-    if index is None or model is None:
+    status["phase"] = "metadata load"
+    meta = MetaStore.load(src)
+    filters = FilterIndex.load(src, meta)
+    lex = LexicalIndex.load(src, meta)
+    neighbors = SimilarityGraph.load(src, courses)
+    t0 = _phase("metadata load", t0, status)
+    
+    status["phase"] = "model load"
+    if reuse is not None and reuse.model is not None and _same_encoder(reuse.config, cfg):
+        encoder, qe = reuse.model, reuse.query_encoder
+    else:
+        encoder = load_encoder(cfg, src)   # config.json "encoder" backend, else SentenceTransformer
+        qe = QueryEncoder(encoder, EXPANSION, EXPANSION_WEIGHT)
+    _phase("model load", t0, status)
+    return IndexState(index_dir=index_dir, config=cfg, version=index_version(cfg, idx_path), index=idx,
+                      course_index=courses, store=meta, filter_index=filters, lexical=lex,
+                      similar=neighbors, model=encoder, query_encoder=qe)
+
+def load_index():
+    """Load FAISS index, columnar chunk metadata, and embedding model on startup."""
+    from ann import describe
+    state = _load_state(default_index_dir())
+    _install(state)
+    query_cache.set_version(state.version)
+    print(f"[app] Loaded {describe(config.get('index'))} index with {len(store):,} chunks (version {version})")
+
+def warm_up(state: IndexState = None, status: dict = startup):
+    """One encode and one search per available path, so the first real query isn't the slow one."""
+    st = state or current_state()
+    status["phase"] = "warm-up"
+    t0 = time.perf_counter()
+    q_emb = st.query_encoder.prepare().embed(["warm up"])
+    for mode in MODES:
+        if mode != "course" or st.course_index is not None:
+            search_courses(q_emb, [8], st.index, st.store, mode=mode, course_index=st.course_index)
+    if st.lexical is not None:
+        st.lexical.search("warm up", 8, st.store.parent_idx)
+    _phase("warm-up", t0, status)
+
+def _mark_ready():
+    timings = startup["timings"]
+    startup["phase"] = "ready"
+    ready.set()
+    print("[app] ready: " + " | ".join(f"{k} {v:.2f}s" for k, v in timings.items())
+          + f" | total {sum(timings.values()):.2f}s")
+
+def load_and_warm_up(load: bool = True):
+    """Startup sequence (run in a background thread): load, warm up, then accept queries."""
+    try:
+        if load:
+            load_index()
+        elif index is None:
+            raise RuntimeError(startup["error"] or "index was not loaded")
+        warm_up()
+        _mark_ready()
+    except Exception as e:
+        startup["phase"] = "failed"
+        startup["error"] = str(e)
+        print(f"[app] Failed to load index: {e}")
+
+def start_background_load(load: bool = True):
+    """Start the startup sequence without blocking; the server can bind meanwhile."""
+    thread = threading.Thread(target=load_and_warm_up, args=(load,), name="rag-startup", daemon=True)
+    thread.start()
+    if RELOAD_WATCH_S > 0:
+        threading.Thread(target=_watch_index, args=(RELOAD_WATCH_S,), name="rag-index-watch", daemon=True).start()
+    return thread
+
+# ----------------------------
+# Hot reload: load a new index directory next to the live one, validate it, swap it in
+# ----------------------------
+# RAG_RELOAD_WATCH=<seconds> polls RAG_INDEX_DIR and reloads when its config.json changes
+# or the path is re-pointed to another directory, which is how build_index.py publishes.
+RELOAD_WATCH_S = float(os.environ.get("RAG_RELOAD_WATCH", "0"))
+reload_status = {"phase": "idle", "timings": {}, "error": None, "index_dir": None,
+                 "version": None, "previous_version": None, "finished": None}
+_reload_lock = threading.Lock()
+
+def _validate(st: IndexState):
+    """Refuse an index the encoder can't query, whose metadata doesn't match, or that finds nothing."""
+    dim = int(st.query_encoder.embed(["smoke test"]).shape[1])
+    dims = {"faiss.index": st.index.d, "config.json": st.config.get("dim", st.index.d)}
+    if st.course_index is not None:
+        dims["course index"] = st.course_index.d
+    wrong = {name: d for name, d in dims.items() if int(d) != dim}
+    if wrong:
+        raise ValueError(f"encoder {st.config.get('model')} produces {dim}-d vectors, but {wrong}")
+    if len(st.store) != st.index.ntotal:
+        raise ValueError(f"metadata has {len(st.store):,} rows but the index has {st.index.ntotal:,} vectors")
+    if st.similar is not None and len(st.similar.neighbors) != len(st.store.parent_rows):
+        raise ValueError(f"similarity graph covers {len(st.similar.neighbors):,} courses, "
+                         f"metadata has {len(st.store.parent_rows):,}")
+    q_emb = st.query_encoder.embed(["introduction to machine learning"])
+    row_ids, _, _ = search_courses(q_emb, [8], st.index, st.store, course_index=st.course_index)[0]
+    if not len(row_ids):
+        raise ValueError("smoke query returned no courses")
+
+def _reload(new_dir: Path):
+    live = current_state()
+    try:
+        print(f"[app] Reloading index from {new_dir} (serving version {live.version} meanwhile)")
+        st = _load_state(new_dir, reload_status, reuse=live)
+        if st.version == live.version and st.index_dir == live.index_dir:
+            reload_status.update(phase="unchanged", version=st.version, finished=time.time())
+            print(f"[app] Index in {new_dir} is already live (version {st.version})")
+            return
+        reload_status["phase"] = "validate"
+        t0 = time.perf_counter()
+        _validate(st)
+        _phase("validate", t0, reload_status)
+        warm_up(st, reload_status)
+        _install(st)
+        query_cache.set_version(st.version)
+        if not ready.is_set():   # a reload also recovers from a failed startup
+            startup.update(phase="ready", error=None)
+            ready.set()
+        reload_status.update(phase="done", version=st.version, previous_version=live.version, finished=time.time())
+        print(f"[app] Swapped in version {st.version} from {new_dir} (was {live.version}): "
+              + " | ".join(f"{k} {v:.2f}s" for k, v in reload_status["timings"].items()))
+    except Exception as e:
+        reload_status.update(phase="failed", error=str(e), finished=time.time())
+        print(f"[app] Reload from {new_dir} failed, still serving version {live.version}: {e}")
+    finally:
+        _reload_lock.release()
+
+def reload_index(new_dir: Path) -> bool:
+    """Start a background reload of `new_dir`; False if one is already running."""
+    if not _reload_lock.acquire(blocking=False):
+        return False
+    reload_status.update(phase="starting", timings={}, error=None, index_dir=str(new_dir),
+                         version=None, previous_version=None, finished=None)
+    threading.Thread(target=_reload, args=(Path(new_dir),), name="rag-reload", daemon=True).start()
+    return True
+
+def _index_signature(path: Path):
+    try:
+        st = (path / "config.json").stat()
+    except OSError:
+        return None
+    return str(path.resolve()), st.st_mtime_ns, st.st_size
+
+def _watch_index(interval: float):
+    path = default_index_dir()
+    seen = _index_signature(path)
+    while True:
+        time.sleep(interval)
+        sig = _index_signature(path)
+        if sig is None or sig == seen or not ready.is_set():
+            continue
+        time.sleep(interval)   # let the writer finish before reading
+        if _index_signature(path) == sig and reload_index(path):
+            seen = sig
+
+def _materialize(row_ids, row_scores, meta=None):
+    """Build result dicts for already-grouped hits straight from the columnar store."""
+    meta = meta if meta is not None else store
+    return [
+        {
+            "course_code": meta.get("metadata.course_code", i),
+            "class_name": meta.get("metadata.class_name", i),
+            "subject": meta.get("metadata.subject", i) or meta.get("metadata.subject_code", i),
+            "description": meta.get("text", i),
+            "score": float(score)
+        }
+        for i, score in zip(row_ids.tolist(), row_scores.tolist())
+    ]
+
+# Fuse BM25 with the vector results (reciprocal rank fusion); RAG_HYBRID=0 turns it off.
+# Course-code lookups ("CS 412 prerequisites") are always answered from the code index.
+HYBRID = os.environ.get("RAG_HYBRID", "1") != "0"
+vector_cost = SavingsMeter()  # per-query encode + search time, to report what the code path saved
+
+# ----------------------------
+# Metrics: /metrics (Prometheus text), Server-Timing on /query, sampling profiler
+# ----------------------------
+metrics = Registry()
+REQUESTS = metrics.register(Counter("rag_requests_total", "HTTP requests by endpoint and status code", ("endpoint", "code")))
+ERRORS = metrics.register(Counter("rag_errors_total", "Requests that failed with an unexpected error", ("endpoint",)))
+QUERY_PATHS = metrics.register(Counter("rag_queries_total", "Queries by how they were answered (code, cache, hybrid, vector)", ("path",)))
+CACHE_HITS = metrics.register(Counter("rag_cache_hits_total", "Query cache hits by tier (exact, semantic)", ("tier",)))
+REQUEST_SECONDS = metrics.register(Histogram("rag_request_seconds", "Request latency by endpoint", ("endpoint",)))
+STAGE_SECONDS = metrics.register(Histogram("rag_stage_seconds", "Time a query spent in each retrieval stage", ("stage",)))
+RESULT_COUNT = metrics.register(Histogram("rag_result_count", "Courses returned per query", buckets=COUNT_BUCKETS))
+metrics.register(Gauge("rag_ready", "1 once the index is loaded and warmed up", ready.is_set))
+profiler = SamplingProfiler()
+
+def _observe(results, stats):
+    """Record one answered query: its path, cache tier, result count and stage timings."""
+    QUERY_PATHS.inc(path=stats.get("path", ""))
+    if stats.get("cache"):
+        CACHE_HITS.inc(tier=stats["cache"])
+    RESULT_COUNT.observe(len(results))
+    for stage, ms in stats.get("timings_ms", {}).items():
+        STAGE_SECONDS.observe(ms / 1e3, stage=stage)
+
+def _code_lookup(st, query: str, top_courses: int, selection):
+    """Answer a query that only names course codes from the hash index; None otherwise."""
+    t0 = time.perf_counter()
+    rows = st.lexical.code_match(query) if st.lexical is not None else None
+    if rows is None:
+        return None
+    rows = np.asarray(rows, dtype="int64")
+    if selection is not None:
+        mask = np.unpackbits(selection.bits, count=selection.n_rows, bitorder="little")
+        rows = rows[mask[rows] == 1]
+    rows = rows[:top_courses]
+    results = _materialize(rows, np.ones(len(rows), dtype="float32"), st.store)
+    elapsed = 1e3 * (time.perf_counter() - t0)
+    return results, {"path": "code", "delivered": len(results), "elapsed_ms": round(elapsed, 3),
+                     "saved_ms": vector_cost.saved(elapsed), "timings_ms": {"code": round(elapsed, 3)}}
+
+def _fuse(st, i, expanded, items, row_ids, row_scores, stats):
+    """RRF of one item's vector hits with its BM25 hits; returns (row_ids, scores, stats)."""
+    _, top_courses, _, selection = items[i]
+    t0 = time.perf_counter()
+    bm25_ids, _ = st.lexical.search(expanded[i], top_courses * FUSE_DEPTH, st.store.parent_idx, selection)
+    t1 = time.perf_counter()
+    fused_ids, fused_scores = rrf_fuse([row_ids, bm25_ids], st.store.parent_idx, top_courses)
+    t2 = time.perf_counter()
+    timings = dict(stats.get("timings_ms", {}), bm25=round(1e3 * (t1 - t0), 3), fuse=round(1e3 * (t2 - t1), 3))
+    stats = dict(stats, path="hybrid", delivered=len(fused_ids), vector_candidates=len(row_ids),
+                 bm25_candidates=len(bm25_ids), bm25_ms=round(1e3 * (t2 - t0), 3), timings_ms=timings)
+    return fused_ids, fused_scores, stats
+
+def retrieve_batch(items):
+    """
+    Retrieve top courses for many (query, top_courses, mode, selection) items at once.
+    `selection` is a compiled filter (or None). Returns one (results, stats) pair
+    per item. Course-code queries are answered from the code index and cached
+    answers are served next; the rest share one batched encode and one search
+    per (mode, filter), fused with BM25 when HYBRID is on. Each item's
+    stats["timings_ms"] has the stages it went through (batch-wide stages such as
+    encode and search are the batch's time, not a share of it). The whole batch runs
+    on one snapshot of the index (see current_state), whose version is in stats.
+    """
+    st = current_state()
+    if st.index is None or st.query_encoder is None:
+        return [([], {}) for _ in items]
+    if not items:
         return []
+    items = [(q, top, mode, _rebind(sel, st)) for q, top, mode, sel in items]
+    out = [None] * len(items)
+    for i, (q, top_courses, _, selection) in enumerate(items):
+        out[i] = _code_lookup(st, q, top_courses, selection)
     
-    # Expand query
-    q_expanded = expand_query(query)
-    
-    # Encode and search
-    q_emb = model.encode([q_expanded], normalize_embeddings=True).astype("float32")
-    chunk_k = max(50, top_courses * 5)
-    scores, idxs = index.search(q_emb, chunk_k)
-    idxs = idxs[0].tolist()
-    scores = scores[0].tolist()
-    
-    # Get matching chunks
-    res_df = chunks_df.iloc[idxs].copy()
-    res_df.insert(0, "score", scores)
-    
-    # Group by course (parent_id) and get best chunk per course
-    if "metadata.parent_id" not in res_df.columns:
-        res_df["metadata.parent_id"] = res_df["id"]
-    
-    best = (
-        res_df
-        .sort_values("score", ascending=False)
-        .drop_duplicates(subset=["metadata.parent_id"], keep="first")
-        .copy()
-    )
-    
-    top = best.head(top_courses).copy()
-    
-    # Extract fields safely
-    def safe_get(row, col, default=""):
-        val = row.get(col, default)
-        return str(val) if pd.notna(val) else default
-    
-    results = []
-    for _, row in top.iterrows():
-        course_code = safe_get(row, "metadata.course_code")
-        class_name = safe_get(row, "metadata.class_name")
-        subject = safe_get(row, "metadata.subject") or safe_get(row, "metadata.subject_code")
-        text = safe_get(row, "text")
-        score = float(row["score"]) if "score" in row else 0.0
-        
-        results.append({
-            "course_code": course_code,
-            "class_name": class_name,
-            "subject": subject,
-            "description": text,
-            "score": score
-        })
+    # Expand queries (BM25 and cache keys use the expanded text) and consult the
+    # exact cache tier (keys are per mode and filter)
+    t0 = time.perf_counter()
+    expanded = [expand_query(q) for q, _, _, _ in items]
+    expand_ms = 1e3 * (time.perf_counter() - t0)
+    timings = [{"expand": expand_ms} for _ in items]
+    spaces = [mode if sel is None else f"{mode}|{sel.key}" for _, _, mode, sel in items]
+    keys = [f"{space}|{cache_key(q)}" for q, space in zip(expanded, spaces)]
+    embs = [None] * len(items)
+    for i, (key, (_, top_courses, mode, _)) in enumerate(zip(keys, items)):
+        if out[i] is not None:
+            continue
+        t0 = time.perf_counter()
+        results, embs[i] = query_cache.lookup(key, top_courses)
+        timings[i]["cache"] = 1e3 * (time.perf_counter() - t0)
+        if results is not None:
+            out[i] = (results, {"path": "cache", "mode": mode, "cache": "exact"})
     
-    return results
+    # Encode only the queries without a cached embedding
+    to_encode = [i for i in range(len(items)) if out[i] is None and embs[i] is None]
+    encode_ms = 0.0
+    if to_encode:
+        t0 = time.perf_counter()
+        new_embs = st.query_encoder.embed([items[i][0] for i in to_encode])
+        batch_ms = 1e3 * (time.perf_counter() - t0)
+        encode_ms = batch_ms / len(to_encode)
+        for i, emb in zip(to_encode, new_embs):
+            embs[i] = emb
+            timings[i]["encode"] = batch_ms
+    
+    # Semantic tier: reuse results of a near-duplicate cached query
+    pending = []
+    for i, (_, top_courses, mode, _) in enumerate(items):
+        if out[i] is None:
+            t0 = time.perf_counter()
+            results = query_cache.lookup_semantic(embs[i], top_courses, namespace=spaces[i])
+            timings[i]["cache"] += 1e3 * (time.perf_counter() - t0)
+            if results is not None:
+                out[i] = (results, {"path": "cache", "mode": mode, "cache": "semantic"})
+            else:
+                pending.append(i)
+    
+    # One batched search per (retrieval mode, filter)
+    hybrid = HYBRID and st.lexical is not None
+    for space in sorted({spaces[i] for i in pending}):
+        rows = [i for i in pending if spaces[i] == space]
+        _, _, mode, selection = items[rows[0]]
+        q_embs = np.vstack([embs[i] for i in rows])
+        # hybrid ranking fuses deeper candidate lists than it returns
+        tops = [items[i][1] * (FUSE_DEPTH if hybrid else 1) for i in rows]
+        t0 = time.perf_counter()
+        hits = search_courses(q_embs, tops, st.index, st.store,
+                              mode=mode, course_index=st.course_index, selection=selection)
+        if to_encode:
+            vector_cost.observe(encode_ms + 1e3 * (time.perf_counter() - t0) / len(rows))
+        for i, (row_ids, row_scores, stats) in zip(rows, hits):
+            stats = dict(stats, timings_ms=dict(timings[i], **stats.get("timings_ms", {})))
+            if hybrid:
+                row_ids, row_scores, stats = _fuse(st, i, expanded, items, row_ids, row_scores, stats)
+            else:
+                stats = dict(stats, path="vector")
+            t0 = time.perf_counter()
+            results = _materialize(row_ids, row_scores, st.store)
+            stats["timings_ms"]["materialize"] = 1e3 * (time.perf_counter() - t0)
+            out[i] = (results, stats)
+            query_cache.put(keys[i], embs[i], results, items[i][1], namespace=space, version=st.version)
+    
+    for i, (results, stats) in enumerate(out):
+        if stats.get("path") == "cache":
+            stats["timings_ms"] = timings[i]
+        stats["timings_ms"] = {k: round(v, 3) for k, v in stats["timings_ms"].items()}
+        stats["version"] = st.version
+        _observe(results, stats)
+    return out
+
+def retrieve_and_group(query: str, top_courses: int = 8, mode: str = None, filters: dict = None):
+    """Retrieve top courses based on query using RAG."""
+    return retrieve_batch([(query, top_courses, mode or DEFAULT_MODE, _parse_filters(filters))])[0][0]
+
+# Requests arriving within RAG_BATCH_WINDOW_MS of each other (up to RAG_BATCH_MAX)
+# share one encode + search. A window of 0 disables coalescing.
+BATCH_WINDOW_MS = float(os.environ.get("RAG_BATCH_WINDOW_MS", "5"))
+BATCH_MAX = int(os.environ.get("RAG_BATCH_MAX", "32"))
+coalescer = QueryCoalescer(retrieve_batch, window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX)
+
+def _parse_mode(value):
+    mode = value or DEFAULT_MODE
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if mode == "course" and course_index is None:
+        raise ValueError("course mode needs an index built with a course-level index")
+    return mode
+
+def _rebind(selection, st):
+    """
+    A filter compiled against one index is only valid for that index: recompile it
+    for `st` (a cache hit unless a reload swapped the index since it was parsed).
+    """
+    if selection is None:
+        return None
+    if st.filter_index is None:
+        raise ValueError("filters are not available for this index")
+    return st.filter_index.compile(json.loads(selection.key))
+
+def _parse_filters(value):
+    """Compile a "filters" object into a row selection (None = no filtering)."""
+    if not value:
+        return None
+    if filter_index is None:
+        raise ValueError("filters are not available for this index")
+    return filter_index.compile(value)
+
+# Process settings that change the results for the same index and query
+_RESULT_SETTINGS = [EXPANSION, EXPANSION_WEIGHT, HYBRID]
+
+def _etag(index_ver, item) -> str:
+    """ETag of a /query answer: the index version plus a digest of the normalized request."""
+    q, top_courses, mode, selection = item
+    request_key = json.dumps([_RESULT_SETTINGS, cache_key(q), top_courses, mode, selection.key if selection else None])
+    return f"{index_ver}-{hashlib.blake2b(request_key.encode(), digest_size=8).hexdigest()}"
+
+def _query_args():
+    """GET /query parameters in the POST body's shape ("filters" is a JSON string)."""
+    data = {k: request.args[k] for k in ("query", "top_courses", "mode") if k in request.args}
+    if "filters" in request.args:
+        try:
+            data["filters"] = json.loads(request.args["filters"])
+        except ValueError:
+            raise ValueError("'filters' must be a JSON object")
+    return data
+
+def _parse_top_courses(value, default=8):
+    try:
+        top_courses = int(value if value is not None else default)
+    except (TypeError, ValueError):
+        top_courses = 0
+    if top_courses < 1:
+        raise ValueError("'top_courses' must be a positive integer")
+    return top_courses
+
+@app.before_request
+def _start_timer():
+    g.t_start = time.perf_counter()
+
+@app.after_request
+def _count_request(response):
+    # Label by route pattern, not raw path, so unknown URLs can't blow up the label set
+    endpoint = request.url_rule.rule if request.url_rule is not None else "other"
+    REQUESTS.inc(endpoint=endpoint, code=str(response.status_code))
+    if "t_start" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.t_start, endpoint=endpoint)
+    return response
+
+def _admin_allowed() -> bool:
+    """Admin/debug routes: need X-Admin-Token when RAG_ADMIN_TOKEN is set, else a loopback client."""
+    token = os.environ.get("RAG_ADMIN_TOKEN")
+    if token:
+        return request.headers.get("X-Admin-Token") == token
+    return request.remote_addr in ("127.0.0.1", "::1")
 
 @app.route("/")
 def home():
     """Health check endpoint."""
     return jsonify({"status": "ok", "message": "Schedule Sculptor RAG API is running"})
 
-@app.route("/query", methods=["POST"])
+@app.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving HTTP (the index may still be loading)."""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: index and model loaded and warmed up; 503 (with the current phase) until then."""
+    body = {"ready": ready.is_set(), "phase": startup["phase"], "timings": startup["timings"], "version": version}
+    if startup["error"]:
+        body["error"] = startup["error"]
+    return jsonify(body), 200 if ready.is_set() else 503
+
+def _not_ready():
+    msg = f"Index failed to load: {startup['error']}" if startup["error"] else f"Index is loading ({startup['phase']})"
+    return jsonify({"error": msg, "phase": startup["phase"]}), 503
+
+@app.route("/query", methods=["GET", "POST"])
 def query():
     """
     Query endpoint that accepts a question and returns relevant courses.
+    GET takes the same fields as query parameters (filters as a JSON string).
     
     Expected JSON body:
     {
         "query": "courses about machine learning",
-        "top_courses": 8  // optional, default 8
+        "top_courses": 8,  // optional, default 8
+        "mode": "chunk",   // optional: "chunk" or "course"
+        "filters": {       // optional, all fields optional and AND-ed
+            "subject_code": "CS",          // or ["CS", "MATH"]
+            "level": 400,                  // or [300, 400]
+            "credits": 3,                  // or {"min": 3, "max": 4}
+            "has_prereqs": false,
+            "has_coreqs": false,
+            "eligible_with": ["CS 141"]    // only courses these completed courses make eligible
+        }
     }
     
     Returns:
@@ -185,40 +619,352 @@ def query():
                 "score": 0.85
             },
             ...
-        ]
+        ],
+        "stats": {"mode": "chunk", "fetched": 16, "delivered": 8, ...},
+        "version": "9c2da76c1eb2"  // index version that answered
     }
+    
+    The ETag is the index version plus a digest of the request: a client that sends
+    it back in If-None-Match gets 304 without a search while the index is unchanged.
+    The Server-Timing response header breaks the request down by stage (ms);
+    "retrieve" is the whole retrieval including any coalescing wait.
     """
+    if not ready.is_set():
+        return _not_ready()
     try:
-        data = request.get_json()
+        try:
+            data = request.get_json() if request.method == "POST" else _query_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         if not data or "query" not in data:
             return jsonify({"error": "Missing 'query' field in request"}), 400
         
         user_query = data["query"]
-        top_courses = data.get("top_courses", 8)
+        try:
+            top_courses = _parse_top_courses(data.get("top_courses"))
+            mode = _parse_mode(data.get("mode"))
+            selection = _parse_filters(data.get("filters"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         if not user_query.strip():
             return jsonify({"error": "Query cannot be empty"}), 400
         
-        # Retrieve courses
-        results = retrieve_and_group(user_query, top_courses)
+        item = (user_query, top_courses, mode, selection)
+        etag = _etag(version, item)
+        if request.if_none_match.contains_weak(etag):
+            QUERY_PATHS.inc(path="not-modified")
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Retrieve courses (coalesced with concurrent requests when enabled)
+        t0 = time.perf_counter()
+        if BATCH_WINDOW_MS > 0:
+            results, stats = coalescer.submit(item)
+        else:
+            results, stats = retrieve_batch([item])[0]
+        t1 = time.perf_counter()
         
-        return jsonify({
+        index_ver = stats.pop("version", version)
+        response = jsonify({
             "query": user_query,
             "results": results,
-            "count": len(results)
+            "count": len(results),
+            "stats": stats,
+            "version": index_ver
         })
+        response.set_etag(etag if index_ver == version else _etag(index_ver, item))
+        response.headers["Cache-Control"] = "no-cache"   # revalidate with If-None-Match
+        timings = dict(stats.get("timings_ms", {}), retrieve=1e3 * (t1 - t0))
+        timings["serialize"] = 1e3 * (time.perf_counter() - t1)
+        timings["total"] = 1e3 * (time.perf_counter() - g.t_start)
+        STAGE_SECONDS.observe(timings["serialize"] / 1e3, stage="serialize")
+        response.headers["Server-Timing"] = server_timing(timings)
+        response.headers["Timing-Allow-Origin"] = "*"   # the frontend is served from another origin
+        return response
     
     except Exception as e:
-        print(f"[app] Error processing query: {e}")
+        ERRORS.inc(endpoint="/query")
+        app.logger.exception("[app] Error processing query")
         return jsonify({"error": str(e)}), 500
 
-if __name__ == "__main__":
+@app.route("/query_batch", methods=["POST"])
+def query_batch():
+    """
+    Batch query endpoint: many queries in one POST, one encode + one search.
+    
+    Expected JSON body:
+    {
+        "queries": ["machine learning", {"query": "nlp", "top_courses": 3, "mode": "course",
+                                         "filters": {"subject_code": "CS"}}],
+        "top_courses": 8,  // optional default for plain-string entries
+        "mode": "chunk",   // optional default mode
+        "filters": {...}   // optional default filters (same format as /query)
+    }
+    
+    Returns:
+    {
+        "responses": [{"query": "...", "results": [...], "count": N, "stats": {...}}, ...],
+        "count": 2,
+        "version": "9c2da76c1eb2"
+    }
+    """
+    if not ready.is_set():
+        return _not_ready()
     try:
-        load_index()
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get("queries"), list):
+            return jsonify({"error": "Missing 'queries' list in request"}), 400
+        
+        items = []
+        try:
+            default_top = _parse_top_courses(data.get("top_courses"))
+            default_mode = _parse_mode(data.get("mode"))
+            default_selection = _parse_filters(data.get("filters"))
+            for entry in data["queries"]:
+                if isinstance(entry, dict):
+                    q = entry.get("query", "")
+                    top_courses = _parse_top_courses(entry.get("top_courses"), default_top)
+                    mode = _parse_mode(entry.get("mode") or default_mode)
+                    selection = _parse_filters(entry["filters"]) if "filters" in entry else default_selection
+                else:
+                    q, top_courses, mode, selection = entry, default_top, default_mode, default_selection
+                items.append((q, top_courses, mode, selection))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        for q, _, _, _ in items:
+            if not isinstance(q, str) or not q.strip():
+                return jsonify({"error": "Every query must be a non-empty string"}), 400
+        
+        batch_results = retrieve_batch(items)
+        versions = {stats.pop("version", version) for _, stats in batch_results}
+        responses = [
+            {"query": q, "results": res, "count": len(res), "stats": stats}
+            for (q, _, _, _), (res, stats) in zip(items, batch_results)
+        ]
+        return jsonify({"responses": responses, "count": len(responses),
+                        "version": versions.pop() if versions else version})
+    
     except Exception as e:
-        print(f"[app] Failed to load index: {e}")
-        index = chunks_df = model = config = None
+        ERRORS.inc(endpoint="/query_batch")
+        app.logger.exception("[app] Error processing batch query")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/prereqs", methods=["POST"])
+def prereqs():
+    """
+    Prerequisite planning from the precomputed graph (rag/src/prereqs.py).
+    
+    Expected JSON body:
+    {
+        "completed": ["CS 111", "CS 141"],  // courses the student has passed
+        "target": "CS 412",                 // optional
+        "list_eligible": true               // optional, default true
+    }
+    
+    Returns:
+    {
+        "eligible": ["AAST 100", ...],    // every course the student can take now
+        "eligible_count": 3670,
+        "unlocked": ["CS 151", ...],      // the eligible ones that have prerequisites
+        "coreqs": {"CHEM 122": ["CHEM 123"]},  // corequisites still to take alongside
+        "unknown": ["XYZ 999"],           // completed codes the graph doesn't know
+        "target": {
+            "course_code": "CS 412", "completed": false, "eligible": false,
+            "missing": ["CS 251", "CS 301", "CS 412"],
+            "steps": [["CS 251", "CS 301"], ["CS 412"]],  // earliest term for each
+            "longest_path": ["CS 301", "CS 412"],  // longest remaining prereq chain
+            "terms": 2,
+            "blocked": []                 // courses stuck on a prerequisite cycle
+        },
+        "elapsed_us": 85.2,
+        "version": "9c2da76c1eb2"
+    }
+    """
+    if not ready.is_set():
+        return _not_ready()
+    try:
+        st = current_state()
+        graph = st.filter_index.prereqs if st.filter_index is not None else None
+        if graph is None:
+            return jsonify({"error": "the prerequisite graph is not available for this index"}), 400
+        data = request.get_json(silent=True) or {}
+        completed = data.get("completed", [])
+        if not isinstance(completed, list) or not all(isinstance(c, str) for c in completed):
+            return jsonify({"error": "'completed' must be a list of course codes"}), 400
+        target = data.get("target")
+        if target is not None and not isinstance(target, str):
+            return jsonify({"error": "'target' must be a course code"}), 400
+        
+        t0 = time.perf_counter()
+        done, unknown = graph.resolve(completed)
+        eligible = graph.eligible_mask(done)
+        unlocked = graph.gated[eligible[graph.gated]]
+        body = {
+            "eligible_count": int(eligible.sum()),
+            "unlocked": [graph.codes[v] for v in unlocked.tolist()],
+            "coreqs": {graph.codes[v]: c for v in graph.coreqs
+                       if eligible[v] and (c := graph.missing_coreqs(v, done))},
+            "unknown": unknown,
+        }
+        if data.get("list_eligible", True):
+            body["eligible"] = [graph.codes[v] for v in np.flatnonzero(eligible).tolist()]
+        if target is not None:
+            known, missing = graph.resolve([target])
+            if missing:
+                return jsonify({"error": f"unknown course '{missing[0]}'"}), 400
+            node = known[0]
+            chain = graph.unlock_chain(node, done)
+            body["target"] = dict(
+                course_code=graph.codes[node], completed=node in done, eligible=bool(eligible[node]),
+                missing=[c for step in chain["steps"] for c in step] + chain["blocked"],
+                terms=len(chain["steps"]), **chain)
+        body["elapsed_us"] = round(1e6 * (time.perf_counter() - t0), 1)
+        body["version"] = st.version
+        return jsonify(body)
+    
+    except Exception as e:
+        ERRORS.inc(endpoint="/prereqs")
+        app.logger.exception("[app] Error processing prerequisite request")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/similar/<course_code>")
+def similar_courses(course_code):
+    """
+    Courses most similar to `course_code` ("CS 412", "cs412"), read from the similarity
+    graph precomputed by build_index.py: no encode and no search.
+    
+    Query parameters:
+        top_courses  number of courses (default 8, at most the graph's k)
+        diversity    0..1 (default 0); > 0 re-ranks so one subject doesn't fill the list,
+                     "diverse=1" is shorthand for the default strength
+    
+    Returns:
+    {
+        "course_code": "CS 412",
+        "results": [{"course_code": "CS 411", ..., "score": 0.83}, ...],
+        "count": 8,
+        "stats": {"diversity": 0.0, "elapsed_us": 41.3},
+        "version": "9c2da76c1eb2"
+    }
+    """
+    if not ready.is_set():
+        return _not_ready()
+    try:
+        st = current_state()
+        if st.similar is None:
+            return jsonify({"error": "similar courses need an index built with a course-level index"}), 400
+        try:
+            top = _parse_top_courses(request.args.get("top_courses"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        default = DIVERSITY if request.args.get("diverse") in ("1", "true") else 0.0
+        try:
+            diversity = float(request.args.get("diversity", default))
+        except ValueError:
+            diversity = -1.0
+        if not 0.0 <= diversity <= 1.0:
+            return jsonify({"error": "'diversity' must be a number between 0 and 1"}), 400
+        
+        t0 = time.perf_counter()
+        code = normalize_code(course_code)
+        row = st.lexical.codes.get(code)
+        if row is None:
+            return jsonify({"error": f"unknown course '{code}'"}), 404
+        parent = int(st.store.parent_idx[row])
+        if diversity > 0:
+            ids, scores = st.similar.lookup(parent)
+            subjects = [st.store.get("metadata.subject_code", r) for r in st.store.parent_rows[ids].tolist()]
+            ids, scores = diversify(ids, scores, subjects, top, diversity)
+        else:
+            ids, scores = st.similar.lookup(parent, top)
+        results = _materialize(st.store.parent_rows[ids], scores, st.store)
+        elapsed_us = round(1e6 * (time.perf_counter() - t0), 1)
+        return jsonify({"course_code": code, "results": results, "count": len(results),
+                        "stats": {"diversity": diversity, "elapsed_us": elapsed_us}, "version": st.version})
+    
+    except Exception as e:
+        ERRORS.inc(endpoint="/similar")
+        app.logger.exception("[app] Error processing similar-courses request")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/batch_stats")
+def batch_stats():
+    """Coalescer knobs and batch-size histogram for /query."""
+    return jsonify(coalescer.stats())
+
+@app.route("/cache_stats")
+def cache_stats():
+    """Query cache hit/miss counters and sizes."""
+    return jsonify(query_cache.stats())
+
+@app.route("/admin/reload", methods=["GET", "POST"])
+def admin_reload():
+    """
+    POST {"index_dir": "..."} (optional, default: the live index's directory) loads that
+    index in the background, validates it and swaps it in while requests keep being
+    served by the live one; GET reports the progress of the last reload.
+    """
+    if not _admin_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    if request.method == "GET":
+        return jsonify(dict(reload_status, live_version=version))
+    if not ready.is_set() and startup["phase"] != "failed":
+        return jsonify({"error": f"Index is still loading ({startup['phase']})"}), 409
+    data = request.get_json(silent=True) or {}
+    new_dir = Path(data.get("index_dir") or index_dir or default_index_dir())
+    if not reload_index(new_dir):
+        return jsonify(dict(reload_status, error="a reload is already running")), 409
+    return jsonify(dict(reload_status, live_version=version)), 202
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics for this process (each gunicorn worker has its own)."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug/profiler", methods=["GET", "POST"])
+def debug_profiler():
+    """
+    Sampling profiler, off until started. POST {"action": "start", "interval_ms": 5,
+    "duration_s": 30} or {"action": "stop"}; GET returns its status, or the collapsed
+    stacks (flamegraph.pl / speedscope input) with ?format=collapsed[&top=N].
+    """
+    if not _admin_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    if request.method == "GET":
+        if request.args.get("format") == "collapsed":
+            top = request.args.get("top", type=int)
+            return Response(profiler.collapsed(top), mimetype="text/plain")
+        return jsonify(profiler.status())
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    if action == "start":
+        try:
+            interval_ms = float(data.get("interval_ms", 5))
+            duration_s = float(data.get("duration_s", 30))
+        except (TypeError, ValueError):
+            return jsonify({"error": "'interval_ms' and 'duration_s' must be numbers"}), 400
+        if not (0.5 <= interval_ms <= 1000) or not (0 < duration_s <= 600):
+            return jsonify({"error": "need 0.5 <= interval_ms <= 1000 and 0 < duration_s <= 600"}), 400
+        if not profiler.start(interval_ms, duration_s, reset=data.get("reset", True)):
+            return jsonify({"error": "profiler is already running"}), 409
+        print(f"[app] profiler started ({interval_ms:g} ms interval, up to {duration_s:g}s)")
+    elif action == "stop":
+        profiler.stop()
+        print(f"[app] profiler stopped after {profiler.samples} samples")
+    else:
+        return jsonify({"error": "'action' must be 'start' or 'stop'"}), 400
+    return jsonify(profiler.status())
+
+if __name__ == "__main__":
+    # Load in the background so the port is bound right away; /readyz flips when done.
+    # With the debug reloader only the child process (WERKZEUG_RUN_MAIN) serves.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_load()
 
     # Read port from environment so frontend and backend can be started on the same port.
     # Default to 5001 to avoid common macOS services on 5000.
@@ -229,6 +975,9 @@ if __name__ == "__main__":
         port = 5001
 
     host = os.environ.get("RAG_API_HOST", "127.0.0.1")
-    print(f"[app] Starting Flask server on http://{host}:{port}")
+    if os.environ.get("RAG_TORCH_THREADS"):
+        pin_threads(int(os.environ["RAG_TORCH_THREADS"]))
+    print(f"[app] Starting Flask development server on http://{host}:{port} "
+          "(use gunicorn -c gunicorn.conf.py wsgi:app for production)")
     # Bind to host and port from environment
-    app.run(debug=True, host=host, port=port)
+    app.run(debug=True, host=host, port=port, threaded=True)
@@ -0,0 +1,164 @@
+"""
+Serving benchmark: QPS, latency and per-worker memory as gunicorn workers grow.
+
+For each worker count this starts `gunicorn -c gunicorn.conf.py wsgi:app`, drives
+/query with a closed loop of client threads for a fixed duration and reads the
+memory of every worker from /proc (Linux): RSS, PSS (RSS with shared pages split
+between the processes sharing them) and the shared part of RSS.
+
+    cd rag/web
+    python bench_serving.py --workers 1 2 4 --clients 16 --duration 20
+
+The query cache is disabled for the run so every request does real work.
+"""
+import argparse, http.client, json, os, signal, subprocess, sys, threading, time
+from pathlib import Path
+
+import numpy as np
+
+QUERIES = [
+    "machine learning", "courses about databases", "intro to accounting", "organic chemistry lab",
+    "statistics for social science", "computer security", "music theory", "public health policy",
+    "urban planning", "creative writing workshop", "operations research", "cognitive psychology",
+    "data visualization", "microeconomics", "human anatomy", "art history survey",
+]
+
+
+def _smaps(pid: int) -> dict:
+    out = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[1].isdigit():
+                out[parts[0].rstrip(":")] = int(parts[1]) / 1024  # MB
+    return out
+
+
+def _children(pid: int):
+    kids = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        kids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return kids
+
+
+def _post(conn, query: str):
+    conn.request("POST", "/query", body=json.dumps({"query": query}),
+                 headers={"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status
+
+
+def _wait_ready(port: int, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            if _post(conn, "warm up") == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def _load(port: int, clients: int, duration: float):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop = time.time() + duration
+
+    def client(seed: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine, i = [], seed
+        while time.time() < stop:
+            t0 = time.perf_counter()
+            try:
+                ok = _post(conn, QUERIES[i % len(QUERIES)]) == 200
+            except OSError:
+                ok = False
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            if ok:
+                mine.append(time.perf_counter() - t0)
+            else:
+                with lock:
+                    errors[0] += 1
+            i += 1
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return np.asarray(latencies) * 1e3, errors[0], time.perf_counter() - t0
+
+
+def run(n_workers: int, args) -> dict:
+    env = dict(os.environ, RAG_WORKERS=str(n_workers), RAG_THREADS=str(args.threads),
+               RAG_API_HOST="127.0.0.1", RAG_API_PORT=str(args.port), RAG_CACHE_SIZE="0")
+    if args.index_dir:
+        env["RAG_INDEX_DIR"] = str(Path(args.index_dir).resolve())
+    web_dir = Path(__file__).resolve().parent
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+                            cwd=web_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not _wait_ready(args.port, args.startup_timeout):
+            raise RuntimeError(f"gunicorn with {n_workers} workers did not come up on port {args.port}")
+        lat, errors, elapsed = _load(args.port, args.clients, args.duration)
+        workers = [_smaps(pid) for pid in _children(proc.pid)]
+        master = _smaps(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+    return {
+        "workers": n_workers,
+        "requests": int(len(lat)),
+        "errors": errors,
+        "qps": round(len(lat) / elapsed, 1),
+        "p50_ms": round(float(np.percentile(lat, 50)), 2) if len(lat) else None,
+        "p99_ms": round(float(np.percentile(lat, 99)), 2) if len(lat) else None,
+        "master_rss_mb": round(master.get("Rss", 0), 1),
+        "worker_rss_mb": round(float(np.mean([w.get("Rss", 0) for w in workers])), 1),
+        "worker_pss_mb": round(float(np.mean([w.get("Pss", 0) for w in workers])), 1),
+        "worker_shared_mb": round(float(np.mean([w.get("Shared_Clean", 0) + w.get("Shared_Dirty", 0)
+                                                 for w in workers])), 1),
+        "total_pss_mb": round(master.get("Pss", 0) + sum(w.get("Pss", 0) for w in workers), 1),
+    }
+
+
+def main(args):
+    print(f"[bench] {args.clients} closed-loop clients x {args.duration:.0f}s, {args.threads} threads/worker, "
+          f"{os.cpu_count()} cores")
+    print(f"{'workers':>7} {'qps':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS/wkr':>8} {'PSS/wkr':>8} "
+          f"{'shared':>8} {'total PSS':>10}")
+    rows = []
+    for n in args.workers:
+        r = run(n, args)
+        rows.append(r)
+        print(f"{r['workers']:>7} {r['qps']:>8.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['worker_rss_mb']:>8.1f} {r['worker_pss_mb']:>8.1f} {r['worker_shared_mb']:>8.1f} "
+              f"{r['total_pss_mb']:>10.1f}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(rows, indent=2))
+        print(f"[bench] wrote {args.json}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    ap.add_argument("--clients", type=int, default=16, help="concurrent closed-loop clients")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load per worker count")
+    ap.add_argument("--port", type=int, default=5099)
+    ap.add_argument("--index-dir", default=None, help="index to serve (default: the app's own)")
+    ap.add_argument("--startup-timeout", type=float, default=180.0)
+    ap.add_argument("--json", default=None, help="also write the results to this file")
+    main(ap.parse_args())
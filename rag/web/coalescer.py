@@ -0,0 +1,92 @@
+"""
+Micro-batching request coalescer for the RAG API.
+
+Requests that arrive within a short window (or until a max batch size is hit)
+are handed to a single batch handler, so the encoder and FAISS search run once
+per batch instead of once per request. Each caller blocks on its own future and
+receives only its own result.
+"""
+
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+class QueryCoalescer:
+    """Collect submitted items into batches and run `handler(items) -> results` once per batch."""
+
+    def __init__(self, handler, window_ms: float = 5.0, max_batch: int = 32):
+        self.handler = handler
+        self.window_ms = float(window_ms)
+        self.max_batch = max(1, int(max_batch))
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._histogram = Counter()
+        self._batches = 0
+        self._items = 0
+        self._wait_total = 0.0
+
+    def submit(self, item, timeout: float = None):
+        """Queue one item and block until its batch has been processed."""
+        fut = Future()
+        self._ensure_worker()
+        self._queue.put((item, fut, time.perf_counter()))
+        return fut.result(timeout=timeout)
+
+    def _ensure_worker(self):
+        # Started lazily so a pre-forked server gets one worker thread per process.
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="query-coalescer", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        window = self.window_ms / 1000.0
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        started = time.perf_counter()
+        items = [item for item, _, _ in batch]
+        try:
+            results = self.handler(items)
+        except Exception as e:
+            for _, fut, _ in batch:
+                fut.set_exception(e)
+        else:
+            for (_, fut, _), res in zip(batch, results):
+                fut.set_result(res)
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._histogram[len(batch)] += 1
+            self._wait_total += sum(started - queued for _, _, queued in batch)
+
+    def stats(self) -> dict:
+        """Knobs plus the batch-size histogram, for tuning throughput against added latency."""
+        with self._lock:
+            return {
+                "window_ms": self.window_ms,
+                "max_batch": self.max_batch,
+                "batches": self._batches,
+                "items": self._items,
+                "mean_batch_size": (self._items / self._batches) if self._batches else 0.0,
+                "mean_queue_wait_ms": (1000.0 * self._wait_total / self._items) if self._items else 0.0,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._histogram.items())},
+            }
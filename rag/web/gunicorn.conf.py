@@ -0,0 +1,34 @@
+"""
+gunicorn settings for the RAG API (see wsgi.py). All knobs come from the environment:
+
+  RAG_API_HOST / RAG_API_PORT   bind address (default 127.0.0.1:5001)
+  RAG_WORKERS                   worker processes (default 2)
+  RAG_THREADS                   request threads per worker (default 4)
+  RAG_TORCH_THREADS             torch/FAISS threads per worker (default: cores // workers)
+  RAG_INDEX_MMAP                map FAISS vectors from disk (default 1 here)
+"""
+import os
+
+bind = f"{os.environ.get('RAG_API_HOST', '127.0.0.1')}:{os.environ.get('RAG_API_PORT') or os.environ.get('PORT') or '5001'}"
+workers = int(os.environ.get("RAG_WORKERS", "2"))
+threads = int(os.environ.get("RAG_THREADS", "4"))
+worker_class = "gthread"   # threads let concurrent requests share a worker's coalescer batches
+timeout = int(os.environ.get("RAG_TIMEOUT", "60"))
+
+# Load index + model in the master before forking (see wsgi.py)
+preload_app = True
+os.environ.setdefault("RAG_INDEX_MMAP", "1")
+
+# Split the cores between workers. The env vars must be set before torch is
+# imported (during preload) to size its OpenMP pool; post_fork pins each worker.
+torch_threads = int(os.environ.get("RAG_TORCH_THREADS") or max(1, (os.cpu_count() or 1) // workers))
+for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(var, str(torch_threads))
+
+
+def post_fork(server, worker):
+    from app import pin_threads, start_background_load
+    pin_threads(torch_threads)
+    server.log.info(f"[app] worker {worker.pid}: {torch_threads} torch/FAISS thread(s)")
+    # The index was loaded before the fork; each worker only warms up (threads don't survive fork)
+    start_background_load(load=False)
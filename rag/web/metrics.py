@@ -0,0 +1,194 @@
+"""
+In-process metrics for the RAG API, without extra dependencies.
+
+- Counter / Histogram with labels, rendered by `Registry.render()` in the
+  Prometheus text exposition format (served at /metrics).
+- `server_timing(timings)`: a Server-Timing header value from {stage: ms}, which
+  browser devtools show as the request's timing breakdown.
+- `SamplingProfiler`: samples the stacks of all other threads every few ms while
+  switched on and aggregates them as collapsed stacks (flamegraph.pl / speedscope).
+
+Every gunicorn worker keeps its own metrics; scrape each worker or sum across them.
+"""
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from pathlib import Path
+
+# Seconds; tuned for a hot path of sub-ms stages up to multi-second encodes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+
+
+class Gauge:
+    """A value read when metrics are rendered."""
+
+    def __init__(self, name: str, help: str, fn):
+        self.name, self.help, self.fn = name, help, fn
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {float(self.fn()):g}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            names = self.labelnames + ("le",)
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{_labels(names, key + (f'{bound:g}',))} {count}"
+            yield f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {series[-2]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {series[-1]:.6f}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {series[-2]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self._metrics for line in m.render()) + "\n"
+
+
+def server_timing(timings: dict) -> str:
+    """Server-Timing header value: `encode;dur=4.210, search;dur=0.630, ...` (ms)."""
+    return ", ".join(f"{name};dur={ms:.3f}" for name, ms in timings.items())
+
+
+# ----------------------------
+# Sampling profiler
+# ----------------------------
+# (module, function) of the frames a thread sits in while idle (waiting for work, I/O or a
+# lock); not worth counting. Matched with the module too, since names like `get` and
+# `wait` are also hot-path methods elsewhere (MetaStore.get).
+_IDLE = {
+    ("threading", "wait"), ("threading", "_wait_for_tstate_lock"), ("queue", "get"),
+    ("selectors", "select"), ("socket", "accept"), ("socket", "readinto"),
+    ("connection", "wait"), ("connection", "_poll"),   # multiprocessing.connection
+}
+
+
+def _idle(frame) -> bool:
+    return (Path(frame.f_code.co_filename).stem, frame.f_code.co_name) in _IDLE
+
+
+class SamplingProfiler:
+    """
+    Off by default. `start()` launches one daemon thread that reads every other
+    thread's current stack every `interval_ms` (sys._current_frames) and counts each
+    distinct stack; it stops itself after `duration_s`. Costs nothing while off.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stacks = _Tally()
+        self.samples = 0
+        self.interval_ms = None
+        self.started = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: float = 5.0, duration_s: float = 30.0, reset: bool = True):
+        with self._lock:
+            if self.running:
+                return False
+            if reset:
+                self.stacks, self.samples = _Tally(), 0
+            self.interval_ms, self.started = float(interval_ms), time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval_ms / 1e3, duration_s),
+                                             name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, interval: float, duration_s: float):
+        me = threading.get_ident()
+        deadline = time.perf_counter() + duration_s
+        while not self._stop.wait(interval) and time.perf_counter() < deadline:
+            for tid, frame in sys._current_frames().items():
+                if tid == me or _idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.samples += 1
+
+    def status(self) -> dict:
+        return {"running": self.running, "samples": self.samples, "interval_ms": self.interval_ms,
+                "started": self.started, "distinct_stacks": len(self.stacks)}
+
+    def collapsed(self, top: int = None) -> str:
+        """`frame;frame;frame count` per line, most sampled first."""
+        with self._lock:
+            items = self.stacks.most_common(top)
+        return "".join(f"{stack} {count}\n" for stack, count in items)
@@ -0,0 +1,21 @@
+"""
+WSGI entry point for production serving:
+
+    cd rag/web
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py sets preload_app, so this module (and with it the FAISS index,
+chunk metadata and model) is loaded once in the master process. Workers are
+forked afterwards and share those pages copy-on-write instead of each loading
+their own copy; each worker then warms up in the background (post_fork) and
+reports ready on /readyz.
+"""
+from app import app, load_index, startup
+
+try:
+    load_index()
+except Exception as e:
+    # Workers still start and answer /healthz; /readyz and /query report the error
+    startup["phase"] = "failed"
+    startup["error"] = str(e)
+    print(f"[app] Failed to load index: {e}")
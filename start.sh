@@ -32,19 +32,45 @@ RAG_API_PORT=$PORT RAG_API_HOST=$HOST python app.py &
 FLASK_PID=$!
 cd ../..
 
-echo "⏳ Waiting for backend to become healthy (timeout 20s)..."
+# The server binds right away (/healthz) and loads the index + model in the
+# background; /readyz turns 200 once it can answer queries.
+echo "⏳ Waiting for backend to start (timeout 20s)..."
 TRIES=0
 MAX_TRIES=20
-until curl -sSf "http://localhost:$PORT/" >/dev/null 2>&1; do
+until curl -sSf "http://localhost:$PORT/healthz" >/dev/null 2>&1; do
     TRIES=$((TRIES+1))
     if [ $TRIES -ge $MAX_TRIES ]; then
-        echo "❌ Backend did not become healthy after $((MAX_TRIES*1)) seconds. Check logs (PID=$FLASK_PID)."
+        echo "❌ Backend did not start after $((MAX_TRIES*1)) seconds. Check logs (PID=$FLASK_PID)."
         echo "   To view logs: tail -n 200 rag/web/*.log || true"
         break
     fi
     sleep 1
 done
 
+if [ $TRIES -lt $MAX_TRIES ]; then
+    READY_TIMEOUT=${RAG_READY_TIMEOUT:-180}
+    echo "⏳ Backend is up; waiting for the index and model to load (timeout ${READY_TIMEOUT}s)..."
+    WAITED=0
+    until curl -sSf "http://localhost:$PORT/readyz" >/dev/null 2>&1; do
+        STATUS=$(curl -s "http://localhost:$PORT/readyz" | tr -d '\n ' )
+        if echo "$STATUS" | grep -q '"phase":"failed"'; then
+            echo "❌ Backend failed to load the index: $STATUS"
+            TRIES=$MAX_TRIES
+            break
+        fi
+        WAITED=$((WAITED+1))
+        if [ $WAITED -ge $READY_TIMEOUT ]; then
+            echo "❌ Backend not ready after ${READY_TIMEOUT} seconds: $STATUS"
+            TRIES=$MAX_TRIES
+            break
+        fi
+        if [ $((WAITED % 5)) -eq 0 ]; then
+            echo "   ...still loading: $STATUS"
+        fi
+        sleep 1
+    done
+fi
+
 if [ $TRIES -lt $MAX_TRIES ]; then
     echo "✅ Backend is up at http://localhost:$PORT"
 